@@ -0,0 +1,26 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('assetpos', '0010_asset_ignore_placement_restrictions'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            # assetpos.models.CHANGE_SEQUENCE_NAME
+            "CREATE SEQUENCE assetpos_assetpositions_change_sequence",
+            "DROP SEQUENCE assetpos_assetpositions_change_sequence",
+        ),
+        migrations.AddField(
+            model_name='assetpositions',
+            name='change_sequence',
+            field=models.BigIntegerField(db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='assetpositions',
+            name='delete_stamp',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
@@ -1,9 +1,26 @@
+import json
 from datetime import datetime
 
 from django.conf import settings
 from django.contrib.gis.db import models
+from django.db import connection, transaction
+from django.db.models.expressions import RawSQL
+from django.utils import timezone
+from landscapelab import vector_tiles
 from raster.models import Tile
 
+# the database sequence from which the change_sequence of AssetPositions is taken
+CHANGE_SEQUENCE_NAME = "assetpos_assetpositions_change_sequence"
+
+# the key of the (transaction level) advisory lock which is held while changes of AssetPositions are written
+CHANGE_LOCK_KEY = 2606201
+
+# the PostgreSQL notification channel on which all changes of AssetPositions are announced (see notify_changes)
+CHANGE_CHANNEL = "assetpos_changes"
+
+# the local path of the vector tile cache of the AssetPositions of each scenario (see landscapelab.vector_tiles)
+ASSET_TILES_PATH = "assetpos/{}"
+
 
 # an asset type is a collection of common assets which share some properties
 # especially currently they share the same placement configuration
@@ -77,6 +94,101 @@ class Attribute(models.Model):
     value = models.FloatField()
 
 
+def lock_changes():
+    """Locks the AssetPositions changes until the end of the current transaction.
+
+    Since the lock is held until the commit, changes are committed in the order of their change_sequence - so a
+    client which has seen a change_sequence is guaranteed to have seen all changes before it."""
+
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_advisory_xact_lock(%s)", [CHANGE_LOCK_KEY])
+
+
+def next_change_sequences(count=1):
+    """Locks the AssetPositions changes (see lock_changes) and returns count new change_sequence numbers.
+    Must be called within a transaction."""
+
+    lock_changes()
+
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT nextval(%s) FROM generate_series(1, %s)", [CHANGE_SEQUENCE_NAME, count])
+        return [row[0] for row in cursor.fetchall()]
+
+
+def notify_changes(ids, previous_locations=None):
+    """Announces the current state of the AssetPositions with the given ids on the CHANGE_CHANNEL as JSON with the id,
+    sequence, scenario, assettype, asset, orientation, position, previous (position), and deleted.
+    previous_locations are the locations by id before they were moved (by default, the current ones).
+
+    The notifications are only delivered when (and if) the current transaction is committed - and only then, the
+    cached vector tiles which contain the previous or the new positions are invalidated."""
+
+    previous_positions = [{"id": assetpos_id, "position": [location.x, location.y]}
+                          for assetpos_id, location in (previous_locations or {}).items() if location is not None]
+
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT pg_notify(%s, json_build_object(
+                'id', p.id, 'sequence', p.change_sequence, 'scenario', t.scenario_id, 'assettype', p.asset_type_id,
+                'asset', p.asset_id, 'orientation', p.orientation,
+                'position', json_build_array(ST_X(p.location), ST_Y(p.location)),
+                'previous', COALESCE(previous.position, json_build_array(ST_X(p.location), ST_Y(p.location))),
+                'deleted', p.delete_stamp IS NOT NULL)::text),
+                t.scenario_id, ST_X(p.location), ST_Y(p.location),
+                (previous.position->>0)::float8, (previous.position->>1)::float8
+            FROM {positions} p
+            LEFT JOIN {tiles} t ON t.id = p.tile_id
+            LEFT JOIN json_to_recordset(%s::json) AS previous(id integer, position json) ON previous.id = p.id
+            WHERE p.id = ANY(%s)
+            ORDER BY p.change_sequence
+        """.format(positions=AssetPositions._meta.db_table, tiles=Tile._meta.db_table),
+            [CHANGE_CHANNEL, json.dumps(previous_positions), list(ids)])
+
+        changes = [change[1:] for change in cursor.fetchall()]
+
+    transaction.on_commit(lambda: invalidate_asset_tiles(changes))
+
+
+def invalidate_asset_tiles(changes):
+    """Removes the cached vector tiles which contain any of the given (scenario id, x, y, previous x, previous y)"""
+
+    for scenario_id, meter_x, meter_y, previous_x, previous_y in changes:
+        if scenario_id is None:
+            continue
+
+        path = vector_tiles.get_cache_path(ASSET_TILES_PATH.format(scenario_id))
+        vector_tiles.invalidate_tiles(path, meter_x, meter_y, meter_x, meter_y)
+
+        if previous_x is not None and (previous_x, previous_y) != (meter_x, meter_y):
+            vector_tiles.invalidate_tiles(path, previous_x, previous_y, previous_x, previous_y)
+
+
+class AssetPositionsQuerySet(models.QuerySet):
+
+    def remove(self):
+        """Marks all AssetPositions of this queryset as deleted (see AssetPositions.delete_stamp) with a new
+        change_sequence each and returns their number"""
+
+        with transaction.atomic(using=self.db):
+            lock_changes()
+
+            ids = list(self.filter(delete_stamp__isnull=True).values_list("id", flat=True))
+            removed = self.model.all_objects.filter(id__in=ids).update(
+                delete_stamp=timezone.now(), change_sequence=RawSQL("nextval(%s)", [CHANGE_SEQUENCE_NAME]))
+
+            notify_changes(ids)
+
+            return removed
+
+
+class AssetPositionsManager(models.Manager.from_queryset(AssetPositionsQuerySet)):
+
+    def get_queryset(self):
+        """Returns only the AssetPositions which have not been deleted"""
+
+        return super().get_queryset().filter(delete_stamp__isnull=True)
+
+
 # this main table holds all the instances of assets with their location
 # TODO: we have to optimize and probably cache it on the client as this will be called often
 class AssetPositions(models.Model):
@@ -101,6 +213,35 @@ class AssetPositions(models.Model):
     # the timestamp, when this position was created
     create_stamp = models.DateTimeField(null=False, auto_now_add=True)
 
-    # FIXME: decide if we want to implement a delete stamp rather then acutally deleting the data
-    # FIXME: this would also mean a lot of changes when querying for asset positions
-    # delete_stamp = models.DateTimeField(null=True)
+    # the timestamp, when this position was deleted - deleted positions are kept as tombstones, so that clients can
+    # be notified of the deletion (see assetpos.views.get_assetposition_changes)
+    delete_stamp = models.DateTimeField(null=True)
+
+    # increases with every change (creation, move or deletion) of any position (see next_change_sequences)
+    # positions which have not been changed since the change tracking was introduced have 0
+    change_sequence = models.BigIntegerField(default=0, db_index=True)
+
+    # only the positions which have not been deleted
+    objects = AssetPositionsManager()
+
+    # all positions including the deleted ones
+    all_objects = AssetPositionsQuerySet.as_manager()
+
+    # the location when this position was loaded from the database (see notify_changes)
+    _loaded_location = None
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_location = instance.__dict__.get("location")
+
+        return instance
+
+    def save(self, *args, **kwargs):
+        # every change gets a new change_sequence, which is committed (and announced) together with it
+        with transaction.atomic(using=kwargs.get("using")):
+            self.change_sequence = next_change_sequences()[0]
+            super().save(*args, **kwargs)
+
+            notify_changes([self.id], {self.id: self._loaded_location})
+            self._loaded_location = self.location
@@ -28,6 +28,15 @@ urlpatterns = [
         r'?P<orientation>(\d+))$',
         views.register_assetposition, name='register_assetposition'),
 
+    # Creates many instances of assets within a scenario, given as json in the request body
+    url(r'^create_batch/(?P<scenario_id>(\d+))$', views.register_assetpositions, name='register_assetpositions'),
+
+    # Sets the positions of many asset instances within a scenario, given as json in the request body
+    url(r'^set_batch/(?P<scenario_id>(\d+))$', views.set_assetpositions, name='set_assetpositions'),
+
+    # Deletes many asset instances within a scenario, given as json in the request body
+    url(r'^remove_batch/(?P<scenario_id>(\d+))$', views.remove_assetpositions, name='remove_assetpositions'),
+
     # Deletes an asset instance
     url(r'^remove/(?P<assetpos_id>(\d+))$',
         views.remove_assetposition, name='remove_assetposition'),
@@ -48,6 +57,30 @@ urlpatterns = [
     url(r'^get_all/(?P<assettype_id>(\d+))/(?P<tile_x>(\d+(?:\.\d+)))/(?P<tile_y>(\d+(?:\.\d+)))/(?P<zoom>(\d+)).json$',
         views.get_assetpositions, name='get_assetpositions'),
 
+    # Request the changes of the locations of an assettype within a scenario and a given tile after a change sequence
+    url(r'^changes/(?P<scenario_id>(\d+))/(?P<assettype_id>(\d+))/(?P<since>(\d+))/'
+        r'(?P<tile_x>(\d+(?:\.\d+)))/(?P<tile_y>(\d+(?:\.\d+)))/(?P<zoom>(\d+)).json$',
+        views.get_assetposition_changes_for_tile, name='get_assetposition_changes_for_tile'),
+
+    # Request the changes of the AssetPositions of an AssetType within a scenario close to a given point (using the
+    # AssetType's display_radius) after a change sequence
+    url(r'^changes_near/(?P<scenario_id>(\d+))/(?P<assettype_id>(\d+))/(?P<since>(\d+))/'
+        r'(?P<meter_x>(\d+(?:\.\d+)))/(?P<meter_y>(\d+(?:\.\d+))).json$',
+        views.get_assetposition_changes_near, name='get_assetposition_changes_near'),
+
+    # Stream the changes of the locations of an assettype within a scenario as server-sent events
+    url(r'^stream/(?P<scenario_id>(\d+))/(?P<assettype_id>(\d+))$',
+        views.stream_assetposition_changes, name='stream_assetposition_changes'),
+
+    # Stream the changes of the locations of an assettype within a scenario and a given tile as server-sent events
+    url(r'^stream/(?P<scenario_id>(\d+))/(?P<assettype_id>(\d+))/'
+        r'(?P<tile_x>(\d+(?:\.\d+)))/(?P<tile_y>(\d+(?:\.\d+)))/(?P<zoom>(\d+))$',
+        views.stream_assetposition_changes, name='stream_assetposition_changes'),
+
+    # Request all AssetPositions of a scenario within a tile as Mapbox Vector Tile
+    url(r'^mvt/(?P<scenario_id>(\d+))/(?P<zoom>(\d+))/(?P<tile_x>(\d+))/(?P<tile_y>(\d+)).mvt$',
+        views.get_assetpositions_mvt, name='get_assetpositions_mvt'),
+
     # Request all AssetPositions of an AssetType close to a given point (using the AssetType's display_radius)
     url(r'^get_near/by_asset/(?P<asset_or_assettype_id>(\d+))/'
         r'(?P<meter_x>(\d+(?:\.\d+)))/(?P<meter_y>(\d+(?:\.\d+))).json$',
@@ -58,6 +91,16 @@ urlpatterns = [
         r'(?P<meter_x>(\d+(?:\.\d+)))/(?P<meter_y>(\d+(?:\.\d+))).json$',
         views.get_near_assetpositions, {"by_assettype": True}, name='get_near_assetpositions'),
 
+    # Request all AssetPositions of an Asset within a scenario close to a given point
+    url(r'^get_near/(?P<scenario_id>(\d+))/by_asset/(?P<asset_or_assettype_id>(\d+))/'
+        r'(?P<meter_x>(\d+(?:\.\d+)))/(?P<meter_y>(\d+(?:\.\d+))).json$',
+        views.get_near_assetpositions, name='get_near_assetpositions'),
+
+    # Request all AssetPositions of an AssetType within a scenario close to a given point
+    url(r'^get_near/(?P<scenario_id>(\d+))/by_assettype/(?P<asset_or_assettype_id>(\d+))/'
+        r'(?P<meter_x>(\d+(?:\.\d+)))/(?P<meter_y>(\d+(?:\.\d+))).json$',
+        views.get_near_assetpositions, {"by_assettype": True}, name='get_near_assetpositions'),
+
     # returns a nested json of all (editable / nonabstract) assettypes
     url(r'^get_all_assettypes.json', views.getall_assettypes, {"include_abstract": True}, name="get_all_assettypes"),
     url(r'^get_all_editable_assettypes.json', views.getall_assettypes, {"editable": True}, name="get_all_editable"),
@@ -1,4 +1,6 @@
 import numpy as np
+from django.contrib.gis.db.models import PointField
+from django.db.models import Func, FloatField, Value
 
 
 # returns true if string matches one of the predefined values
@@ -20,3 +22,15 @@ def length(v):
 def get_squared_distance(point1, point2):
     """Returns the distance between two points squared (for efficiency)"""
     return (point1.x - point2.x) ** 2 + (point1.y - point2.y) ** 2
+
+
+class KNNDistance(Func):
+    """The PostGIS <-> (2D bounding box distance) operator between two geometries - in contrast to the Distance
+    function, ordering by it uses the spatial index, so the nearest rows are found without computing all distances"""
+
+    template = "%(expressions)s"
+    arg_joiner = " <-> "
+    output_field = FloatField()
+
+    def __init__(self, expression, point):
+        super().__init__(expression, Value(point, output_field=PointField(srid=point.srid)))
@@ -1,55 +1,167 @@
+import json
 import logging
+import math
+import select
+
+import psycopg2
 import webmercator
 
+from django.conf import settings
 from django.contrib.gis import geos
-from django.contrib.gis.db.models.functions import Distance
 from django.contrib.gis.measure import D
-from django.db.models import Q
-from django.http import JsonResponse
-
-from assetpos.models import AssetType, AssetPositions, Asset
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Q, Max
+from django.http import JsonResponse, StreamingHttpResponse, HttpResponseBadRequest
+from django.views.decorators.csrf import csrf_exempt
+
+from assetpos.models import AssetType, AssetPositions, Asset, CHANGE_CHANNEL, ASSET_TILES_PATH, lock_changes, \
+    next_change_sequences, notify_changes
 from django.contrib.gis.geos import Polygon
 
 from assetpos import util
+from landscapelab import vector_tiles
 from location.models import Scenario
+from raster.models import Tile
 from raster.tiles import get_root_tile
 
 logger = logging.getLogger(__name__)
 
 MAX_ASSETS_PER_RESPONSE = 50
 
+# the maximum number of assets which can be created, moved or removed at once
+MAX_ASSETS_PER_BATCH = 1000
 
-def can_place_at_position(assettype, meter_x, meter_y):
-    """Returns true if the asset with the given id may be placed at the given position."""
+# the size (in meters) of the grid cells for which the results of get_near_assetpositions are shared
+NEAR_ASSETS_CELL_SIZE = 50
 
-    position = geos.Point(float(meter_x), float(meter_y))
+# the number of seconds for which the results of get_near_assetpositions are cached per grid cell
+NEAR_ASSETS_CACHE_SECONDS = 5
+
+# the number of AssetPositions which are cached per grid cell - more than MAX_ASSETS_PER_RESPONSE, so that the nearest
+# ones of every point within the cell are usually among them
+NEAR_ASSETS_CACHED_ROWS = 4 * MAX_ASSETS_PER_RESPONSE
+
+# the maximum number of changes returned by get_assetposition_changes - clients poll again if there are more
+MAX_CHANGES_PER_RESPONSE = 1000
 
-    placement_areas = assettype.placement_areas
+# the number of seconds after which a keepalive comment is sent on an idle change stream
+STREAM_KEEPALIVE_SECONDS = 15
+
+
+def can_place_at_position(assettype, meter_x, meter_y, scenario=None, ignored_assetpos_id=None):
+    """Returns true if an asset of the given type may be placed at the given position.
+    If a scenario (or its id) is given, only the assets within this scenario are taken into account for the minimum
+    distance.
+    The asset position with the ignored_assetpos_id (e.g. the one which is being moved) is never in the way."""
+
+    position = geos.Point(float(meter_x), float(meter_y))
 
     # if there is another asset closer to this one than the minimum distance, it may not be placed
     if assettype.minimum_distance != 0:
-        # TODO: We might want to filter by scenario here as well, otherwise assets from other
-        #  scenarios can block this one
-        # TODO: This can be done much more efficiently using a spatial filter and checking if the count is 0
-        for other_asset in AssetPositions.objects.filter(asset_type_id=assettype).all():
-            squared_distance = util.get_squared_distance(other_asset.location, position)
-            required_squared_distance = assettype.minimum_distance ** 2
+        # the spatial index of the locations is used for the dwithin filter, so this doesn't depend on the total
+        # number of asset positions
+        too_close = AssetPositions.objects.filter(asset_type=assettype,
+                                                  location__dwithin=(position, D(m=assettype.minimum_distance)))
+
+        if scenario is not None:
+            too_close = too_close.filter(tile__scenario=scenario)
 
-            if squared_distance < required_squared_distance:
-                return not assettype.allow_placement
+        if ignored_assetpos_id is not None:
+            too_close = too_close.exclude(id=ignored_assetpos_id)
+
+        if too_close.exists():
+            return False
 
     # if there are no placement areas present this asset can be placed according
     # to it's global setting
-    if not placement_areas:
+    if not assettype.placement_areas:
         return assettype.allow_placement
 
-    # check if the position and the placement areas overlap
-    if placement_areas.covers(position):
+    # check if the position and the placement areas overlap - the areas have already been loaded with the asset type,
+    # so they are prepared for the test instead of being queried again
+    if assettype.placement_areas.prepared.covers(position):
         return assettype.allow_placement
     else:
         return not assettype.allow_placement
 
 
+def can_place_at_positions(scenario_id, placements, ignored_assetpos_ids=()):
+    """Returns a list with True for each of the given (assettype, meter_x, meter_y, ignore_restrictions, previous
+    location) placements within the given scenario if it may be placed there (see can_place_at_position).
+
+    The existing asset positions and the placement areas are checked in a single spatial query, in which the
+    positions with the ignored_assetpos_ids (e.g. the ones which are being moved) are not in the way. Additionally,
+    the placements must keep the minimum distance to each other (they are accepted in the given order), and to the
+    previous locations of the placements which are not possible (since those positions stay where they are).
+    Placements with ignore_restrictions are always possible."""
+
+    if not placements:
+        return []
+
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT at.minimum_distance != 0 AND EXISTS (
+                       SELECT 1 FROM {positions} p JOIN {tiles} t ON t.id = p.tile_id
+                       WHERE p.asset_type_id = at.id AND t.scenario_id = %s AND p.delete_stamp IS NULL
+                         AND NOT p.id = ANY(%s) AND ST_DWithin(p.location, c.point, at.minimum_distance)),
+                   ST_Covers(at.placement_areas, c.point)
+            FROM (SELECT u.number, u.assettype_id, ST_SetSRID(ST_MakePoint(u.x, u.y), %s) AS point
+                  FROM unnest(%s::integer[], %s::float8[], %s::float8[])
+                       WITH ORDINALITY AS u(assettype_id, x, y, number)) c
+            JOIN {assettypes} at ON at.id = c.assettype_id
+            ORDER BY c.number
+        """.format(positions=AssetPositions._meta.db_table, tiles=Tile._meta.db_table,
+                   assettypes=AssetType._meta.db_table),
+            [int(scenario_id), list(ignored_assetpos_ids), settings.DEFAULT_SRID,
+             [assettype.id for assettype, _, _, _, _ in placements],
+             [float(meter_x) for _, meter_x, _, _, _ in placements],
+             [float(meter_y) for _, _, meter_y, _, _ in placements]])
+
+        checks = cursor.fetchall()
+
+    def is_too_close(assettype, meter_x, meter_y, locations):
+        return assettype.minimum_distance != 0 and any(
+            other_assettype_id == assettype.id and
+            math.hypot(float(meter_x) - other_x, float(meter_y) - other_y) <= assettype.minimum_distance
+            for other_assettype_id, other_x, other_y in locations)
+
+    possible = []
+    accepted_locations = []
+
+    for (assettype, meter_x, meter_y, ignore_restrictions, _), (too_close, covered) in zip(placements, checks):
+        if ignore_restrictions:
+            is_possible = True
+        elif too_close or is_too_close(assettype, meter_x, meter_y, accepted_locations):
+            is_possible = False
+        elif covered is None:
+            # there are no placement areas
+            is_possible = assettype.allow_placement
+        else:
+            is_possible = assettype.allow_placement if covered else not assettype.allow_placement
+
+        if is_possible:
+            accepted_locations.append((assettype.id, float(meter_x), float(meter_y)))
+
+        possible.append(is_possible)
+
+    # the positions which can't be moved stay where they are, which may be too close to others which could be moved
+    rejected = True
+    while rejected:
+        staying_locations = [(assettype.id, previous.x, previous.y)
+                             for (assettype, _, _, _, previous), is_possible in zip(placements, possible)
+                             if not is_possible and previous is not None]
+        rejected = False
+
+        for number, (assettype, meter_x, meter_y, ignore_restrictions, _) in enumerate(placements):
+            if possible[number] and not ignore_restrictions \
+                    and is_too_close(assettype, meter_x, meter_y, staying_locations):
+                possible[number] = False
+                rejected = True
+
+    return possible
+
+
 # TODO: Remove default scenario_id=10 once the old request isn't used anymore
 def register_assetposition(request, asset_id, meter_x, meter_y, orientation=0, scenario_id=10):
     """Called when an asset should be instantiated at the given location.
@@ -76,7 +188,8 @@ def register_assetposition(request, asset_id, meter_x, meter_y, orientation=0, s
     assettype = asset.asset_type
 
     # If the ignore_placement_restrictions flag is not set and the asset may not be placed here, return
-    if (not asset.ignore_placement_restrictions) and (not can_place_at_position(assettype, meter_x, meter_y)):
+    if (not asset.ignore_placement_restrictions) and \
+            (not can_place_at_position(assettype, meter_x, meter_y, scenario=scenario)):
         return JsonResponse(ret)
 
     location_point = geos.Point(float(meter_x), float(meter_y))
@@ -88,10 +201,7 @@ def register_assetposition(request, asset_id, meter_x, meter_y, orientation=0, s
     # If this is a unique asset, there should only be one instance -> delete existing position first
     # TODO: Is there a cleaner way for this? (See TODO in assetpos/models.py at the 'unique' field)
     if asset.unique:
-        existing = AssetPositions.objects.filter(asset_type=assettype, asset=asset)
-
-        if existing.exists():
-            existing.delete()
+        AssetPositions.objects.filter(asset_type=assettype, asset=asset).remove()
 
     new_assetpos.save()
 
@@ -114,7 +224,8 @@ def remove_assetposition(request, assetpos_id):
     if not assetpos.exists():
         return JsonResponse(ret)
 
-    assetpos.delete()
+    # the position is kept as tombstone, so that the deletion is passed on to the clients
+    assetpos.remove()
     ret["delete_success"] = True
 
     return JsonResponse(ret)
@@ -141,7 +252,8 @@ def get_assetpositions_global(request, asset_id):
     The assets are named by their assetpos ID."""
 
     ret = {
-        "assets": None
+        "assets": None,
+        "sequence": get_change_sequence()
     }
 
     assets = AssetPositions.objects.filter(asset=asset_id).all()
@@ -164,7 +276,10 @@ def set_assetposition(request, assetpos_id, meter_x, meter_y):
         return JsonResponse(ret)
     assetpos = AssetPositions.objects.get(id=assetpos_id)
 
-    if not can_place_at_position(assetpos.asset_type, meter_x, meter_y):
+    scenario = assetpos.tile.scenario_id if assetpos.tile_id else None
+
+    if not can_place_at_position(assetpos.asset_type, meter_x, meter_y, scenario=scenario,
+                                 ignored_assetpos_id=assetpos.id):
         return JsonResponse(ret)
 
     assetpos.location = geos.Point(float(meter_x), float(meter_y))
@@ -175,10 +290,266 @@ def set_assetposition(request, assetpos_id, meter_x, meter_y):
     return JsonResponse(ret)
 
 
-def get_near_assetpositions(request, asset_or_assettype_id, meter_x, meter_y, by_assettype=False):
-    """Returns all AssetPositions of a given Asset-ID or AssetType-ID (if by_assettype == True) which are
-    closer than the AssetType's display_radius to the given point.
-    If the display_radius is 0, all AssetPositions are returned.
+def read_batch_assets(request):
+    """Returns the list of the 'assets' in the json request body, or None if it is invalid or too long"""
+
+    try:
+        items = json.loads(request.body.decode("utf-8"))["assets"]
+    except (ValueError, KeyError, TypeError) as error:
+        logger.warning("Invalid batch asset request: {}".format(error))
+        return None
+
+    if not isinstance(items, list):
+        logger.warning("Invalid batch asset request: 'assets' is not a list")
+        return None
+
+    if len(items) > MAX_ASSETS_PER_BATCH:
+        logger.warning("Batch asset request exceeded the maximum of {} assets".format(MAX_ASSETS_PER_BATCH))
+        return None
+
+    return items
+
+
+# creates many instances of assets within a scenario at once, given as json in the request body:
+# {"assets": [[asset_id, meter_x, meter_y, orientation], ...]} (the orientation is optional)
+# returns a list of the results ('creation_success' and 'assetpos_id' like register_assetposition) in the same order
+@csrf_exempt
+def register_assetpositions(request, scenario_id):
+
+    items = read_batch_assets(request)
+    if items is None:
+        return HttpResponseBadRequest()
+
+    if not all(isinstance(item, list) and 3 <= len(item) <= 4 for item in items):
+        logger.warning("Invalid batch asset request: every asset has to be a list of 3 or 4 values")
+        return HttpResponseBadRequest()
+
+    try:
+        requested = [(int(item[0]), float(item[1]), float(item[2]), float(item[3]) if len(item) > 3 else 0)
+                     for item in items]
+    except (ValueError, IndexError, KeyError, TypeError) as error:
+        logger.warning("Invalid batch asset request: {}".format(error))
+        return HttpResponseBadRequest()
+
+    results = [{"creation_success": False, "assetpos_id": None} for _ in requested]
+
+    scenario = Scenario.objects.filter(id=scenario_id).first()
+    if not scenario:
+        logger.warn("Non-existent scenario with ID {} requested!".format(scenario_id))
+        return JsonResponse({"results": results})
+
+    assets = Asset.objects.select_related("asset_type").in_bulk({asset_id for asset_id, _, _, _ in requested})
+
+    # only the first instance of a unique asset can be created
+    candidates = []
+    unique_assets = set()
+
+    for number, (asset_id, meter_x, meter_y, orientation) in enumerate(requested):
+        asset = assets.get(asset_id)
+
+        if not asset:
+            logger.warn("Attempt to create instance of on-existent asset with ID {}!".format(asset_id))
+        elif asset.unique and asset_id in unique_assets:
+            logger.warn("Attempt to create multiple instances of the unique asset with ID {}!".format(asset_id))
+        else:
+            candidates.append((number, asset, meter_x, meter_y, orientation))
+
+            if asset.unique:
+                unique_assets.add(asset_id)
+
+    with transaction.atomic():
+        # Other changes have to wait until this transaction is committed, so the placements stay valid
+        lock_changes()
+
+        possible = can_place_at_positions(scenario.id, [(asset.asset_type, meter_x, meter_y,
+                                                         asset.ignore_placement_restrictions, None)
+                                                        for _, asset, meter_x, meter_y, _ in candidates])
+        candidates = [candidate for candidate, is_possible in zip(candidates, possible) if is_possible]
+
+        # Unique assets replace their existing instance (see register_assetposition)
+        AssetPositions.objects.filter(asset__in=[asset for _, asset, _, _, _ in candidates if asset.unique]).remove()
+
+        root_tile = get_root_tile(scenario)
+        new_assetpositions = AssetPositions.objects.bulk_create([
+            AssetPositions(location=geos.Point(meter_x, meter_y), orientation=orientation, asset=asset,
+                           asset_type=asset.asset_type, tile=root_tile, change_sequence=change_sequence)
+            for (_, asset, meter_x, meter_y, orientation), change_sequence
+            in zip(candidates, next_change_sequences(len(candidates)))])
+
+        notify_changes([assetpos.id for assetpos in new_assetpositions])
+
+    for (number, _, _, _, _), assetpos in zip(candidates, new_assetpositions):
+        results[number] = {"creation_success": True, "assetpos_id": assetpos.id}
+
+    return JsonResponse({"results": results})
+
+
+# sets the positions of many existing asset instances within a scenario at once, given as json in the request body:
+# {"assets": [[assetpos_id, meter_x, meter_y], ...]}
+# returns a list of the results ('success' like set_assetposition) in the same order
+@csrf_exempt
+def set_assetpositions(request, scenario_id):
+
+    items = read_batch_assets(request)
+    if items is None:
+        return HttpResponseBadRequest()
+
+    if not all(isinstance(item, list) and len(item) == 3 for item in items):
+        logger.warning("Invalid batch asset request: every asset has to be a list of 3 values")
+        return HttpResponseBadRequest()
+
+    try:
+        requested = [(int(item[0]), float(item[1]), float(item[2])) for item in items]
+    except (ValueError, IndexError, KeyError, TypeError) as error:
+        logger.warning("Invalid batch asset request: {}".format(error))
+        return HttpResponseBadRequest()
+
+    # every asset instance can only be moved once
+    requested_ids = [assetpos_id for assetpos_id, _, _ in requested]
+    if len(set(requested_ids)) != len(requested_ids):
+        logger.warning("Batch asset request contains an asset instance multiple times")
+        return HttpResponseBadRequest()
+
+    with transaction.atomic():
+        # Other changes have to wait until this transaction is committed, so the placements stay valid
+        lock_changes()
+
+        assetpositions = AssetPositions.objects.select_related("asset_type") \
+            .filter(tile__scenario_id=scenario_id).in_bulk(requested_ids)
+        candidates = [(assetpositions[assetpos_id], meter_x, meter_y) for assetpos_id, meter_x, meter_y in requested
+                      if assetpos_id in assetpositions]
+
+        possible = can_place_at_positions(scenario_id,
+                                          [(assetpos.asset_type, meter_x, meter_y, False, assetpos.location)
+                                           for assetpos, meter_x, meter_y in candidates],
+                                          ignored_assetpos_ids=list(assetpositions))
+        moved = [assetpos for (assetpos, _, _), is_possible in zip(candidates, possible) if is_possible]
+        previous_locations = {assetpos.id: assetpos.location for assetpos in moved}
+
+        for (assetpos, meter_x, meter_y), is_possible in zip(candidates, possible):
+            if is_possible:
+                assetpos.location = geos.Point(meter_x, meter_y)
+
+        for assetpos, change_sequence in zip(moved, next_change_sequences(len(moved))):
+            assetpos.change_sequence = change_sequence
+
+        AssetPositions.objects.bulk_update(moved, ["location", "change_sequence"])
+        notify_changes(previous_locations.keys(), previous_locations)
+
+    return JsonResponse({"results": [{"success": assetpos_id in previous_locations} for assetpos_id in requested_ids]})
+
+
+# removes many asset instances within a scenario at once, given as json in the request body:
+# {"assets": [assetpos_id, ...]}
+# returns a list of the results ('delete_success' like remove_assetposition) in the same order
+@csrf_exempt
+def remove_assetpositions(request, scenario_id):
+
+    items = read_batch_assets(request)
+    if items is None:
+        return HttpResponseBadRequest()
+
+    try:
+        requested_ids = [int(item) for item in items]
+    except (ValueError, TypeError) as error:
+        logger.warning("Invalid batch asset request: {}".format(error))
+        return HttpResponseBadRequest()
+
+    with transaction.atomic():
+        # The lock is taken before reading, so the asset instances can't be removed concurrently in the meantime
+        lock_changes()
+
+        removed_ids = set(AssetPositions.objects.filter(id__in=requested_ids, tile__scenario_id=scenario_id)
+                          .values_list("id", flat=True))
+
+        AssetPositions.objects.filter(id__in=removed_ids).remove()
+
+    return JsonResponse({"results": [{"delete_success": assetpos_id in removed_ids} for assetpos_id in requested_ids]})
+
+
+def query_near_assetposition_rows(objects, radius, center, search_radius, limit):
+    """Returns the nearest (at most limit) AssetPositions of the given queryset within the search_radius (unless the
+    radius is 0) around the given point as (id, x, y, asset id, asset name) tuples, ordered by their distance"""
+
+    if radius > 0:
+        # the dwithin filter uses the spatial index
+        objects = objects.filter(location__dwithin=(center, D(m=search_radius)))
+
+    # the ordering by the KNN operator is done using the spatial index as well, so together with the limit, only
+    # the nearest rows are read - even if the radius is 0 (unlimited)
+    nearest = objects.order_by(util.KNNDistance("location", center)) \
+        .values_list("id", "location", "asset_id", "asset__name")[:limit]
+
+    return [(assetpos_id, location.x, location.y, asset_id, asset_name)
+            for assetpos_id, location, asset_id, asset_name in nearest]
+
+
+def get_near_assetposition_rows(objects, cache_key, radius, meter_x, meter_y):
+    """Returns the nearest (at most MAX_ASSETS_PER_RESPONSE) AssetPositions of the given queryset within the radius
+    (unless it is 0) around the given point as (distance, id, x, y, asset id, asset name) tuples ordered by their
+    distance, together with the change sequence (see get_change_sequence) before they were read.
+
+    Clients are usually close to each other, so the nearest NEAR_ASSETS_CACHED_ROWS around the center of the
+    NEAR_ASSETS_CELL_SIZE grid cell which contains the point are cached per cell for NEAR_ASSETS_CACHE_SECONDS, and
+    re-ranked for the exact point. To contain all positions which are within the radius of any point in the cell, the
+    cell's half diagonal is added to the radius. If the cached rows can't tell the nearest ones to the point apart
+    from the ones beyond them, the point is queried on its own.
+    """
+
+    cell_x = math.floor(meter_x / NEAR_ASSETS_CELL_SIZE)
+    cell_y = math.floor(meter_y / NEAR_ASSETS_CELL_SIZE)
+    cache_key = "{}:{}:{}".format(cache_key, cell_x, cell_y)
+
+    cell_center_x = (cell_x + 0.5) * NEAR_ASSETS_CELL_SIZE
+    cell_center_y = (cell_y + 0.5) * NEAR_ASSETS_CELL_SIZE
+    center_distance = math.hypot(meter_x - cell_center_x, meter_y - cell_center_y)
+
+    cached = cache.get(cache_key)
+
+    if cached is None:
+        sequence = get_change_sequence()
+        rows = query_near_assetposition_rows(objects, radius, geos.Point(cell_center_x, cell_center_y, srid=3857),
+                                             radius + NEAR_ASSETS_CELL_SIZE / math.sqrt(2), NEAR_ASSETS_CACHED_ROWS)
+
+        # all positions which are not cached are at least as far away from the cell center as the last cached one
+        if len(rows) < NEAR_ASSETS_CACHED_ROWS:
+            cached_distance = math.inf
+        else:
+            cached_distance = math.hypot(rows[-1][1] - cell_center_x, rows[-1][2] - cell_center_y)
+
+        cached = (sequence, rows, cached_distance)
+        cache.set(cache_key, cached, NEAR_ASSETS_CACHE_SECONDS)
+
+    sequence, rows, cached_distance = cached
+
+    # The rows are shared within the cell, so they are filtered and ordered for this exact point
+    near_rows = sorted((math.hypot(x - meter_x, y - meter_y), assetpos_id, x, y, asset_id, asset_name)
+                       for assetpos_id, x, y, asset_id, asset_name in rows)
+    near_rows = [row for row in near_rows if radius == 0 or row[0] <= radius][:MAX_ASSETS_PER_RESPONSE]
+
+    # Positions which are not cached are at least cached_distance - center_distance away from the point, so the
+    # cached rows are only enough if no position which is not cached could be closer than the ones returned (or, if
+    # there are less of them, within the radius)
+    if len(near_rows) == MAX_ASSETS_PER_RESPONSE:
+        required_distance = near_rows[-1][0]
+    else:
+        required_distance = radius if radius > 0 else math.inf
+
+    if required_distance > cached_distance - center_distance:
+        sequence = get_change_sequence()
+        rows = query_near_assetposition_rows(objects, radius, geos.Point(meter_x, meter_y, srid=3857), radius,
+                                             MAX_ASSETS_PER_RESPONSE)
+        near_rows = [(math.hypot(x - meter_x, y - meter_y), assetpos_id, x, y, asset_id, asset_name)
+                     for assetpos_id, x, y, asset_id, asset_name in rows]
+
+    return sequence, near_rows
+
+
+def get_near_assetpositions(request, asset_or_assettype_id, meter_x, meter_y, by_assettype=False, scenario_id=None):
+    """Returns the nearest AssetPositions (at most MAX_ASSETS_PER_RESPONSE) of a given Asset-ID or AssetType-ID (if
+    by_assettype == True) which are closer than the AssetType's display_radius to the given point.
+    If the display_radius is 0, the nearest AssetPositions regardless of their distance are returned.
+    If a scenario_id is given, only AssetPositions within this scenario are returned.
     """
 
     meter_x = float(meter_x)
@@ -189,49 +560,49 @@ def get_near_assetpositions(request, asset_or_assettype_id, meter_x, meter_y, by
 
     if by_assettype:
         # Request by AssetType -> Get all AssetPositions with that AssetType
-        if not AssetType.objects.filter(id=asset_or_assettype_id).exists():
+        radius = AssetType.objects.filter(id=asset_or_assettype_id).values_list("display_radius", flat=True).first()
+
+        if radius is None:
             logger.warn("AssetType with given ID {} does not exist!".format(asset_or_assettype_id))
-            return ret
+            return JsonResponse(ret)
 
-        asset_type = AssetType.objects.get(id=asset_or_assettype_id)
-        objects = AssetPositions.objects.filter(asset_type=asset_type)
+        objects = AssetPositions.objects.filter(asset_type_id=asset_or_assettype_id)
     else:
         # Request by Asset -> Get all AssetPositions of that Asset
-        if not Asset.objects.filter(id=asset_or_assettype_id).exists():
+        radius = Asset.objects.filter(id=asset_or_assettype_id) \
+            .values_list("asset_type__display_radius", flat=True).first()
+
+        if radius is None:
             logger.warn("Asset with given ID {} does not exist!".format(asset_or_assettype_id))
-            return ret
+            return JsonResponse(ret)
 
-        asset = Asset.objects.get(id=asset_or_assettype_id)
-        asset_type = asset.asset_type
-        objects = AssetPositions.objects.filter(asset=asset)
+        objects = AssetPositions.objects.filter(asset_id=asset_or_assettype_id)
 
-    # Create a circle which the visible objects overlap with
-    center = geos.Point(meter_x, meter_y, srid=3857)
-    radius = asset_type.display_radius
+    if scenario_id is not None:
+        objects = objects.filter(tile__scenario_id=scenario_id)
 
-    if radius > 0:
-        # If the radius is > 0, we have to only return the nearby objects; the dwithin query is optimized for this
-        near_assetpositions = objects.filter(location__dwithin=(center, D(m=radius))) \
-            .annotate(distance=Distance("location", center)) \
-            .order_by("distance")
-    else:
-        # If the radius is 0, this means that there is no limit -> Return all
-        near_assetpositions = objects.all()
+    ret["sequence"], near_assetpositions = get_near_assetposition_rows(objects, "near:{}:{}:{}".format(
+        "assettype" if by_assettype else "asset", asset_or_assettype_id, scenario_id), radius, meter_x, meter_y)
 
-    number_of_assets = len(near_assetpositions)
+    ret["assets"] = {assetpos_id: {"position": [x, y],
+                                   "asset_id": asset_id,
+                                   "asset_name": asset_name,
+                                   "distance": str(D(m=distance))}
+                     for distance, assetpos_id, x, y, asset_id, asset_name in near_assetpositions}
 
-    if number_of_assets > MAX_ASSETS_PER_RESPONSE:
-        returned_assetpositions = near_assetpositions[0:MAX_ASSETS_PER_RESPONSE]
-    else:
-        returned_assetpositions = near_assetpositions
+    return JsonResponse(ret)
 
-    ret["assets"] = {assetposition.id: {"position": [assetposition.location.x, assetposition.location.y],
-                                        "asset_id": assetposition.asset_id,
-                                        "asset_name": assetposition.asset.name,
-                                        "distance": str(assetposition.distance)}
-                     for assetposition in returned_assetpositions}
 
-    return JsonResponse(ret)
+def get_tile_area(zoom, meter_x, meter_y):
+    """Returns the (min x, min y, max x, max y) area in meters of the tile at the given zoom level which contains the
+    given point. The area is centered on the upper left corner of the tile, as the clients expect it."""
+
+    point = webmercator.Point(meter_x=float(meter_x), meter_y=float(meter_y), zoom_level=int(zoom))
+    tile_center = webmercator.Point(tile_x=point.tile_x, tile_y=point.tile_y, zoom_level=int(zoom))
+    half_size = tile_center.meters_per_tile / 2
+
+    return (tile_center.meter_x - half_size, tile_center.meter_y - half_size,
+            tile_center.meter_x + half_size, tile_center.meter_y + half_size)
 
 
 # returns all assets of a given type within the extent of the given tile
@@ -239,19 +610,12 @@ def get_near_assetpositions(request, asset_or_assettype_id, meter_x, meter_y, by
 # TODO: add additional properties (eg. overlay information)
 def get_assetpositions(request, zoom, tile_x, tile_y, assettype_id):
     ret = {
-        "assets": {}
+        "assets": {},
+        "sequence": get_change_sequence()
     }
 
     # Construct the polygon which represents this tile, filter assets with that polygon
-    point = webmercator.Point(meter_x=float(tile_x), meter_y=float(tile_y), zoom_level=int(zoom))
-    tile_center = webmercator.Point(tile_x=point.tile_x, tile_y=point.tile_y, zoom_level=int(zoom))
-
-    polygon = Polygon((
-        (tile_center.meter_x + tile_center.meters_per_tile / 2, tile_center.meter_y + tile_center.meters_per_tile / 2),
-        (tile_center.meter_x + tile_center.meters_per_tile / 2, tile_center.meter_y - tile_center.meters_per_tile / 2),
-        (tile_center.meter_x - tile_center.meters_per_tile / 2, tile_center.meter_y - tile_center.meters_per_tile / 2),
-        (tile_center.meter_x - tile_center.meters_per_tile / 2, tile_center.meter_y + tile_center.meters_per_tile / 2),
-        (tile_center.meter_x + tile_center.meters_per_tile / 2, tile_center.meter_y + tile_center.meters_per_tile / 2)))
+    polygon = Polygon.from_bbox(get_tile_area(zoom, tile_x, tile_y))
 
     assets = AssetPositions.objects.filter(asset_type=AssetType.objects.get(id=assettype_id),
                                            location__contained=polygon).all()
@@ -262,6 +626,201 @@ def get_assetpositions(request, zoom, tile_x, tile_y, assettype_id):
     return JsonResponse(ret, safe=False)
 
 
+def get_assetpositions_mvt(request, scenario_id, zoom, tile_x, tile_y):
+    """Returns the AssetPositions of the given scenario within the given tile as Mapbox Vector Tile with the layer
+    'assets', whose point features have the attributes id, asset_id, asset_type_id and orientation"""
+
+    path = vector_tiles.get_cache_path(ASSET_TILES_PATH.format(int(scenario_id)))
+
+    data = vector_tiles.get_vector_tile(path, int(zoom), int(tile_x), int(tile_y), """
+        SELECT ST_AsMVT(features, 'assets', %(extent)s, 'geom') FROM (
+            SELECT p.id, p.asset_id, p.asset_type_id, p.orientation,
+                   ST_AsMVTGeom(p.location, ST_MakeEnvelope(%(min_x)s, %(min_y)s, %(max_x)s, %(max_y)s, 3857),
+                                %(extent)s, 0, true) AS geom
+            FROM {positions} p JOIN {tiles} t ON t.id = p.tile_id
+            WHERE t.scenario_id = %(scenario_id)s AND p.delete_stamp IS NULL
+              AND p.location && ST_MakeEnvelope(%(min_x)s, %(min_y)s, %(max_x)s, %(max_y)s, 3857)
+        ) AS features
+    """.format(positions=AssetPositions._meta.db_table, tiles=Tile._meta.db_table), {"scenario_id": int(scenario_id)})
+
+    return vector_tiles.get_vector_tile_response(request, data)
+
+
+def get_change_sequence():
+    """Returns the change_sequence of the latest committed change of any AssetPosition.
+    Clients pass it to get_assetposition_changes to only receive the changes after the data they already have."""
+
+    return AssetPositions.all_objects.aggregate(sequence=Max("change_sequence"))["sequence"] or 0
+
+
+def get_changes_since(scenario_id, assettype_id, since):
+    """Returns the (id, change_sequence, location, asset_id, orientation, delete_stamp) of all AssetPositions
+    (including the deleted ones) of the given type in the given scenario which changed after the given sequence"""
+
+    return AssetPositions.all_objects.filter(asset_type_id=assettype_id, tile__scenario_id=scenario_id,
+                                             change_sequence__gt=since) \
+        .order_by("change_sequence") \
+        .values_list("id", "change_sequence", "location", "asset_id", "orientation", "delete_stamp")
+
+
+def get_assetposition_changes(scenario_id, assettype_id, since, is_visible):
+    """Returns a JsonResponse with the changes of the AssetPositions of the given type in the given scenario after the
+    given change sequence:
+    'assets': the created or moved positions for which is_visible(x, y) is True, by ID
+    'removed': the IDs of the deleted positions, and of the moved positions for which is_visible(x, y) is False
+    'sequence': the change sequence which has to be passed to the next request
+    'complete': False if there are more than MAX_CHANGES_PER_RESPONSE changes, so the client has to poll again"""
+
+    changes = get_changes_since(scenario_id, assettype_id, since)[:MAX_CHANGES_PER_RESPONSE]
+
+    ret = {
+        "assets": {},
+        "removed": [],
+        "sequence": int(since),
+        "complete": True
+    }
+
+    number_of_changes = 0
+
+    for assetpos_id, change_sequence, location, asset_id, orientation, delete_stamp in changes:
+        number_of_changes += 1
+        ret["sequence"] = change_sequence
+
+        # positions which are moved out of the requested area are removed for the client as well
+        if delete_stamp is None and is_visible(location.x, location.y):
+            ret["assets"][assetpos_id] = {"position": [location.x, location.y],
+                                          "asset_id": asset_id,
+                                          "orientation": orientation}
+        else:
+            ret["removed"].append(assetpos_id)
+
+    ret["complete"] = number_of_changes < MAX_CHANGES_PER_RESPONSE
+
+    return JsonResponse(ret)
+
+
+def get_assetposition_changes_for_tile(request, scenario_id, assettype_id, since, zoom, tile_x, tile_y):
+    """Returns the changes of the AssetPositions within the given tile (see get_assetpositions) after the given
+    change sequence (see get_assetposition_changes)"""
+
+    min_x, min_y, max_x, max_y = get_tile_area(zoom, tile_x, tile_y)
+
+    return get_assetposition_changes(scenario_id, assettype_id, since,
+                                     lambda x, y: min_x <= x <= max_x and min_y <= y <= max_y)
+
+
+def get_assetposition_changes_near(request, scenario_id, assettype_id, since, meter_x, meter_y):
+    """Returns the changes of the AssetPositions within the AssetType's display_radius around the given point (see
+    get_near_assetpositions) after the given change sequence (see get_assetposition_changes)"""
+
+    meter_x = float(meter_x)
+    meter_y = float(meter_y)
+
+    radius = AssetType.objects.filter(id=assettype_id).values_list("display_radius", flat=True).first()
+
+    if radius is None:
+        logger.warn("AssetType with given ID {} does not exist!".format(assettype_id))
+        return JsonResponse({})
+
+    return get_assetposition_changes(scenario_id, assettype_id, since,
+                                     lambda x, y: radius == 0 or math.hypot(x - meter_x, y - meter_y) <= radius)
+
+
+def format_change_event(event, sequence, data):
+    """Returns a server-sent event with the given name, change sequence (as event id) and JSON data"""
+
+    return "id: {}\nevent: {}\ndata: {}\n\n".format(sequence, event, json.dumps(data))
+
+
+def generate_change_events(scenario_id, assettype_id, since, is_visible):
+    """Yields server-sent events for all changes of the AssetPositions of the given type in the given scenario after
+    the given sequence (or from now on, if it is None) - first the ones which are already committed, then the ones
+    announced on the CHANGE_CHANNEL (see assetpos.models.notify_changes):
+    'change': a position for which is_visible(x, y) is True has been created or moved, with id, position, asset_id and
+    orientation
+    'removed': a position has been deleted or moved to where is_visible(x, y) is False, with id"""
+
+    # Listening blocks the connection, so a separate one is used for each stream
+    listener = psycopg2.connect(**connection.get_connection_params())
+
+    try:
+        listener.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+
+        with listener.cursor() as cursor:
+            cursor.execute("LISTEN {}".format(CHANGE_CHANNEL))
+
+        # The missed changes are only read now that we listen, so that none of them is lost in between
+        if since is None:
+            since = get_change_sequence()
+        else:
+            for assetpos_id, change_sequence, location, asset_id, orientation, delete_stamp \
+                    in get_changes_since(scenario_id, assettype_id, since).iterator():
+                since = change_sequence
+
+                if delete_stamp is None and is_visible(location.x, location.y):
+                    yield format_change_event("change", change_sequence, {
+                        "id": assetpos_id, "position": [location.x, location.y], "asset_id": asset_id,
+                        "orientation": orientation})
+                else:
+                    yield format_change_event("removed", change_sequence, {"id": assetpos_id})
+
+        while True:
+            if select.select([listener], [], [], STREAM_KEEPALIVE_SECONDS) == ([], [], []):
+                # comments keep proxies from closing the connection, and detect clients which are gone
+                yield ": keepalive\n\n"
+                continue
+
+            listener.poll()
+
+            while listener.notifies:
+                change = json.loads(listener.notifies.pop(0).payload)
+
+                if change["sequence"] <= since or change["scenario"] != scenario_id \
+                        or change["assettype"] != assettype_id:
+                    continue
+
+                since = change["sequence"]
+
+                if not change["deleted"] and is_visible(*change["position"]):
+                    yield format_change_event("change", since, {
+                        "id": change["id"], "position": change["position"], "asset_id": change["asset"],
+                        "orientation": change["orientation"]})
+
+                # only clients which have seen the position before are told about its removal
+                elif is_visible(*change["previous"]) or is_visible(*change["position"]):
+                    yield format_change_event("removed", since, {"id": change["id"]})
+    finally:
+        listener.close()
+
+
+def stream_assetposition_changes(request, scenario_id, assettype_id, zoom=None, tile_x=None, tile_y=None):
+    """Streams the changes of the AssetPositions of the given type in the given scenario (and within the given tile,
+    if any - see get_assetpositions) as server-sent events (see generate_change_events).
+
+    The stream starts after the change sequence in the Last-Event-ID header (sent by EventSource when reconnecting)
+    or in the 'since' parameter - e.g. the one returned by get_assetpositions - or else now.
+    Every open stream occupies a worker thread of the server."""
+
+    since = request.META.get("HTTP_LAST_EVENT_ID") or request.GET.get("since")
+
+    if zoom is None:
+        def is_visible(x, y):
+            return True
+    else:
+        min_x, min_y, max_x, max_y = get_tile_area(zoom, tile_x, tile_y)
+
+        def is_visible(x, y):
+            return min_x <= x <= max_x and min_y <= y <= max_y
+
+    response = StreamingHttpResponse(generate_change_events(int(scenario_id), int(assettype_id),
+                                                            int(since) if since else None, is_visible),
+                                     content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+
+    return response
+
+
 # gets the attributes and values of the requested asset_id
 def get_attributes(request, asset_id):
     ret = {}
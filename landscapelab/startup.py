@@ -1,5 +1,6 @@
 import signal
 import os
+import threading
 from landscapelab import utils
 
 
@@ -10,3 +11,16 @@ def startup(wsgi=False):
     utils.reload_logging(None)
     if not os.name == 'nt' and not wsgi:
         signal.signal(signal.SIGHUP, utils.reload_logging)
+
+
+# builds the in-memory tile indices of the raster pyramids in the background
+# this has to be called after the django stack has been set up
+def build_tile_indices():
+    from raster import tile_index, tiles, views
+
+    def build():
+        for path, do_epx_scale, file_ending in views.PYRAMIDS.values():
+            tile_index.get_tile_index(path, file_ending)
+
+    if tiles.USE_TILE_INDEX:
+        threading.Thread(target=build, daemon=True).start()
@@ -0,0 +1,167 @@
+import hashlib
+import logging
+import os
+import uuid
+
+import webmercator
+from django.db import connection
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response
+
+from landscapelab import utils
+from raster import tile_storage
+
+# the local path of the vector tile caches (within the static files, like the raster pyramids)
+VECTOR_TILES_BASE = "vector"
+
+# the file ending of the cached Mapbox Vector Tiles
+MVT_FILE_ENDING = "mvt"
+MVT_CONTENT_TYPE = "application/vnd.mapbox-vector-tile"
+
+# the size of the coordinate space of a vector tile
+MVT_EXTENT = 4096
+
+# tiles up to this zoom level are cached on disk, deeper ones only cover few features and are generated every time
+MAX_CACHED_ZOOM = 16
+
+# the margin (in meters) by which the extent of a changed feature is grown when invalidating the tiles containing it,
+# so that the tiles which only touch it are invalidated as well
+INVALIDATION_MARGIN = 0.01
+
+# every invalidation of a vector tile cache writes a new generation into the file with the path of the cache and this
+# ending, so that tiles which have been generated from outdated data in the meantime are not kept (see get_vector_tile)
+GENERATION_ENDING = ".generation"
+
+logger = logging.getLogger(__name__)
+
+
+def get_cache_path(local_path: str):
+    """Returns the full path of the vector tile cache with the given local path"""
+
+    return utils.get_full_texture_path(utils.join_path(VECTOR_TILES_BASE, local_path))
+
+
+def get_generation(path: str):
+    """Returns the current generation of the vector tile cache at the given path (empty if it was never used)"""
+
+    try:
+        with open(path + GENERATION_ENDING) as generation_file:
+            return generation_file.read()
+    except FileNotFoundError:
+        return ""
+
+
+def next_generation(path: str):
+    """Replaces the generation of the vector tile cache at the given path by a new one (atomically, like tiles are
+    written - see tile_storage.DirectoryStorage.write), which is seen by all server processes"""
+
+    filename = path + GENERATION_ENDING
+    temporary_filename = "{}.{}.tmp".format(filename, uuid.uuid4().hex)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+
+    with open(temporary_filename, "w") as generation_file:
+        generation_file.write(uuid.uuid4().hex)
+
+    os.replace(temporary_filename, filename)
+
+
+def get_tile_bounds(zoom: int, tile_x: int, tile_y: int):
+    """Returns the (min x, min y, max x, max y) WebMercator extent of the given tile"""
+
+    # the meter coordinates of a tile are its upper left corner
+    corner = webmercator.Point(tile_x=tile_x, tile_y=tile_y, zoom_level=zoom)
+
+    return corner.meter_x, corner.meter_y - corner.meters_per_tile, corner.meter_x + corner.meters_per_tile, \
+        corner.meter_y
+
+
+def get_vector_tile(path: str, zoom: int, tile_x: int, tile_y: int, query: str, params: dict):
+    """Returns the Mapbox Vector Tile generated by the given query (which returns the result of ST_AsMVT), cached in
+    the given path if the zoom level is at most MAX_CACHED_ZOOM.
+
+    The query gets the extent of the tile as the parameters min_x, min_y, max_x and max_y (in EPSG:3857) and the size
+    of the tile coordinate space as extent, in addition to the given ones.
+
+    If the cache is invalidated while the tile is generated, the tile might contain outdated data and is not kept."""
+
+    storage = tile_storage.get_storage(path, MVT_FILE_ENDING)
+
+    if zoom <= MAX_CACHED_ZOOM:
+        data = storage.read(zoom, tile_x, tile_y)
+        if data is not None:
+            return data
+
+        # the generation has to be read before the query, so that any change which the query doesn't see yet is
+        # invalidated afterwards - it is created with the first tile, so that invalidate_tiles can skip unused caches
+        generation = get_generation(path)
+        if not generation:
+            try:
+                next_generation(path)
+                generation = get_generation(path)
+            except OSError as error:
+                logger.warning("Could not create the generation of the vector tile cache {}: {}".format(path, error))
+
+    min_x, min_y, max_x, max_y = get_tile_bounds(zoom, tile_x, tile_y)
+
+    with connection.cursor() as cursor:
+        cursor.execute(query, dict(params, min_x=min_x, min_y=min_y, max_x=max_x, max_y=max_y, extent=MVT_EXTENT))
+        data = bytes(cursor.fetchone()[0] or b"")
+
+    # empty tiles are not cached, since they can't be told apart from missing ones (they are cheap to generate anyway)
+    if data and zoom <= MAX_CACHED_ZOOM:
+        try:
+            storage.write(zoom, tile_x, tile_y, data)
+
+            # the invalidation might have removed the tile before it was written
+            if get_generation(path) != generation:
+                storage.delete(zoom, tile_x, tile_y)
+        except OSError as error:
+            logger.warning("Could not cache vector tile {}/{}/{} in {}: {}".format(zoom, tile_x, tile_y, path, error))
+
+    return data
+
+
+def invalidate_tiles(path: str, min_x: float, min_y: float, max_x: float, max_y: float, buffer: int = 0):
+    """Removes all cached tiles in the given path which intersect with the given WebMercator extent.
+    The buffer (in tile coordinates, see ST_AsMVTGeom) with which the features have been clipped is taken into account,
+    since features are included in the neighbouring tiles up to that distance."""
+
+    # no tile has been cached (or started to be generated) yet if there is no generation (see get_vector_tile)
+    if not get_generation(path):
+        return
+
+    storage = tile_storage.get_storage(path, MVT_FILE_ENDING)
+
+    try:
+        # tiles which are being generated right now are removed by their writer (see get_vector_tile)
+        next_generation(path)
+
+        for zoom in range(MAX_CACHED_ZOOM + 1):
+            tile_size = webmercator.Point(tile_x=0, tile_y=0, zoom_level=zoom).meters_per_tile
+            margin = INVALIDATION_MARGIN + tile_size * buffer / MVT_EXTENT
+
+            # the y tile coordinate grows southwards, so the upper left corner has the smallest tile coordinates
+            p_from = webmercator.Point(meter_x=min_x - margin, meter_y=max_y + margin, zoom_level=zoom)
+            p_to = webmercator.Point(meter_x=max_x + margin, meter_y=min_y - margin, zoom_level=zoom)
+
+            for tile_x in range(p_from.tile_x, p_to.tile_x + 1):
+                for tile_y in range(p_from.tile_y, p_to.tile_y + 1):
+                    storage.delete(zoom, tile_x, tile_y)
+    except OSError as error:
+        # this runs after the commit of the change, so the change itself must not fail
+        logger.error("Could not invalidate the vector tile cache {}: {}".format(path, error))
+
+
+def get_vector_tile_response(request, data: bytes):
+    """Returns the response with the given vector tile - clients have to revalidate it, since it changes with edits"""
+
+    etag = '"{}"'.format(hashlib.sha1(data).hexdigest())
+
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = HttpResponse(data, content_type=MVT_CONTENT_TYPE)
+
+    response["ETag"] = etag
+    response["Cache-Control"] = "no-cache"
+
+    return response
@@ -16,3 +16,6 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "landscapelab.settings")
 startup.startup(wsgi=True)
 
 application = get_wsgi_application()
+
+# scan the tile pyramids before the first requests arrive
+startup.build_tile_indices()
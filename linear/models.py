@@ -1,6 +1,17 @@
 from django.contrib.gis.db import models
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from landscapelab import vector_tiles
 from raster.models import Tile
 
+# the local path of the vector tile cache of the line segments (see landscapelab.vector_tiles)
+LINE_TILES_PATH = "linear"
+
+# the distance (in tile coordinates) up to which lines are included in the vector tiles beyond their borders
+LINE_TILES_BUFFER = 256
+
 
 # TODO: Some fields here overlap with assetpos. When we unify dynamic and static assets,
 #  we can probably also have a common superclass for lines and assets!
@@ -39,3 +50,34 @@ class LineSegment(models.Model):
 
     # Optional width if it deviates from the LineType default
     width = models.FloatField(null=True)
+
+    # the line when this segment was loaded from the database (see invalidate_line_tiles)
+    _loaded_line = None
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_line = instance.__dict__.get("line")
+
+        return instance
+
+
+# the cached vector tiles of changed line segments are invalidated - this also covers fixtures, which don't call save()
+@receiver(post_save, sender=LineSegment)
+@receiver(post_delete, sender=LineSegment)
+def invalidate_line_tiles(sender, instance, using, **kwargs):
+    path = vector_tiles.get_cache_path(LINE_TILES_PATH)
+    extents = [line.transform(3857, clone=True).extent for line in (instance.line, instance._loaded_line)
+               if line is not None]
+
+    # tiles which are generated before the commit would still contain the old line
+    transaction.on_commit(lambda: invalidate_extents(path, extents), using=using)
+
+    instance._loaded_line = instance.line
+
+
+def invalidate_extents(path, extents):
+    """Removes the cached line tiles which intersect with any of the given WebMercator extents"""
+
+    for min_x, min_y, max_x, max_y in extents:
+        vector_tiles.invalidate_tiles(path, min_x, min_y, max_x, max_y, LINE_TILES_BUFFER)
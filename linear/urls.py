@@ -8,6 +8,9 @@ urlpatterns = [
         views.get_lines_near_position, name="get_lines_near_position"),
 
     url(r'^tile/(?P<line_type_id>(\d+))/(?P<tile_x>(\d+(?:\.\d+)))/(?P<tile_y>(\d+(?:\.\d+)))/(?P<zoom>(\d+)).json$',
-        views.get_lines_for_tile, name="get_lines_for_tile")
+        views.get_lines_for_tile, name="get_lines_for_tile"),
+
+    url(r'^mvt/(?P<zoom>(\d+))/(?P<tile_x>(\d+))/(?P<tile_y>(\d+)).mvt$',
+        views.get_lines_mvt, name="get_lines_mvt")
 
 ]
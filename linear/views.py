@@ -3,7 +3,8 @@ from django.contrib.gis import geos
 from django.contrib.gis.geos import Polygon
 from django.http import JsonResponse
 
-from linear.models import LineType, LineSegment
+from landscapelab import vector_tiles
+from linear.models import LineType, LineSegment, LINE_TILES_PATH, LINE_TILES_BUFFER
 import logging
 
 
@@ -87,3 +88,25 @@ def get_lines_near_position(request, position_x, position_y, line_type_id):
 
     return JsonResponse(ret)
 
+
+def get_lines_mvt(request, zoom, tile_x, tile_y):
+    """Returns the line segments within the given tile as Mapbox Vector Tile with the layer 'lines', whose line
+    features have the attributes id, type (the id of the LineType) and width (the LineType's width if the segment has
+    none)"""
+
+    data = vector_tiles.get_vector_tile(vector_tiles.get_cache_path(LINE_TILES_PATH), int(zoom), int(tile_x),
+                                        int(tile_y), """
+        SELECT ST_AsMVT(features, 'lines', %(extent)s, 'geom') FROM (
+            SELECT s.id, s.type_id AS type, COALESCE(s.width, lt.width) AS width,
+                   ST_AsMVTGeom(ST_Transform(s.line, 3857),
+                                ST_MakeEnvelope(%(min_x)s, %(min_y)s, %(max_x)s, %(max_y)s, 3857),
+                                %(extent)s, %(buffer)s, true) AS geom
+            FROM {segments} s JOIN {linetypes} lt ON lt.id = s.type_id
+            WHERE s.line && ST_Transform(ST_MakeEnvelope(%(min_x)s, %(min_y)s, %(max_x)s, %(max_y)s, 3857),
+                                         ST_SRID(s.line))
+        ) AS features
+        WHERE geom IS NOT NULL
+    """.format(segments=LineSegment._meta.db_table, linetypes=LineType._meta.db_table),
+        {"buffer": LINE_TILES_BUFFER})
+
+    return vector_tiles.get_vector_tile_response(request, data)
@@ -1,89 +1,213 @@
-from itertools import islice
-
+import io
+import json
 import os
+import time
+
 import png
 import webmercator
 import numpy as np
 from django.conf import settings
-from django.contrib.gis.geos import Polygon, Point
+from django.contrib.gis.geos import Polygon
 import rasterio  # TODO: decide if we want to read raster or polygon data
+import rasterio.features
+import rasterio.fill
+import rasterio.transform
+import rasterio.warp
+from rasterio.crs import CRS
+from rasterio.enums import Resampling
+from rasterio.windows import Window
 from django.contrib.gis.utils import LayerMapping
-from django.db.models import Avg
+from django.db import connection, transaction
 
 from raster.models import DigitalHeightModel, Tile
-from landscapelab import utils
 import logging
 
+try:
+    import resource
+except ImportError:
+    # the resource module is only available on unix - elsewhere, the peak memory usage is not logged
+    resource = None
+
 
 DEFAULT_DHM_FILE = settings.STATICFILES_DIRS[0] + "/raster/dhm_lamb_10m.tif"
 DHM_SPLAT_FILE = settings.STATICFILES_DIRS[0] + "/raster/{}/{}/{}/{}.png"
 DHM_SPLAT_IDENTIFIER = "dhm_splat"
 DEFAULT_DHM_SRID = 3857  # WebMercator Aux Sphere
+TILE_SRID = 3857  # the tile pyramids are always in WebMercator
 TILE_SIZE_PIXEL = 256
-BATCH_SIZE = 50000
+
+# the size (in cells) of the square blocks in which rasters are read and imported
+IMPORT_BLOCK_SIZE = 256
+
+# the structure of a point in the binary postgres COPY format (numbers are big endian, except within the EWKB)
+COPY_HEADER = b"PGCOPY\n\xff\r\n\0" + bytes(8)
+COPY_TRAILER = b"\xff\xff"
+DHM_COPY_ROW = np.dtype([('field_count', '>i2'),
+                         ('point_length', '>i4'), ('byte_order', 'u1'), ('geometry_type', '<u4'), ('srid', '<u4'),
+                         ('x', '<f8'), ('y', '<f8'),
+                         ('height_length', '>i4'), ('height', '>f8'),
+                         ('resolution_length', '>i4'), ('resolution', '>f8')])
 
 logger = logging.getLogger(__name__)
 
 
-# imports the dhm into the postgis database
-# FIXME: dummy -> we have to figure out input variables
+# imports the dhm into the postgis database and returns the number of imported points
+# raster files are streamed block by block straight into the database, see import_dhm_raster
 def import_dhm(dhm_filename: str, bounding_box: Polygon, srid=DEFAULT_DHM_SRID):
 
-    # delete all old data within the bounding box
+    start_time = time.time()
+    count = None
+
+    with transaction.atomic():
+
+        # delete all old data within the bounding box
+        if bounding_box:
+            logger.debug("delete all data from database within geometry {}".format(bounding_box))
+            DigitalHeightModel.objects.filter(point__within=bounding_box).delete()
+
+        # getting the type of dhm and check if we import a vector (*.shp) or raster file (anything else)
+        if dhm_filename.lower().endswith(".shp"):
+
+            # vector implementation
+            logger.debug("staring vector import")
+            mapping = {'height': 'float',
+                       'point': 'POINT', }
+            lm = LayerMapping(DigitalHeightModel, dhm_filename, mapping)
+            lm.save(verbose=True)  # save the data to the database
+
+        # raster implementation
+        else:
+            count = import_dhm_raster(dhm_filename, bounding_box, srid)
+
+            duration = time.time() - start_time
+            logger.info("imported {} points in {:.1f}s ({:.0f} points/s){}".format(
+                count, duration, count / duration if duration > 0 else 0,
+                ", peak memory usage: {:.0f} MB".format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+                if resource else ""))
+
+    return count
+
+
+# imports the cells of the given raster (within the bounding box, if given) as points
+# the raster is read in blocks of IMPORT_BLOCK_SIZE x IMPORT_BLOCK_SIZE cells, which are streamed into a single COPY,
+# so only one block is held in memory at a time - regardless of the width of the raster
+# srid is used if the raster itself doesn't define its reference system
+def import_dhm_raster(dhm_filename: str, bounding_box: Polygon, srid=DEFAULT_DHM_SRID):
+
+    with rasterio.open(dhm_filename) as dhm_datasource:
+        raster_crs = dhm_datasource.crs or CRS.from_epsg(srid)
+        resolution = abs(dhm_datasource.transform.a)
+
+        # only read the part of the raster which covers the bounding box
+        row_from, row_to, col_from, col_to = 0, dhm_datasource.height, 0, dhm_datasource.width
+        if bounding_box:
+            # reference systems without an EPSG code are passed as WKT
+            raster_srid = raster_crs.to_epsg()
+            if bounding_box.srid and bounding_box.srid != raster_srid:
+                bounding_box = bounding_box.transform(raster_srid or raster_crs.to_wkt(), clone=True)
+
+            min_x, min_y, max_x, max_y = bounding_box.extent
+            rows, cols = rasterio.transform.rowcol(dhm_datasource.transform, [min_x, min_x, max_x, max_x],
+                                                   [min_y, max_y, min_y, max_y])
+            row_from, row_to = max(min(rows), 0), min(max(rows) + 1, dhm_datasource.height)
+            col_from, col_to = max(min(cols), 0), min(max(cols) + 1, dhm_datasource.width)
+
+        logger.debug("starting raster import with up to {} points".format(
+            max(row_to - row_from, 0) * max(col_to - col_from, 0)))
+
+        windows = [Window(col, row, min(IMPORT_BLOCK_SIZE, col_to - col), min(IMPORT_BLOCK_SIZE, row_to - row))
+                   for row in range(row_from, row_to, IMPORT_BLOCK_SIZE)
+                   for col in range(col_from, col_to, IMPORT_BLOCK_SIZE)]
+        count = 0
+
+        # the COPY data is produced block by block while the database reads it
+        def get_copy_data():
+            nonlocal count
+
+            yield COPY_HEADER
+
+            for number, window in enumerate(windows):
+                rows_data = get_dhm_window_rows(dhm_datasource, window, bounding_box, raster_crs, resolution)
+                count += len(rows_data)
+
+                logger.debug("read {} entries ({:.1f} %)".format(count, (number + 1) * 100 / len(windows)))
+                yield rows_data.tobytes()
+
+            yield COPY_TRAILER
+
+        with connection.cursor() as cursor:
+            cursor.copy_expert("COPY {} (point, height, resolution) FROM STDIN WITH (FORMAT binary)".format(
+                connection.ops.quote_name(DigitalHeightModel._meta.db_table)), ChunkReader(get_copy_data()))
+
+    return count
+
+
+# returns the valid cells of the given raster window as rows in the binary COPY format (see DHM_COPY_ROW)
+def get_dhm_window_rows(dhm_datasource, window: Window, bounding_box: Polygon, raster_crs: CRS, resolution: float):
+
+    heights = dhm_datasource.read(1, window=window, masked=True)  # we assume there is a single height band
+    window_transform = dhm_datasource.window_transform(window)
+
+    # the coordinates of the centers of all cells in the window
+    rows, cols = np.indices(heights.shape)
+    xs, ys = window_transform * (cols + 0.5, rows + 0.5)
+
+    # only import cells with data within the bounding polygon
+    valid = ~np.ma.getmaskarray(heights)
     if bounding_box:
-        logger.debug("delete all data from database within geometry {}".format(bounding_box))
-        DigitalHeightModel.objects.filter(point__within=bounding_box).delete()
+        valid &= rasterio.features.geometry_mask([json.loads(bounding_box.json)], heights.shape, window_transform,
+                                                 invert=True)
 
-    # getting the type of dhm and check if we import a vector (*.shp) or raster file (anything else)
-    if dhm_filename.lower().endswith(".shp"):
+    xs, ys, heights = xs[valid], ys[valid], heights.data[valid]
 
-        # vector implementation
-        logger.debug("staring vector import")
-        mapping = {'height': 'float',
-                   'point': 'POINT', }
-        lm = LayerMapping(DigitalHeightModel, dhm_filename, mapping)
-        lm.save(verbose=True)  # save the data to the database
+    if len(heights) > 0 and raster_crs != CRS.from_epsg(settings.DEFAULT_SRID):
+        xs, ys = rasterio.warp.transform(raster_crs, CRS.from_epsg(settings.DEFAULT_SRID), xs, ys)
 
-    # raster implementation
-    else:
-        with rasterio.open(dhm_filename) as dhm_datasource:
-            crs = dhm_datasource.crs
-            np_heightmap = dhm_datasource.read(1)  # we assume there is a single height band
-            rows, cols = np_heightmap.shape
-            logger.debug("starting raster import with {} points".format(rows * cols))
-
-            # add all valid points to a list
-            dhm_list = []
-            for x in range(0, rows):
-                for y in range(0, cols):
-                    x_m, y_m = dhm_datasource.affine * (x, y)
-                    point = Point(x_m, y_m, srid=crs)  # convert x,y to meters in crs
-
-                    # only import points within the bounding polygon
-                    if bounding_box:
-                        if not bounding_box.contains(point):
-                            continue
-                    dhm_point = DigitalHeightModel()
-                    dhm_point.point = point
-                    dhm_point.height = np_heightmap[x, y]
-                    dhm_list.append(dhm_point)
-
-            # bulk insert the batch into the database
-            count = 0
-            while True:
-                batch = list(islice(dhm_list, BATCH_SIZE))
-                if not batch:
-                    break
-                DigitalHeightModel.objects.bulk_create(batch, BATCH_SIZE)
-                count += BATCH_SIZE
-                logger.debug("inserted {} from {} entries ({} %)".format(count, len(dhm_list),
-                                                                         count * 100 / len(dhm_list)))
+    # the rows are passed in the binary COPY format, which can be built for all of them at once
+    # the points are encoded as EWKB, which postgis accepts as binary representation of a geometry
+    rows_data = np.empty(len(heights), dtype=DHM_COPY_ROW)
+    rows_data['field_count'] = 3
+    rows_data['point_length'] = 25  # byte order, type, srid, x and y
+    rows_data['byte_order'] = 1  # little endian
+    rows_data['geometry_type'] = 0x20000001  # point with srid
+    rows_data['srid'] = settings.DEFAULT_SRID
+    rows_data['x'], rows_data['y'] = xs, ys
+    rows_data['height_length'] = rows_data['resolution_length'] = 8
+    rows_data['height'] = heights
+    rows_data['resolution'] = resolution
+
+    return rows_data
+
+
+class ChunkReader(io.RawIOBase):
+    """A readable file over the byte strings produced by the given iterator, which are only produced when they are
+    read - this way, COPY data can be streamed to the database (see cursor.copy_expert) without building it first"""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.chunk = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.chunk:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return 0
+            self.chunk = memoryview(chunk)
+
+        size = min(len(buffer), len(self.chunk))
+        buffer[:size] = self.chunk[:size]
+        self.chunk = self.chunk[size:]
+
+        return size
 
 
 # TODO: maybe move this to another file?
 # gets the tile if it exists or initializes the requested tile
 def get_or_initialize_tile(x: int, y: int, zoom: int):
-    tile = Tile.objects.filter(x=x, y=y, lod=zoom)
+    tile = Tile.objects.filter(x=x, y=y, lod=zoom).first()
     if not tile:
         tile = Tile()
         tile.x = x
@@ -93,41 +217,65 @@ def get_or_initialize_tile(x: int, y: int, zoom: int):
     return tile
 
 
-# generates the database (cache) entry for the dhm
-def generate_dhm_db(x: int, y: int, zoom: int):
+# returns the heights (in meters) of the pixels of the given tile as TILE_SIZE_PIXEL x TILE_SIZE_PIXEL float array
+# (rows from north to south, columns from west to east), or None if the dhm doesn't cover the tile at all
+def read_heightmap(x: int, y: int, zoom: int, dhm_filename=DEFAULT_DHM_FILE):
 
-    # create the empty dhm array for this tile with an unsigned integer with 20 bit precision
-    np_heightmap = np.zeros((TILE_SIZE_PIXEL, TILE_SIZE_PIXEL), dtype=np.uint32)
+    with rasterio.open(dhm_filename) as dhm_datasource:
+        return read_heightmap_from(dhm_datasource, x, y, zoom)
 
-    # iterate to all pixels of the image in terms of projected coordinates
+
+# like read_heightmap, but from an already opened dhm raster
+# the heights are read directly from the dhm raster: gdal only reads the part of it which covers the tile and
+# resamples (and reprojects, if necessary) it to the tile pixels - pixels without data are interpolated
+def read_heightmap_from(dhm_datasource, x: int, y: int, zoom: int):
+
+    # the upper left corner of the tile
     point = webmercator.Point(tile_x=x, tile_y=y, zoom_level=zoom)
-    meters_x_steps = np.arange(point.meter_x, point.meters_per_tile + point.meter_x, point.meters_per_pixel)
-    meters_y_steps = np.arange(point.meter_y, point.meters_per_tile + point.meter_y, point.meters_per_pixel)
-    pixel_x, pixel_y = -1, -1
-    for m_x_from, m_x_to in utils.lookahead(meters_x_steps):
-        pixel_x += 1
-        for m_y_from, m_y_to in utils.lookahead(meters_y_steps):
-            pixel_y += 1
-
-            # don't calculate if we are beyond the last pixel
-            if m_x_to is None or m_y_to is None:
-                continue
-
-            # get the available height information of the requested pixel
-            bbox = Polygon.from_bbox((m_x_from, m_y_from, m_x_to, m_y_to))
-            dhm_points = DigitalHeightModel.objects.filter(poly__contained=bbox)
-
-            # if there are registered heights we have to calculate the average
-            if dhm_points:
-                np_heightmap[pixel_x, pixel_y] = dhm_points.aggregate(Avg('height'))
-            # FIXME: we have to somehow estimate from the surounding values
-            else:
-                pass
+    tile_transform = rasterio.transform.from_bounds(point.meter_x, point.meter_y - point.meters_per_tile,
+                                                    point.meter_x + point.meters_per_tile, point.meter_y,
+                                                    TILE_SIZE_PIXEL, TILE_SIZE_PIXEL)
+
+    np_heightmap = np.full((TILE_SIZE_PIXEL, TILE_SIZE_PIXEL), np.nan, dtype=np.float32)
+
+    source_crs = dhm_datasource.crs or CRS.from_epsg(DEFAULT_DHM_SRID)
+
+    # average all dhm cells within a pixel if they are smaller than it, interpolate between them otherwise
+    source_resolution = abs(dhm_datasource.transform.a)
+    if source_crs.is_projected and source_resolution < point.meters_per_pixel:
+        resampling = Resampling.average
+    else:
+        resampling = Resampling.bilinear
+
+    rasterio.warp.reproject(rasterio.band(dhm_datasource, 1), np_heightmap,
+                            src_crs=source_crs, src_nodata=dhm_datasource.nodata,
+                            dst_transform=tile_transform, dst_crs=CRS.from_epsg(TILE_SRID),
+                            dst_nodata=np.nan, resampling=resampling)
+
+    valid = ~np.isnan(np_heightmap)
+
+    if not valid.any():
+        logger.debug("the dhm {} doesn't cover tile {}/{}/{}".format(dhm_datasource.name, zoom, x, y))
+        return None
+
+    # fill gaps (e.g. at the border of the dhm) by interpolating from the surrounding values
+    if not valid.all():
+        np_heightmap = rasterio.fill.fillnodata(np_heightmap, mask=valid.astype(np.uint8),
+                                                max_search_distance=TILE_SIZE_PIXEL * 2)
+
+    return np_heightmap
+
+
+# generates the database (cache) entry for the dhm
+def generate_dhm_db(x: int, y: int, zoom: int, dhm_filename=DEFAULT_DHM_FILE):
+
+    np_heightmap = read_heightmap(x, y, zoom, dhm_filename)
 
     # store the result as cache of the tile in the database
-    tile = get_or_initialize_tile(x, y, zoom)
-    tile.heightmap = np_heightmap
-    tile.save()
+    if np_heightmap is not None:
+        tile = get_or_initialize_tile(x, y, zoom)
+        tile.heightmap = np_heightmap
+        tile.save()
 
     return np_heightmap
 
@@ -141,7 +289,7 @@ def generate_dhm_splat_tile(x: int, y: int, zoom: int):
 
     # load or generate dhm information
     np_dhm = tile.heightmap
-    if not np_dhm:
+    if np_dhm is None:
         # generate tile in db
         np_dhm = generate_dhm_db(x, y, zoom)
 
@@ -0,0 +1,93 @@
+import logging
+import threading
+from io import BytesIO
+
+import numpy as np
+import rasterio
+import rasterio.warp
+import webmercator
+from PIL import Image
+from rasterio.crs import CRS
+
+from raster import tile_storage
+from raster.calculate_dhm import read_heightmap_from, TILE_SRID, DEFAULT_DHM_SRID
+
+# heights are encoded as integer number of 1/HEIGHT_SCALE meters, split into the bytes of the 3 RGB channels:
+# height = (R * 2^16 + G * 2^8 + B) / HEIGHT_SCALE
+HEIGHT_SCALE = 100
+
+# the opened dhm rasters of the current thread, by filename (rasterio datasets must not be shared between threads)
+datasets = threading.local()
+
+logger = logging.getLogger(__name__)
+
+
+def encode_heights(heights: np.ndarray):
+    """Returns the given heights in meters as (3, rows, columns) uint8 array of R, G and B.
+    Negative heights (e.g. nodata encoded as -9999) and NaN are encoded as 0."""
+
+    # Convert negative pixels to 0, since e.g. nodata may be encoded as -9999
+    scaled = np.nan_to_num(heights, nan=0.0) * HEIGHT_SCALE
+    scaled[scaled < 0] = 0
+
+    # The highest byte is discarded because heightmaps will never have such big heights (over 167772 meters? nope)
+    values = scaled.astype(np.uint32)
+
+    return np.stack(((values >> 16) & 0xFF, (values >> 8) & 0xFF, values & 0xFF)).astype(np.uint8)
+
+
+def decode_heights(rgb: np.ndarray):
+    """Returns the heights in meters of the given (3, rows, columns) R, G and B array (see encode_heights)"""
+
+    rgb = rgb.astype(np.uint32)
+
+    return (rgb[0] << 16 | rgb[1] << 8 | rgb[2]) / HEIGHT_SCALE
+
+
+def get_dataset(filename: str):
+    """Returns the given raster, opened once per thread"""
+
+    if not hasattr(datasets, "opened"):
+        datasets.opened = {}
+
+    if filename not in datasets.opened:
+        datasets.opened[filename] = rasterio.open(filename)
+
+    return datasets.opened[filename]
+
+
+def get_tile_range(filename: str, zoom: int):
+    """Returns the minimum and maximum tile x and y coordinates covering the given raster at the given zoom level"""
+
+    # not opened with get_dataset, since this is usually called before worker processes are forked
+    with rasterio.open(filename) as dataset:
+        min_x, min_y, max_x, max_y = rasterio.warp.transform_bounds(dataset.crs or CRS.from_epsg(DEFAULT_DHM_SRID),
+                                                                    CRS.from_epsg(TILE_SRID), *dataset.bounds)
+
+    # the y tile coordinate grows southwards, so the upper left corner has the smallest tile coordinates
+    p_from = webmercator.Point(meter_x=min_x, meter_y=max_y, zoom_level=zoom)
+    p_to = webmercator.Point(meter_x=max_x, meter_y=min_y, zoom_level=zoom)
+
+    return p_from.tile_x, p_from.tile_y, p_to.tile_x, p_to.tile_y
+
+
+def generate_dhm_tile(filename: str, path: str, zoom: int, tile_x: int, tile_y: int):
+    """Resamples the given raster to the given tile and saves it RGB encoded in the pyramid at path.
+    Returns True if the tile has been saved, False if the raster doesn't cover it."""
+
+    heights = read_heightmap_from(get_dataset(filename), tile_x, tile_y, zoom)
+    if heights is None:
+        return False
+
+    data = BytesIO()
+    Image.fromarray(np.ascontiguousarray(encode_heights(heights).transpose(1, 2, 0)), "RGB").save(data, format="PNG")
+    tile_storage.get_storage(path, "png").write(zoom, tile_x, tile_y, data.getvalue())
+
+    return True
+
+
+def generate_dhm_tiles(filename: str, path: str, zoom: int, tiles):
+    """Generates all given (tile_x, tile_y) tiles at the given zoom level (see generate_dhm_tile) and returns the
+    number of saved tiles - used to process a batch of tiles in a worker"""
+
+    return sum(generate_dhm_tile(filename, path, zoom, tile_x, tile_y) for tile_x, tile_y in tiles)
@@ -1,3 +1,4 @@
+import numpy as np
 from PIL import Image
 
 
@@ -18,54 +19,78 @@ def scale_epx(image: Image):
 
     Depending on the original neighboring pixels, these 9 new pixels are chosen.
 
+    The comparisons are done for all pixels at once on shifted numpy arrays of the image.
+    Edge handling: The last row and column are only used as neighbors, so the result is (width * 3 - 3) x
+    (height * 3 - 3) pixels. The neighbors left of / above the first column / row wrap around to the last
+    column / row.
+
     More information: https://en.wikipedia.org/wiki/Pixel-art_scaling_algorithms
     """
 
     width, height = image.size
-    image_pixels = image.load()
-
-    new_image = Image.new(image.mode, (width * 3 - 3, height * 3 - 3))
-    new_image_pixels = new_image.load()
-
-    for x in range(width - 1):
-        for y in range(height - 1):
-            A = image_pixels[x - 1, y - 1]
-            B = image_pixels[x, y - 1]
-            C = image_pixels[x + 1, y - 1]
-            D = image_pixels[x - 1, y]
-            E = image_pixels[x, y]
-            F = image_pixels[x + 1, y]
-            G = image_pixels[x - 1, y + 1]
-            H = image_pixels[x, y + 1]
-            I = image_pixels[x + 1, y + 1]
-
-            new_1 = E
-            new_2 = E
-            new_3 = E
-            new_4 = E
-            new_5 = E
-            new_6 = E
-            new_7 = E
-            new_8 = E
-            new_9 = E
-
-            if D == B and D != H and B != F: new_1 = D
-            if (D == B and D != H and B != F and E != C) or (B == F and B != D and F != H and E != A): new_2 = B
-            if B == F and B != D and F != H: new_3 = F
-            if (H == D and H != F and D != B and E != A) or (D == B and D != H and B != F and E != G): new_4 = D
-            if (B == F and B != D and F != H and E != I) or (F == H and F != B and H != D and E != C): new_6 = F
-            if H == D and H != F and D != B: new_7 = D
-            if (F == H and F != B and H != D and E != G) or (H == D and H != F and D != B and E != I): new_8 = H
-            if F == H and F != B and H != D: new_9 = F
-
-            new_image_pixels[x * 3, y * 3] = new_1
-            new_image_pixels[x * 3 + 1, y * 3] = new_2
-            new_image_pixels[x * 3 + 2, y * 3] = new_3
-            new_image_pixels[x * 3, y * 3 + 1] = new_4
-            new_image_pixels[x * 3 + 1, y * 3 + 1] = new_5
-            new_image_pixels[x * 3 + 2, y * 3 + 1] = new_6
-            new_image_pixels[x * 3, y * 3 + 2] = new_7
-            new_image_pixels[x * 3 + 1, y * 3 + 2] = new_8
-            new_image_pixels[x * 3 + 2, y * 3 + 2] = new_9
+
+    pixels = np.asarray(image)
+    if pixels.ndim == 2:
+        pixels = pixels[:, :, np.newaxis]
+
+    # prepend the last row and column, so that the neighbors at -1 wrap around like with direct pixel access
+    pixels = np.concatenate((pixels[-1:], pixels), axis=0)
+    pixels = np.concatenate((pixels[:, -1:], pixels), axis=1)
+
+    # pack all bands of a pixel into one integer, so that pixels can be compared and copied with a single operation
+    # (the bands are reinterpreted as unsigned integers first, so that this also works for e.g. float images)
+    band_values = pixels.view("u{}".format(pixels.dtype.itemsize))
+    bits_per_band = pixels.dtype.itemsize * 8
+    keys = np.zeros(pixels.shape[:2], dtype=np.uint64)
+    for band in range(pixels.shape[2]):
+        keys |= band_values[:, :, band].astype(np.uint64) << np.uint64(band * bits_per_band)
+
+    def neighbor(row_offset, column_offset):
+        """Returns the given neighbor of every pixel in the original image except the last row and column"""
+        return keys[1 + row_offset:height + row_offset, 1 + column_offset:width + column_offset]
+
+    A, B, C = neighbor(-1, -1), neighbor(-1, 0), neighbor(-1, 1)
+    D, E, F = neighbor(0, -1), neighbor(0, 0), neighbor(0, 1)
+    G, H, I = neighbor(1, -1), neighbor(1, 0), neighbor(1, 1)
+
+    upper_left = (D == B) & (D != H) & (B != F)
+    upper_right = (B == F) & (B != D) & (F != H)
+    lower_left = (H == D) & (H != F) & (D != B)
+    lower_right = (F == H) & (F != B) & (H != D)
+
+    # the new pixels 1-9 as (condition, replacing pixels) - if the condition is not met, E is used
+    new_pixels = [
+        [(upper_left, D),
+         ((upper_left & (E != C)) | (upper_right & (E != A)), B),
+         (upper_right, F)],
+        [((lower_left & (E != A)) | (upper_left & (E != G)), D),
+         (None, E),
+         ((upper_right & (E != I)) | (lower_right & (E != C)), F)],
+        [(lower_left, D),
+         ((lower_right & (E != G)) | (lower_left & (E != I)), H),
+         (lower_right, F)]
+    ]
+
+    # the result is built as (row, new pixel row, column, new pixel column) and then merged to rows and columns
+    new_keys = np.empty((height - 1, 3, width - 1, 3), dtype=np.uint64)
+
+    for new_row, conditions in enumerate(new_pixels):
+        for new_column, (condition, replacement) in enumerate(conditions):
+            if condition is None:
+                new_keys[:, new_row, :, new_column] = replacement
+            else:
+                new_keys[:, new_row, :, new_column] = np.where(condition, replacement, E)
+
+    new_keys = new_keys.reshape((height * 3 - 3, width * 3 - 3))
+
+    # unpack the bands again
+    band_mask = np.uint64((1 << bits_per_band) - 1)
+    new_image_pixels = np.empty(new_keys.shape + (pixels.shape[2],), dtype=band_values.dtype)
+    for band in range(pixels.shape[2]):
+        new_image_pixels[:, :, band] = (new_keys >> np.uint64(band * bits_per_band)) & band_mask
+
+    new_image = Image.frombytes(image.mode, (width * 3 - 3, height * 3 - 3), new_image_pixels.tobytes())
+    if image.mode == "P":
+        new_image.putpalette(image.getpalette())
 
     return new_image
@@ -0,0 +1,102 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from django.core.management import BaseCommand
+
+from raster import dhm_tiles, tile_index
+from raster.views import PYRAMIDS
+
+# the number of tiles which are generated by a worker process in one job
+TILES_PER_JOB = 64
+
+
+class Command(BaseCommand):
+    help = """
+    Builds the DHM pyramid (RGB encoded, see raster.dhm_tiles) directly from a source GeoTIFF with 1 band of float32
+    heights. Every tile from zoom-from to zoom-to which is covered by the source is resampled from it (averaged when
+    the tile has a lower resolution than the source, bilinear otherwise), so deep tiles don't have to be cropped from
+    their ancestors.
+    The tiles are generated in batches by a pool of processes. Existing tiles are skipped unless --overwrite is set.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--source', type=str)
+        parser.add_argument('--pyramidpath', type=str, default=PYRAMIDS["dhm"][0])
+        parser.add_argument('--zoom-from', type=int)
+        parser.add_argument('--zoom-to', type=int)
+        parser.add_argument('--overwrite', action='store_true')
+        parser.add_argument('--processes', type=int, default=os.cpu_count())
+
+    def handle(self, *args, **options):
+        source = options['source']
+        pyramidpath = options['pyramidpath']
+        zoom_from = options['zoom_from']
+        zoom_to = options['zoom_to']
+        file_ending = PYRAMIDS["dhm"][2]
+
+        if not source or not os.path.isfile(source):
+            raise ValueError("Invalid source path!")
+
+        if zoom_from is None or zoom_to is None or zoom_from > zoom_to:
+            raise ValueError("zoom-from and zoom-to are required, and zoom-from must not be larger than zoom-to!")
+
+        # the existing tiles are looked up in a sorted array of packed keys (8 bytes per tile) instead of a set
+        existing_tiles = None
+        if not options['overwrite']:
+            existing_tiles = tile_index.TileIndex(pyramidpath, file_ending)
+            existing_tiles.build()
+
+        generated = 0
+        skipped = 0
+
+        def get_batches(zoom, min_tile_x, min_tile_y, max_tile_x, max_tile_y):
+            """Yields the missing tiles of the given range in lists of up to TILES_PER_JOB (tile x, tile y)"""
+            nonlocal skipped
+
+            batch = []
+
+            for tile_x in range(min_tile_x, max_tile_x + 1):
+                for tile_y in range(min_tile_y, max_tile_y + 1):
+                    if existing_tiles is not None and existing_tiles.contains(zoom, tile_x, tile_y):
+                        skipped += 1
+                        continue
+
+                    batch.append((tile_x, tile_y))
+
+                    if len(batch) == TILES_PER_JOB:
+                        yield batch
+                        batch = []
+
+            if batch:
+                yield batch
+
+        def handle_finished(finished_jobs):
+            nonlocal generated
+
+            for job in finished_jobs:
+                pending.remove(job)
+                generated += job.result()
+
+        with ProcessPoolExecutor(max_workers=options['processes']) as executor:
+            pending = set()
+
+            for zoom in range(zoom_from, zoom_to + 1):
+                tile_range = dhm_tiles.get_tile_range(source, zoom)
+                min_tile_x, min_tile_y, max_tile_x, max_tile_y = tile_range
+
+                print("Generating up to {} tiles at zoom {}...".format(
+                    (max_tile_x - min_tile_x + 1) * (max_tile_y - min_tile_y + 1), zoom))
+
+                # the batches are only enumerated as jobs are submitted, so deep zoom levels are never held in memory
+                for batch in get_batches(zoom, *tile_range):
+                    # only a limited number of jobs is submitted at once, so that the tile lists don't pile up
+                    if len(pending) >= options['processes'] * 4:
+                        finished_jobs, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        handle_finished(finished_jobs)
+
+                    pending.add(executor.submit(dhm_tiles.generate_dhm_tiles, source, pyramidpath, zoom, batch))
+
+            handle_finished(wait(pending).done)
+
+        print("Generated {} tiles from zoom {} to {} in {}, {} existing tiles were skipped.".format(
+            generated, zoom_from, zoom_to, pyramidpath, skipped))
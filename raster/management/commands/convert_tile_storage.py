@@ -0,0 +1,53 @@
+import logging
+
+from django.core.management import BaseCommand
+
+from raster import tile_storage
+
+logger = logging.getLogger(__name__)
+
+# the number of tiles which are read from the source before they are written to the target at once
+BATCH_SIZE = 1000
+
+
+class Command(BaseCommand):
+    help = 'Copies all tiles of a pyramid from one storage to another, e.g. from a zoom/x/y.png directory to an ' \
+           'MBTiles file or back. The kind of storage is chosen by the path: paths ending with .mbtiles are MBTiles ' \
+           'files, all other paths are directories. Existing tiles in the target are replaced.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--source', type=str)
+        parser.add_argument('--target', type=str)
+        parser.add_argument('--file_ending', type=str, default='png')
+
+    def handle(self, *args, **options):
+        if not options['source'] or not options['target'] or options['source'] == options['target']:
+            raise ValueError('A source and a (different) target path are required!')
+
+        source = tile_storage.get_storage(options['source'], options['file_ending'])
+        target = tile_storage.get_storage(options['target'], options['file_ending'])
+
+        keys = sorted(source.get_tile_keys())
+        copied = 0
+        batch = []
+
+        for key in keys:
+            zoom, tile_x, tile_y = tile_storage.unpack_key(key)
+            data = source.read(zoom, tile_x, tile_y)
+
+            if data is None:
+                logger.warning("Skipping empty tile {}/{}/{}".format(zoom, tile_x, tile_y))
+                continue
+
+            batch.append((zoom, tile_x, tile_y, data))
+
+            if len(batch) >= BATCH_SIZE:
+                target.write_many(batch)
+                copied += len(batch)
+                batch = []
+                logger.info("copied {} of {} tiles".format(copied, len(keys)))
+
+        target.write_many(batch)
+        copied += len(batch)
+
+        print("Copied {} of {} tiles from {} to {}.".format(copied, len(keys), source.path, target.path))
@@ -1,23 +1,49 @@
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-import numpy as np
 import rasterio
 from django.core.management import BaseCommand
+from rasterio.windows import Window
+
+from raster import dhm_tiles
+
+# the size of the blocks (in pixels) in which the image is converted
+BLOCK_SIZE = 512
+
+# the number of tiles which are generated by a worker thread in one job when writing to a pyramid
+TILES_PER_JOB = 64
+
+
+def get_windows(width, height):
+    """Returns the windows of all blocks of an image with the given size"""
+
+    return [Window(col, row, min(BLOCK_SIZE, width - col), min(BLOCK_SIZE, height - row))
+            for row in range(0, height, BLOCK_SIZE) for col in range(0, width, BLOCK_SIZE)]
 
 
 class Command(BaseCommand):
     help = """
     This script takes a tif with 1 band of float32 pixels and converts it to an 8bit-channel RGB tif.
     The process is technically lossy, but has enough accuracy for heightmaps to be converted losslessly.
-    To reconstruct the height in millimeters from the RGB channels: R * 2^16 + G * 2^8 + B
-    
-    There are two outputs: The result of the conversion in 'converted.tif', and a human-readable
-    (but very lossy!) 'view.tif', in which the encoded values have been converted back - thus it
+    To reconstruct the height from the RGB channels: (R * 2^16 + G * 2^8 + B) / 100 (see raster.dhm_tiles)
+
+    The image is converted block by block by a pool of threads, so the memory usage doesn't depend on its size.
+    There are these outputs:
+    --output: The result of the conversion (default: 'converted.tif').
+    --view: A human-readable (but very lossy!) tif, in which the encoded values have been converted back - thus it
     can be used to roughly check if the conversion is correct.
+    --pyramid and --zoom: The encoded heights are additionally resampled to the WebMercator tiles at the given zoom
+    level and saved into the given tile pyramid (e.g. the DHM pyramid).
     """
 
     def add_arguments(self, parser):
         parser.add_argument('--imagepath', type=str)
+        parser.add_argument('--output', type=str, default='converted.tif')
+        parser.add_argument('--view', type=str)
+        parser.add_argument('--pyramid', type=str)
+        parser.add_argument('--zoom', type=int)
+        parser.add_argument('--threads', type=int, default=os.cpu_count())
 
     def handle(self, *args, **options):
         filename = options['imagepath']
@@ -25,43 +51,69 @@ class Command(BaseCommand):
         if not filename or not os.path.isfile(filename):
             raise ValueError("Invalid path!")
 
+        if options['pyramid'] and options['zoom'] is None:
+            raise ValueError("A zoom level is required for the pyramid!")
+
         with rasterio.open(filename) as src:
-            float32input = src.read(1)
             profile = src.profile
-            
-        # Convert negative pixels to 0, since e.g. nodata may be encoded as -9999
-        float32input[float32input < 0] = 0
+            windows = get_windows(src.width, src.height)
+
+        profile.update(dtype=rasterio.uint8, count=3, compress='lzw', nodata=0, tiled=True, blockxsize=BLOCK_SIZE,
+                       blockysize=BLOCK_SIZE, BIGTIFF='IF_SAFER')
+
+        write_lock = threading.Lock()
+
+        with rasterio.open(options['output'], 'w', **profile) as dst, \
+                ThreadPoolExecutor(max_workers=options['threads']) as executor:
+
+            def convert_block(window):
+                # Every thread reads from its own handle, but they all write into the same output
+                heights = dhm_tiles.get_dataset(filename).read(1, window=window, masked=True)
+                rgb = dhm_tiles.encode_heights(heights.filled(0))
+
+                with write_lock:
+                    dst.write(rgb, window=window)
+
+            # consume the results so that exceptions of the workers are raised here
+            list(executor.map(convert_block, windows))
+
+        print("Converted {} into {}.".format(filename, options['output']))
+
+        if options['view']:
+            self.write_view(options['output'], options['view'], profile, windows)
 
-        # Meters to millimeters
-        float_millimeters = float32input * 100
+        if options['pyramid']:
+            self.write_pyramid(filename, options['pyramid'], options['zoom'], options['threads'])
 
-        int_millimeters = float_millimeters.astype(np.uint32)
+    def write_view(self, converted_filename, view_filename, profile, windows):
+        """Writes a reconstructed image of the converted one (scaled to 0-255) to make sure everything is correct"""
 
-        # Datatype for array with  4 8bit bands
-        # The first band is discarded because heightmaps will never have such big heights (over 167772 meters? nope)
-        dt = np.dtype((np.uint32, {'f0': (np.uint8, 0), 'f1': (np.uint8, 1), 'f2': (np.uint8, 2), 'f3': (np.uint8, 3)}))
+        with rasterio.open(converted_filename) as converted:
+            maximum = max(dhm_tiles.decode_heights(converted.read(window=window)).max() for window in windows)
 
-        # Split the input int_millimeters into an array according to the datatype
-        int_split = int_millimeters.view(dtype=dt)
+            print("Maximum height of reconstructed image in meters - compare to gdalinfo -stats to make sure the "
+                  "data has been encoded correctly:", maximum)
 
-        profile.update(dtype=rasterio.uint8, count=3, compress='lzw', nodata=0)
+            with rasterio.open(view_filename, 'w', **profile) as dst:
+                for window in windows:
+                    reconstructed_scaled = dhm_tiles.decode_heights(converted.read(window=window)) * (
+                        255.0 / maximum if maximum > 0 else 0)
 
-        with rasterio.open('converted.tif', 'w', **profile) as dst:
-            dst.write(int_split['f2'].astype(rasterio.uint8), 1)
-            dst.write(int_split['f1'].astype(rasterio.uint8), 2)
-            dst.write(int_split['f0'].astype(rasterio.uint8), 3)
+                    for i in range(1, 4):
+                        dst.write(reconstructed_scaled.astype(rasterio.uint8), i, window=window)
 
-        # Also save a reconstructed image to make sure everything is correct
-        reconstructed = int_split['f2'].astype(np.uint32) * 2 ** 16 + int_split['f1'].astype(np.uint32) * 2 ** 8 + \
-                        int_split['f0'].astype(np.uint32)
+        print("Produced the (lossy, but human-readable) {}.".format(view_filename))
 
-        print("Maximum height of reconstructed image in millimeters - compare to gdalinfo -stats to make sure the "
-              "data has been encoded correctly:", reconstructed.max())
+    def write_pyramid(self, filename, pyramid, zoom, threads):
+        """Resamples the heights to all tiles at the given zoom level and saves them into the pyramid"""
 
-        reconstructed_scaled = reconstructed * (255.0 / reconstructed.max())
+        min_tile_x, min_tile_y, max_tile_x, max_tile_y = dhm_tiles.get_tile_range(filename, zoom)
+        tiles = [(tile_x, tile_y) for tile_x in range(min_tile_x, max_tile_x + 1)
+                 for tile_y in range(min_tile_y, max_tile_y + 1)]
 
-        with rasterio.open('view.tif', 'w', **profile) as dst:
-            for i in range(1, 4):
-                dst.write(reconstructed_scaled.astype(rasterio.uint8), i)
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            generated = sum(executor.map(lambda batch: dhm_tiles.generate_dhm_tiles(filename, pyramid, zoom, batch),
+                                         (tiles[start:start + TILES_PER_JOB]
+                                          for start in range(0, len(tiles), TILES_PER_JOB))))
 
-        print("Done! Produced 'converted.tif' and (lossy, but human-readable) 'view.tif'.")
+        print("Saved {} tiles at zoom {} into {}.".format(generated, zoom, pyramid))
@@ -0,0 +1,91 @@
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import webmercator
+from django.core.management import BaseCommand
+
+from location.models import Scenario
+from raster import tiles, tile_storage
+from raster.views import PYRAMIDS
+
+logger = logging.getLogger(__name__)
+
+
+def disable_tile_index():
+    """Runs in every worker process - each of them would otherwise scan the whole pyramid to build its own index"""
+
+    tiles.USE_TILE_INDEX = False
+
+
+def get_tile_range(extent, zoom):
+    """Returns the minimum and maximum tile x and y coordinates covering the given extent at the given zoom level"""
+
+    min_x, min_y, max_x, max_y = extent
+
+    # the y tile coordinate grows southwards, so the upper left corner has the smallest tile coordinates
+    p_from = webmercator.Point(meter_x=min_x, meter_y=max_y, zoom_level=zoom)
+    p_to = webmercator.Point(meter_x=max_x, meter_y=min_y, zoom_level=zoom)
+
+    return p_from.tile_x, p_from.tile_y, p_to.tile_x, p_to.tile_y
+
+
+def generate_subtree(path, do_epx_scale, file_ending, tile_x, tile_y, zoom, zoom_to, extent):
+    """Generates all missing tiles within the extent below the given tile - runs in a worker process"""
+
+    tile_ranges = {z: get_tile_range(extent, z) for z in range(zoom, zoom_to + 1)}
+
+    def is_within_extent(x, y, z):
+        min_tile_x, min_tile_y, max_tile_x, max_tile_y = tile_ranges[z]
+        return min_tile_x <= x <= max_tile_x and min_tile_y <= y <= max_tile_y
+
+    return tiles.generate_descendants(tile_x, tile_y, zoom, zoom_to, path, do_epx_scale, file_ending,
+                                      is_within_extent)
+
+
+class Command(BaseCommand):
+    help = """
+    Generates all missing derived tiles of the given pyramids within the extent of a scenario, so that they don't
+    have to be cropped on demand when they are first requested.
+    Every tile at zoom-from is the source of one job - its subtree up to zoom-to is generated in a single pass, so
+    that every tile is decoded only once. The jobs are distributed over a pool of processes.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenario', type=int)
+        parser.add_argument('--zoom-from', type=int)
+        parser.add_argument('--zoom-to', type=int)
+        parser.add_argument('--pyramids', type=str, nargs='+', choices=PYRAMIDS.keys(), default=list(PYRAMIDS.keys()))
+        parser.add_argument('--processes', type=int, default=os.cpu_count())
+
+    def handle(self, *args, **options):
+        zoom_from = options['zoom_from']
+        zoom_to = options['zoom_to']
+
+        if zoom_from is None or zoom_to is None or zoom_from >= zoom_to:
+            raise ValueError("zoom-from and zoom-to are required, and zoom-from must be smaller than zoom-to!")
+
+        scenario = Scenario.objects.get(id=options['scenario'])
+        extent = scenario.bounding_polygon.extent
+
+        with ProcessPoolExecutor(max_workers=options['processes'], initializer=disable_tile_index) as executor:
+            for pyramid in options['pyramids']:
+                path, do_epx_scale, file_ending = PYRAMIDS[pyramid]
+                storage = tile_storage.get_storage(path, file_ending)
+                min_tile_x, min_tile_y, max_tile_x, max_tile_y = get_tile_range(extent, zoom_from)
+
+                logger.info("generating {} from zoom {} to {} in ({}, {}), ({}, {})".format(
+                    pyramid, zoom_from, zoom_to, min_tile_x, min_tile_y, max_tile_x, max_tile_y))
+
+                jobs = [executor.submit(generate_subtree, path, do_epx_scale, file_ending, tile_x, tile_y, zoom_from,
+                                        zoom_to, extent)
+                        for tile_x in range(min_tile_x, max_tile_x + 1)
+                        for tile_y in range(min_tile_y, max_tile_y + 1)
+                        if storage.exists(zoom_from, tile_x, tile_y)]
+
+                generated = 0
+                for job in as_completed(jobs):
+                    generated += job.result()
+
+                print("Generated {} tiles of the {} pyramid from {} source tiles at zoom {}.".format(
+                    generated, pyramid, len(jobs), zoom_from))
@@ -30,4 +30,6 @@ class Command(BaseCommand):
             bounding_box = geos.fromstr(options['bounding_polygon'], srid=srid)
 
         # now we hand off to the internal implementation
-        import_dhm(options['filename'], bounding_box, srid=srid)
+        count = import_dhm(options['filename'], bounding_box, srid=srid)
+        if count is not None:
+            print("Imported {} height points.".format(count))
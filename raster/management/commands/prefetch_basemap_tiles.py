@@ -17,6 +17,7 @@ class Command(BaseCommand):
         parser.add_argument('--layer', type=str, nargs=1)
         parser.add_argument('--zoom-from', type=int, nargs='?')
         parser.add_argument('--zoom-to', type=int, nargs='?')
+        parser.add_argument('--workers', type=int, nargs='?')
 
     def handle(self, *args, **options):
 
@@ -36,7 +37,7 @@ class Command(BaseCommand):
         kwargs = dict()
         if 'url' in options:
             if options['url']:
-                kwargs['url'] = options['url']
+                kwargs['url'] = options['url'][0]
         if 'layer' in options:
             if options['layer']:
                 kwargs['layer'] = options['layer'][0]  # FIXME: why I have to do this?
@@ -47,4 +48,10 @@ class Command(BaseCommand):
             if options['zoom-to']:
                 kwargs['zoom_to'] = options['zoom-to']
 
-        fetch_wmts_tiles(bounding_box, **kwargs)
+        if options['workers']:
+            kwargs['workers'] = options['workers']
+
+        statistics = fetch_wmts_tiles(bounding_box, **kwargs)
+        if statistics:
+            print("Fetched {fetched} tiles, {missing} were not available, {failed} failed and {skipped} had already "
+                  "been fetched before.".format(**statistics))
@@ -12,6 +12,7 @@ class Command(BaseCommand):
         parser.add_argument('--layer', type=str, nargs=1)
         parser.add_argument('--zoom-from', type=int, nargs='?')
         parser.add_argument('--zoom-to', type=int, nargs='?')
+        parser.add_argument('--workers', type=int, nargs='?')
 
     def handle(self, *args, **options):
 
@@ -20,7 +21,7 @@ class Command(BaseCommand):
         scenario_id = options['scenario']
         if 'url' in options:
             if options['url']:
-                kwargs['tile-url'] = options['url']
+                kwargs['tile_url'] = options['url'][0]
         if 'layer' in options:
             if options['layer']:
                 kwargs['layer'] = options['layer'][0]  # FIXME: why I have to do this?
@@ -31,4 +32,10 @@ class Command(BaseCommand):
             if options['zoom-to']:
                 kwargs['zoom_to'] = options['zoom-to']
 
-        fetch_tiles(scenario_id, **kwargs)
+        if options['workers']:
+            kwargs['workers'] = options['workers']
+
+        statistics = fetch_tiles(scenario_id, **kwargs)
+        if statistics:
+            print("Fetched {fetched} tiles, {missing} were not available, {failed} failed and {skipped} had already "
+                  "been fetched before.".format(**statistics))
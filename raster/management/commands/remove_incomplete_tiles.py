@@ -1,73 +1,92 @@
+import csv
 import os
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 
-import rasterio
 from django.core.management import BaseCommand
 
+from raster import tile_checks, tile_storage
+
+# the number of tiles which are checked by a worker process in one job
+TILES_PER_JOB = 256
+
 
 class Command(BaseCommand):
-    help = 'Removes tiles in a tile pyramid which are incomplete (contain transparency).' \
-           'E.g. necessary when combining tilesets to prevent cliffs from forming when a file is replaced with an' \
-           'incomplete one.' \
-           'When the check_only flag is set, the command only prints out files which would be deleted, but doesnt' \
-           'actually delete them.'
+    help = 'Removes tiles in a tile pyramid which are incomplete (contain pixels which are 0 in all bands, e.g. ' \
+           'transparency). ' \
+           'E.g. necessary when combining tilesets to prevent cliffs from forming when a file is replaced with an ' \
+           'incomplete one. ' \
+           'When the check_only flag is set, the command only reports tiles which would be deleted, but doesnt ' \
+           'actually delete them. ' \
+           'The tiles are checked in parallel by a pool of processes. With --report, all incomplete and unreadable ' \
+           'tiles are written to a CSV file (zoom, x, y, result, removed).'
 
     def add_arguments(self, parser):
         parser.add_argument('--pyramidpath', type=str)
+        parser.add_argument('--file_ending', type=str, default='png')
         parser.add_argument('--check_only', action='store_true')
+        parser.add_argument('--report', type=str)
+        parser.add_argument('--processes', type=int, default=os.cpu_count())
 
     def handle(self, *args, **options):
         pyramidpath = options['pyramidpath']
 
-        if not pyramidpath or not os.path.isdir(pyramidpath):
-            raise ValueError('Invalid path - must be a directory!')
+        if not pyramidpath or not (os.path.isdir(pyramidpath) or os.path.isfile(pyramidpath)):
+            raise ValueError('Invalid path - must be a directory (or an MBTiles file)!')
+
+        storage = tile_storage.get_storage(pyramidpath, options['file_ending'])
+        keys = storage.get_tile_keys()
 
         files_to_be_deleted = 0
-        files_total = 0
+        files_unreadable = 0
+        files_total = len(keys)
+
+        report_file = open(options['report'], 'w', newline='') if options['report'] else None
+        report = csv.writer(report_file) if report_file else None
+        if report:
+            report.writerow(['zoom', 'x', 'y', 'result', 'removed'])
 
-        # Iterate over zoom folder, then x coordinate folder, then y coordinate files within that folder
-        for zoom_folder in os.listdir(pyramidpath):
-            full_zoom_path = os.path.join(pyramidpath, zoom_folder)
+        def handle_finished(finished_jobs):
+            nonlocal files_to_be_deleted, files_unreadable
 
-            for x_folder in os.listdir(full_zoom_path):
-                full_x_path = os.path.join(full_zoom_path, x_folder)
+            for job in finished_jobs:
+                pending.remove(job)
 
-                for y_file in os.listdir(full_x_path):
-                    full_y_file = os.path.join(full_x_path, y_file)
+                for key, result in job.result():
+                    zoom, tile_x, tile_y = tile_storage.unpack_key(key)
 
-                    if full_y_file.endswith('.png'):
-                        files_total += 1
+                    # Unreadable tiles are only reported, since they might be fine and just written right now
+                    remove = result == tile_checks.TILE_INCOMPLETE and not options['check_only']
 
-                        with rasterio.open(full_y_file) as src:
-                            bands = src.read()
+                    if result == tile_checks.TILE_INCOMPLETE:
+                        files_to_be_deleted += 1
+                    else:
+                        files_unreadable += 1
 
-                            # Check how many pixels with the value 0 there are per band
-                            # TODO: This method is pretty inefficient, but it's done like this because of how
-                            #  rasterio structures images... we check every single pixel in every single band
-                            #  because we only want to delete tiles which have pixels that are 0 in ALL bands
-                            pixels_checked = [0] * len(bands[0][0]) * len(bands[0])
+                    if remove:
+                        storage.delete(zoom, tile_x, tile_y)
 
-                            for band in bands:
-                                pixel_number = 0
+                    if report:
+                        report.writerow([zoom, tile_x, tile_y, result, remove])
 
-                                for row in band:
-                                    for pixel in row:
-                                        if pixel != 0:
-                                            pixels_checked[pixel_number] += 1
+        try:
+            with ProcessPoolExecutor(max_workers=options['processes']) as executor:
+                pending = set()
 
-                                        pixel_number += 1
+                for start in range(0, files_total, TILES_PER_JOB):
+                    # only a limited number of jobs is submitted at once, so that their results are handled early
+                    if len(pending) >= options['processes'] * 4:
+                        finished_jobs, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        handle_finished(finished_jobs)
 
-                            # If there was a pixel which was 0 in all bands, this image contains empty pixels
-                            # -> Print/delete it
-                            if 0 in pixels_checked:
-                                files_to_be_deleted += 1
+                    pending.add(executor.submit(tile_checks.check_tiles, pyramidpath, options['file_ending'],
+                                                keys[start:start + TILES_PER_JOB].tolist()))
 
-                                if options['check_only']:
-                                    print("File {} would be removed!".format(full_y_file))
-                                else:
-                                    os.remove(full_y_file)
-                            elif options['check_only']:
-                                print("File {} is fine!".format(full_y_file))
+                handle_finished(wait(pending).done)
+        finally:
+            if report_file:
+                report_file.close()
 
         # Print statistics
-        print("{} tiles of {} - {}% - would be deleted.".format(files_to_be_deleted, files_total,
-                                                                (files_to_be_deleted / files_total) * 100))
+        print("{} tiles of {} - {:.2f}% - are incomplete and {}. {} tiles could not be read.".format(
+            files_to_be_deleted, files_total, (files_to_be_deleted / files_total * 100) if files_total else 0,
+            "would be deleted" if options['check_only'] else "have been deleted", files_unreadable))
@@ -1,57 +1,277 @@
+import logging
 import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 from django.core.management import BaseCommand
 
+from raster import tile_storage
+
 # Source of the actual conversion calculation:
 # https://alastaira.wordpress.com/2011/07/06/converting-tms-tile-coordinates-to-googlebingosm-tile-coordinates/
 
+# the number of files which are renamed (or linked) by a worker thread in one job
+FILES_PER_JOB = 1000
+
+# the number of jobs per worker thread which are submitted at once (so that read tiles don't pile up in memory)
+JOBS_PER_THREAD = 2
+
+# the suffix of the intermediate names while renaming in place (tiles are swapped with their counterpart in one step)
+TEMPORARY_SUFFIX = ".tms-rename"
+
+logger = logging.getLogger(__name__)
+
+
+def get_rename_plan(pyramidpath, file_ending, do_austria_check, include_unchanged=False):
+    """Scans the pyramid once and returns a list of (zoom, x, tms y, osm y, source path, target path) tuples for all
+    files which belong to a tile with the given file ending (including e.g. .png.aux.xml files).
+    If include_unchanged is set, the files which are already named correctly (see do_austria_check) are included with
+    their current coordinates and path, so that they are copied to a new target as well."""
+
+    plan = []
+
+    # Iterate over zoom folder, then x coordinate folder, then y coordinate files within that folder
+    with os.scandir(pyramidpath) as zoom_entries:
+        for zoom_entry in zoom_entries:
+            if not zoom_entry.name.isdigit() or not zoom_entry.is_dir():
+                continue
+            zoom = int(zoom_entry.name)
+
+            with os.scandir(zoom_entry.path) as x_entries:
+                for x_entry in x_entries:
+                    if not x_entry.name.isdigit() or not x_entry.is_dir():
+                        continue
+                    x_coordinate = int(x_entry.name)
+
+                    with os.scandir(x_entry.path) as y_entries:
+                        for y_entry in y_entries:
+                            # Split the coordinate from the file ending (usually png or png.aux.xml)
+                            coordinate, separator, ending = y_entry.name.partition('.')
+                            if not coordinate.isdigit() or ending.endswith(TEMPORARY_SUFFIX) \
+                                    or not (ending == file_ending or ending.startswith(file_ending + ".")):
+                                continue
+                            y_coordinate = int(coordinate)
+
+                            if do_austria_check and x_coordinate > y_coordinate:
+                                # In Austria, the y coordinate of correctly named tiles is always smaller than the x
+                                # coordinate. If that's the case, the tile is kept as it is
+                                if include_unchanged:
+                                    plan.append((zoom, x_coordinate, y_coordinate, y_coordinate, y_entry.path,
+                                                 y_entry.path))
+                                continue
+
+                            # Transform the y coordinate to OSM format
+                            new_y_coordinate = (1 << zoom) - y_coordinate - 1
+
+                            plan.append((zoom, x_coordinate, y_coordinate, new_y_coordinate, y_entry.path,
+                                         os.path.join(x_entry.path, "{}.{}".format(new_y_coordinate, ending))))
+
+    return plan
+
+
+def find_interrupted_renames(pyramidpath):
+    """Returns the (intermediate path, target path) of all files which have been left with their intermediate name by
+    an interrupted in-place conversion. Only tiles which are converted get an intermediate name, so their target is
+    the one with the transformed y coordinate."""
+
+    renames = []
+
+    with os.scandir(pyramidpath) as zoom_entries:
+        for zoom_entry in zoom_entries:
+            if not zoom_entry.name.isdigit() or not zoom_entry.is_dir():
+                continue
+            zoom = int(zoom_entry.name)
+
+            with os.scandir(zoom_entry.path) as x_entries:
+                for x_entry in x_entries:
+                    if not x_entry.name.isdigit() or not x_entry.is_dir():
+                        continue
+
+                    with os.scandir(x_entry.path) as y_entries:
+                        for y_entry in y_entries:
+                            coordinate, separator, ending = y_entry.name.partition('.')
+                            if not coordinate.isdigit() or not ending.endswith(TEMPORARY_SUFFIX):
+                                continue
+
+                            new_y_coordinate = (1 << zoom) - int(coordinate) - 1
+                            renames.append((y_entry.path, os.path.join(x_entry.path, "{}.{}".format(
+                                new_y_coordinate, ending[:-len(TEMPORARY_SUFFIX)]))))
+
+    return renames
+
+
+def find_collisions(plan, in_place):
+    """Returns the entries of the plan whose target already exists and would be overwritten.
+    When renaming in place, targets which are renamed themselves (i.e. swapped) are not collisions."""
+
+    sources = {source for _, _, _, _, source, _ in plan} if in_place else set()
+
+    return [entry for entry in plan if entry[5] not in sources and os.path.exists(entry[5])]
+
+
+def find_unchanged_collisions(plan):
+    """Returns the entries of the plan which would be converted to the same target as a tile which is kept unchanged
+    (see get_rename_plan) - the unchanged tile takes precedence."""
+
+    unchanged_targets = {new_path for _, _, y, new_y, _, new_path in plan if y == new_y}
+
+    return [entry for entry in plan if entry[2] != entry[3] and entry[5] in unchanged_targets]
+
+
+def rename_batch(renames):
+    """Renames all given (source, target) paths and returns the number of renamed files"""
+
+    for source, target in renames:
+        os.rename(source, target)
+
+    return len(renames)
+
+
+def link_batch(links):
+    """Creates hardlinks for all given (source, target) paths and returns the number of linked files"""
+
+    for source, target in links:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.link(source, target)
+
+    return len(links)
+
+
+def map_in_batches(executor, threads, function, items):
+    """Runs the function on batches of FILES_PER_JOB of the given items in the executor and yields the results in order.
+    At most JOBS_PER_THREAD jobs per thread are pending at once, so the results are only produced as fast as they are
+    consumed."""
+
+    pending = deque()
+
+    for start in range(0, len(items), FILES_PER_JOB):
+        if len(pending) >= threads * JOBS_PER_THREAD:
+            yield pending.popleft().result()
+
+        pending.append(executor.submit(function, items[start:start + FILES_PER_JOB]))
+
+    while pending:
+        yield pending.popleft().result()
+
+
+def run_in_batches(executor, threads, function, pairs):
+    """Runs the function on batches of the given pairs (see map_in_batches) and returns the summed results"""
+
+    return sum(map_in_batches(executor, threads, function, pairs))
+
 
 class Command(BaseCommand):
     help = 'Converts pyramid tiles from TMS format to OSM by transforming the y coordinate of the tile paths. ' \
            'If the do_austria_check flag is set, only tiles which seem to have the incorrect format for Austrian' \
-           ' tiles are renamed.'
+           ' tiles are renamed. ' \
+           'By default, the files are renamed in place. With --target, the pyramid is left as it is and the tiles ' \
+           'are written to a new directory tree (as hardlinks) or to an MBTiles file (if the target ends with ' \
+           '.mbtiles) instead, including the tiles which are already named correctly. Targets which already ' \
+           'exist are reported as collisions and are not overwritten. ' \
+           'With --dry_run, only the plan is reported. ' \
+           'If an in-place conversion has been interrupted, only the files which have been left with an ' \
+           'intermediate name are renamed to their target.'
 
     def add_arguments(self, parser):
         parser.add_argument('--pyramidpath', type=str)
         parser.add_argument('--do_austria_check', action='store_true')
+        parser.add_argument('--file_ending', type=str, default='png')
+        parser.add_argument('--target', type=str)
+        parser.add_argument('--dry_run', action='store_true')
+        parser.add_argument('--threads', type=int, default=8)
 
     def handle(self, *args, **options):
         pyramidpath = options['pyramidpath']
+        target = options['target']
 
         if not pyramidpath or not os.path.isdir(pyramidpath):
             raise ValueError('Invalid path - must be a directory!')
 
-        # Iterate over zoom folder, then x coordinate folder, then y coordinate files within that folder
-        for zoom_folder in os.listdir(pyramidpath):
-            full_zoom_path = os.path.join(pyramidpath, zoom_folder)
-            zoom = int(zoom_folder)
+        interrupted = find_interrupted_renames(pyramidpath)
 
-            for x_folder in os.listdir(full_zoom_path):
-                full_x_path = os.path.join(full_zoom_path, x_folder)
+        if interrupted:
+            if target:
+                raise ValueError("{} files of an interrupted conversion are left in {} - convert it in place first to "
+                                 "finish the conversion!".format(len(interrupted), pyramidpath))
 
-                x_coordinate = int(x_folder)
+            # the interrupted conversion is finished first
+            blocked = [(source, new_path) for source, new_path in interrupted if os.path.exists(new_path)]
+            for source, new_path in blocked:
+                logger.warning("Not finishing the conversion of {}, since {} already exists".format(source, new_path))
 
-                for y_file in os.listdir(full_x_path):
-                    full_y_file = os.path.join(full_x_path, y_file)
+            finished = [rename for rename in interrupted if rename not in blocked]
+            if not options['dry_run']:
+                rename_batch(finished)
 
-                    if '.png' in full_y_file:
-                        # Split the coordinate from the file ending (usually png or png.aux.xml)
-                        coordinate_and_ending = y_file.split('.', 1)
+            print("{} files of an interrupted conversion {} renamed to their target, {} are left because their "
+                  "target already exists{}".format(len(finished), "would be" if options['dry_run'] else "were",
+                                                   len(blocked), " (see the log for details)." if blocked else "."))
 
-                        # Transform the y coordinate to OSM format
-                        y_coordinate = int(coordinate_and_ending[0])
+            # The other files could have been converted before the interruption or not, so converting all of them
+            # now could turn converted ones back
+            print("The remaining files are not converted in this run, since they might have been converted already - "
+                  "run the conversion again with --do_austria_check to convert the ones which still need it.")
+            return
 
-                        if options['do_austria_check']:
-                            # In Austria, the y coordinate of correctly named tiles is always smaller than the x
-                            # coordinate. If that's the case, don't do anything
-                            if x_coordinate > y_coordinate:
-                                continue
+        # a new target has to contain the tiles which are already named correctly as well
+        plan = get_rename_plan(pyramidpath, options['file_ending'], options['do_austria_check'],
+                               include_unchanged=bool(target))
+
+        if target and not target.endswith(tile_storage.MBTILES_ENDING):
+            # the same relative paths in the new tree
+            plan = [entry[:5] + (os.path.join(target, os.path.relpath(entry[5], pyramidpath)),) for entry in plan]
+
+        if target and target.endswith(tile_storage.MBTILES_ENDING):
+            storage = tile_storage.get_storage(target, options['file_ending'])
+            plan = [entry for entry in plan if entry[4].endswith("." + options['file_ending'])]
+            collisions = [entry for entry in plan if storage.exists(entry[0], entry[1], entry[3])]
+        else:
+            collisions = find_collisions(plan, in_place=not target)
+
+        # with the Austria check, a tile could be converted to the name of one which is already named correctly
+        collisions += find_unchanged_collisions(plan)
+
+        for zoom, x, y, new_y, source, new_path in collisions:
+            logger.warning("Not converting {}, since {} already exists".format(source, new_path))
+
+        colliding_sources = {entry[4] for entry in collisions}
+        plan = [entry for entry in plan if entry[4] not in colliding_sources]
+
+        print("{} files {} converted, {} are skipped because their target already exists{}".format(
+            len(plan), "would be" if options['dry_run'] else "will be", len(collisions),
+            " (see the log for details)." if collisions else "."))
+
+        if options['dry_run']:
+            return
+
+        threads = options['threads']
+
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            if not target:
+                # Rename to intermediate names first, so that tiles which are swapped don't overwrite each other
+                renamed = run_in_batches(executor, threads, rename_batch,
+                                         [(source, source + TEMPORARY_SUFFIX) for _, _, _, _, source, _ in plan])
+                run_in_batches(executor, threads, rename_batch,
+                               [(source + TEMPORARY_SUFFIX, new_path) for _, _, _, _, source, new_path in plan])
+                print("Renamed {} files.".format(renamed))
+
+            elif target.endswith(tile_storage.MBTILES_ENDING):
+                # the tiles are read in parallel, but written by a single connection in large transactions
+                def read_batch(batch):
+                    tiles = []
+                    for zoom, x, y, new_y, source, new_path in batch:
+                        with open(source, 'rb') as tile_file:
+                            tiles.append((zoom, x, new_y, tile_file.read()))
+                    return tiles
 
-                        new_y_coordinate = (1 << zoom) - y_coordinate - 1
-                        new_y_file = str(new_y_coordinate) + '.' + str(coordinate_and_ending[1])
+                written = 0
+                for tiles in map_in_batches(executor, threads, read_batch, plan):
+                    storage.write_many(tiles)
+                    written += len(tiles)
 
-                        # Build the new filename and rename the file
-                        full_new_file = os.path.join(full_x_path, new_y_file)
-                        os.rename(full_y_file, full_new_file)
+                print("Wrote {} tiles to {}.".format(written, target))
 
-                        print("Renamed {} to {}".format(full_y_file, full_new_file))
+            else:
+                linked = run_in_batches(executor, threads, link_batch,
+                                        [(source, new_path) for _, _, _, _, source, new_path in plan])
+                print("Linked {} files into {}.".format(linked, target))
@@ -0,0 +1,62 @@
+import numpy as np
+from django.db import migrations
+
+import raster.models
+
+
+# the maps are converted tile by tile, so that only a single tile is held in memory at a time
+def arrays_to_binary(apps, schema_editor):
+    Tile = apps.get_model('raster', 'Tile')
+
+    tiles = Tile.objects.exclude(heightmap_array=None, watersplatmap_array=None)
+    for tile in tiles.only('id', 'heightmap_array', 'watersplatmap_array').iterator():
+        Tile.objects.filter(pk=tile.pk).update(heightmap=tile.heightmap_array, watersplatmap=tile.watersplatmap_array)
+
+
+def binary_to_arrays(apps, schema_editor):
+    Tile = apps.get_model('raster', 'Tile')
+
+    tiles = Tile.objects.exclude(heightmap=None, watersplatmap=None)
+    for tile in tiles.only('id', 'heightmap', 'watersplatmap').iterator():
+        Tile.objects.filter(pk=tile.pk).update(
+            heightmap_array=None if tile.heightmap is None else np.asarray(tile.heightmap, dtype=float).tolist(),
+            watersplatmap_array=None if tile.watersplatmap is None else tile.watersplatmap.tolist())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('raster', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RenameField(
+            model_name='tile',
+            old_name='heightmap',
+            new_name='heightmap_array',
+        ),
+        migrations.RenameField(
+            model_name='tile',
+            old_name='watersplatmap',
+            new_name='watersplatmap_array',
+        ),
+        migrations.AddField(
+            model_name='tile',
+            name='heightmap',
+            field=raster.models.HeightmapField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='tile',
+            name='watersplatmap',
+            field=raster.models.BitmaskField(blank=True, null=True),
+        ),
+        migrations.RunPython(arrays_to_binary, binary_to_arrays),
+        migrations.RemoveField(
+            model_name='tile',
+            name='heightmap_array',
+        ),
+        migrations.RemoveField(
+            model_name='tile',
+            name='watersplatmap_array',
+        ),
+    ]
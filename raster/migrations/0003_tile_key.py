@@ -0,0 +1,83 @@
+from django.db import migrations, models
+
+from raster.tile_storage import ZOOM_SHIFT, X_SHIFT
+
+
+# Tiles used to be looked up without a unique constraint, so concurrent requests could create the same tile twice.
+# Of each set of duplicates, the one with the lowest id is kept (with the maps of the others if it has none), and all
+# references to the others (from any table, e.g. children, AssetPositions or LineSegments) are moved to it.
+def merge_duplicate_tiles(apps, schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("""
+            CREATE TEMPORARY TABLE raster_tile_duplicates AS
+            SELECT id, kept_id FROM (
+                SELECT id, min(id) OVER (PARTITION BY scenario_id, key) AS kept_id FROM raster_tile
+            ) AS tiles
+            WHERE id <> kept_id
+        """)
+
+        cursor.execute("""
+            SELECT referencing.relname, columns.attname
+            FROM pg_constraint constraints
+            JOIN pg_class referencing ON referencing.oid = constraints.conrelid
+            JOIN pg_attribute columns ON columns.attrelid = constraints.conrelid
+                AND columns.attnum = constraints.conkey[1]
+            WHERE constraints.contype = 'f' AND constraints.confrelid = 'raster_tile'::regclass
+        """)
+
+        for table, column in cursor.fetchall():
+            quoted_table = schema_editor.quote_name(table)
+            quoted_column = schema_editor.quote_name(column)
+
+            cursor.execute("UPDATE {table} SET {column} = duplicates.kept_id FROM raster_tile_duplicates duplicates "
+                           "WHERE {table}.{column} = duplicates.id".format(table=quoted_table, column=quoted_column))
+
+        cursor.execute("""
+            UPDATE raster_tile SET
+                heightmap = coalesce(raster_tile.heightmap, duplicates.heightmap),
+                watersplatmap = coalesce(raster_tile.watersplatmap, duplicates.watersplatmap)
+            FROM (
+                SELECT DISTINCT ON (duplicates.kept_id) duplicates.kept_id, tiles.heightmap, tiles.watersplatmap
+                FROM raster_tile_duplicates duplicates JOIN raster_tile tiles ON tiles.id = duplicates.id
+                ORDER BY duplicates.kept_id, tiles.heightmap IS NULL, tiles.id
+            ) AS duplicates
+            WHERE raster_tile.id = duplicates.kept_id
+        """)
+
+        cursor.execute("DELETE FROM raster_tile WHERE id IN (SELECT id FROM raster_tile_duplicates)")
+        cursor.execute("DROP TABLE raster_tile_duplicates")
+
+        # the deferred foreign key checks are run now, since the table can't be altered while they are pending
+        cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+        cursor.execute("SET CONSTRAINTS ALL DEFERRED")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('raster', '0002_tile_binary_maps'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tile',
+            name='key',
+            field=models.BigIntegerField(null=True),
+        ),
+        # the same packing as raster.tile_storage.pack_key
+        migrations.RunSQL(
+            "UPDATE raster_tile SET key = (lod::bigint << {}) | (x::bigint << {}) | y::bigint".format(ZOOM_SHIFT,
+                                                                                                    X_SHIFT),
+            migrations.RunSQL.noop,
+        ),
+        migrations.AlterField(
+            model_name='tile',
+            name='key',
+            field=models.BigIntegerField(),
+        ),
+        migrations.RunPython(merge_duplicate_tiles, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='tile',
+            unique_together={('scenario', 'key')},
+        ),
+    ]
@@ -1,13 +1,50 @@
+import numpy as np
 from django.conf import settings
 from django.contrib.gis.db import models
-from django.contrib.postgres.fields import ArrayField
 
 from location.models import Scenario
+from raster.tile_storage import pack_key
 
 
 # the resolution of a tile in x and y
 TILE_SIZE = 256
 
+# heights are stored as little endian 32 bit floats (in meters)
+HEIGHTMAP_DTYPE = np.dtype('<f4')
+
+
+# stores a TILE_SIZE x TILE_SIZE array of heights as raw bytes (256 KB per tile instead of a nested float8 array)
+# the values are loaded as read-only numpy array which directly uses the data of the database row (no copy)
+class HeightmapField(models.BinaryField):
+
+    def from_db_value(self, value, expression, connection):
+        if value is None:
+            return None
+
+        return np.frombuffer(value, dtype=HEIGHTMAP_DTYPE).reshape((TILE_SIZE, TILE_SIZE))
+
+    def get_prep_value(self, value):
+        if value is None or isinstance(value, (bytes, bytearray, memoryview)):
+            return value
+
+        return np.ascontiguousarray(value, dtype=HEIGHTMAP_DTYPE).reshape((TILE_SIZE, TILE_SIZE)).tobytes()
+
+
+# stores a TILE_SIZE x TILE_SIZE boolean array as bit mask (8 KB per tile), which is loaded as numpy array
+class BitmaskField(models.BinaryField):
+
+    def from_db_value(self, value, expression, connection):
+        if value is None:
+            return None
+
+        return np.unpackbits(np.frombuffer(value, dtype=np.uint8)).view(bool).reshape((TILE_SIZE, TILE_SIZE))
+
+    def get_prep_value(self, value):
+        if value is None or isinstance(value, (bytes, bytearray, memoryview)):
+            return value
+
+        return np.packbits(np.asarray(value, dtype=bool).reshape((TILE_SIZE, TILE_SIZE))).tobytes()
+
 
 # this represents a tile in a LOD quadtree pyramid
 class Tile(models.Model):
@@ -28,14 +65,26 @@ class Tile(models.Model):
     # the y-coordinate in the QuadTree pyramid
     y = models.IntegerField()
 
+    # lod, x and y packed into a single number (see raster.tile_storage.pack_key), which is unique per scenario
+    # it allows to look up a tile (or all ancestors of a location) with a single indexed query
+    key = models.BigIntegerField()
+
     # this is the heightmap of the give tile (None if not yet calculated)
-    # stored as an 2 dimensional array of float values in meters (max. resolution 1cm)
+    # stored as an 2 dimensional array of float32 values in meters (rows from north to south)
     # TODO: how do we apply the different height modifications from other modules (roads, rivers, ..)
     # TODO: we can handle them by priority or store the entire calculation or geometries
-    heightmap = ArrayField(ArrayField(models.FloatField(), size=TILE_SIZE), size=TILE_SIZE, blank=True, null=True)
+    heightmap = HeightmapField(blank=True, null=True)
+
+    # the generated splatmap for water as bit mask
+    watersplatmap = BitmaskField(blank=True, null=True)
+
+    class Meta:
+        unique_together = ('scenario', 'key')
 
-    # the generated splatmap for water in binary format
-    watersplatmap = ArrayField(ArrayField(models.BooleanField(), size=TILE_SIZE), size=TILE_SIZE, blank=True, null=True)
+    # the key is derived from the coordinates whenever the tile is saved (note that bulk_create doesn't call this)
+    def save(self, *args, **kwargs):
+        self.key = pack_key(self.lod, self.x, self.y)
+        super().save(*args, **kwargs)
 
 
 # all vectorized height information available (it is cut down based on a bounding box to the project extent)
@@ -1,37 +1,143 @@
-from django.http import HttpResponse
+from django.http import HttpResponse, FileResponse, StreamingHttpResponse, Http404
 from django.contrib.staticfiles import finders
+from django.utils.cache import get_conditional_response
 
+import hashlib
+import mimetypes
 import os.path
 import logging
-import json
+import re
+import threading
+from collections import OrderedDict
 
 logger = logging.getLogger(__name__)
 
+# the size of the chunks in which partial responses are streamed
+CHUNK_SIZE = 64 * 1024
 
-# delivers given raster as json
-def request_to_png_response(filename):
+# the pattern of a (single) range in the http range header
+RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
 
-    img_name = finders.find(os.path.join('maps', filename))
+# cache of the found static raster paths by requested filename
+# (only successful lookups are cached, so files which are added later can still be found)
+found_paths = {}
 
-    # Open the data source and read in the extent
+# the number of content hashes which are cached - the least recently used ones are dropped first
+MAX_CONTENT_HASHES = 1024
+
+# cache of the (size, modification time, content hash) by path - the hash is used as ETag
+content_hashes = OrderedDict()
+content_hashes_lock = threading.Lock()
+
+
+def find_raster(filename):
+    """Returns the full path of the static raster with the given filename, or None if it does not exist"""
+
+    if filename not in found_paths:
+        path = finders.find(os.path.join('maps', filename))
+
+        if path is None:
+            return None
+
+        found_paths[filename] = path
+
+    return found_paths[filename]
+
+
+def get_content_hash(path, stat):
+    """Returns the hash of the content of the given file, which is only calculated again if the file has changed"""
+
+    with content_hashes_lock:
+        cached = content_hashes.get(path)
+
+        if cached is not None and cached[:2] == (stat.st_size, stat.st_mtime_ns):
+            content_hashes.move_to_end(path)
+            return cached[2]
+
+    content_hash = hashlib.sha1()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+            content_hash.update(chunk)
+
+    with content_hashes_lock:
+        # an earlier version of the file is replaced, so every path is only cached once
+        content_hashes[path] = (stat.st_size, stat.st_mtime_ns, content_hash.hexdigest())
+        content_hashes.move_to_end(path)
+
+        while len(content_hashes) > MAX_CONTENT_HASHES:
+            content_hashes.popitem(last=False)
+
+    return content_hash.hexdigest()
+
+
+def stream_range(file, start, length):
+    """Yields length bytes from the given file starting at start in chunks, and closes the file at the end"""
+
+    with file:
+        file.seek(start)
+        while length > 0:
+            chunk = file.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+# delivers given raster as binary response
+# a single byte range can be requested with the http range header
+def request_to_png_response(request, filename):
+
+    img_name = find_raster(filename)
+
+    # Open the data source
     try:
-        BASE = os.path.dirname(os.path.abspath(__file__))
-        img = open(os.path.join(BASE, img_name), "rb")
-    except RuntimeError as e:
-        logger.error('Unable to open %s' % img_name)
-        logger.error(e)
-        return {"Error": "failed to open file"}
-    except TypeError as e:
+        img = open(img_name, "rb")
+    except (OSError, TypeError) as e:
         logger.error('Unable to open %s' % img_name)
         logger.error(e)
-        return {"Error": "failed to open file"}
+        raise Http404("failed to open file")
+
+    stat = os.fstat(img.fileno())
+    etag = '"{}"'.format(get_content_hash(img_name, stat))
+    content_type = mimetypes.guess_type(img_name)[0] or "application/octet-stream"
+
+    not_modified_response = get_conditional_response(request, etag=etag)
+    if not_modified_response is not None:
+        img.close()
+        not_modified_response["ETag"] = etag
+        return not_modified_response
+
+    range_match = RANGE_PATTERN.match(request.META.get("HTTP_RANGE", "").strip())
+
+    # a syntactically invalid range header (e.g. bytes=500-100) is ignored, and the full content is returned (RFC 7233)
+    if range_match and range_match.group(1) and range_match.group(2) \
+            and int(range_match.group(2)) < int(range_match.group(1)):
+        range_match = None
+
+    if range_match and any(range_match.groups()):
+        start, end = range_match.groups()
+
+        if not start:
+            # a suffix range, e.g. bytes=-500 for the last 500 bytes
+            start, end = max(stat.st_size - int(end), 0), stat.st_size - 1
+        else:
+            start, end = int(start), min(int(end), stat.st_size - 1) if end else stat.st_size - 1
+
+        # only ranges which are valid, but not within the content (or empty suffixes) can't be satisfied
+        if start > end:
+            img.close()
+            response = HttpResponse(status=416)
+            response["Content-Range"] = "bytes */{}".format(stat.st_size)
+            return response
 
-    img_data = img.read()
-    img_dict = {}
+        response = StreamingHttpResponse(stream_range(img, start, end - start + 1), status=206,
+                                         content_type=content_type)
+        response["Content-Range"] = "bytes {}-{}/{}".format(start, end, stat.st_size)
+        response["Content-Length"] = str(end - start + 1)
+    else:
+        response = FileResponse(img, content_type=content_type)
 
-    # The image bytes will be sent as JSON, so we need to create a dictionary out of the image bytes.
-    # This is probably somewhat redundant and inefficient, but it works!
-    for i in range(len(img_data)):
-        img_dict[i] = int(img_data[i])
+    response["Accept-Ranges"] = "bytes"
+    response["ETag"] = etag
 
-    return img_dict
+    return response
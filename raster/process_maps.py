@@ -1,31 +1,31 @@
 import logging
 import os
-from urllib import request
-from pathlib import Path
-from urllib.error import HTTPError
 
 import webmercator
 from django.conf import settings
 
 from landscapelab import utils
 from location.models import Scenario
-from raster import views
+from raster import views, tile_fetcher, tile_storage
 
 TILE_URL_FORMAT = "https://{}.tile.opentopomap.org/{}/{}/{}.png"
+TILE_URL_SUBDOMAINS = "abc"
 DEFAULT_LAYER = "opentopomap"
 DEFAULT_ZOOM_FROM = 5
 DEFAULT_ZOOM_TO = 22
 
-# the format and location of the opentopomap raster pictures
-TOPO_FILE = "/raster/{}/{}/{}/{}.png"
+# the location of the opentopomap pyramid by layer
+TOPO_PATH = "raster/{}"
+TOPO_FILE_ENDING = "png"
 
 
 logger = logging.getLogger(__name__)
 
 
 # method to fetch a complete pyramid within a given bounding box
+# the tiles are downloaded concurrently, tiles which have been fetched in a previous run are skipped
 def fetch_tiles(scenario_id, tile_url=TILE_URL_FORMAT, layer=DEFAULT_LAYER,
-                zoom_from=DEFAULT_ZOOM_FROM, zoom_to=DEFAULT_ZOOM_TO):
+                zoom_from=DEFAULT_ZOOM_FROM, zoom_to=DEFAULT_ZOOM_TO, workers=tile_fetcher.DEFAULT_WORKERS):
 
     logger.info("fetch layer {} from {} (z: {} to {})".format(layer, tile_url, zoom_from, zoom_to))
 
@@ -47,37 +47,49 @@ def fetch_tiles(scenario_id, tile_url=TILE_URL_FORMAT, layer=DEFAULT_LAYER,
             max_y = y
 
     # get all tiles in the available extent and zoomlevel
-    for zoom in range(zoom_from, zoom_to):
-        p_from = webmercator.Point(meter_x=min_x, meter_y=min_y, zoom_level=zoom)
-        p_to = webmercator.Point(meter_x=max_x, meter_y=max_y, zoom_level=zoom)
+    def get_tiles():
+        for zoom in range(zoom_from, zoom_to):
+            p_from = webmercator.Point(meter_x=min_x, meter_y=min_y, zoom_level=zoom)
+            p_to = webmercator.Point(meter_x=max_x, meter_y=max_y, zoom_level=zoom)
 
-        logger.info("getting all tiles with z {} for ({}, {}), ({}, {})".format(zoom, p_from.tile_x, p_from.tile_y,
-                                                                                p_to.tile_x, p_to.tile_y))
-        for y in range(p_to.tile_y, p_from.tile_y+1):
-            for x in range(p_from.tile_x, p_to.tile_x+1):
-                fetch_tile(tile_url, layer, x, y, zoom)
+            logger.info("getting all tiles with z {} for ({}, {}), ({}, {})".format(zoom, p_from.tile_x, p_from.tile_y,
+                                                                                    p_to.tile_x, p_to.tile_y))
+            for y in range(p_to.tile_y, p_from.tile_y+1):
+                for x in range(p_from.tile_x, p_to.tile_x+1):
+                    yield zoom, x, y
+
+    def fetch(zoom, x, y):
+        return tile_fetcher.download(get_tile_url(tile_url, x, y, zoom))
+
+    return tile_fetcher.fetch_pyramid(get_tiles(), fetch, utils.get_full_texture_path(TOPO_PATH.format(layer)),
+                                      TOPO_FILE_ENDING, workers)
+
+
+# returns the url of the given tile - the requests are spread over the subdomains of the tile server
+def get_tile_url(tile_url, x, y, zoom):
+    return tile_url.format(TILE_URL_SUBDOMAINS[(x + y) % len(TILE_URL_SUBDOMAINS)], zoom, x, y)
 
 
 # this fetches a single tile and puts it into our source directory
 def fetch_tile(tile_url, layer, x, y, zoom):
 
-    file = utils.get_full_texture_path(TOPO_FILE.format(layer, zoom, x, y))
+    storage = tile_storage.get_storage(utils.get_full_texture_path(TOPO_PATH.format(layer)), TOPO_FILE_ENDING)
 
-    if not Path(file).is_file():
+    if not storage.exists(zoom, x, y):
 
-        try:
-            # create necessary subdirectories
-            os.makedirs(Path(file).parent)
-        except FileExistsError:
-            pass  # skip if all paths are already there
-
-        # make the request for the image and stores the raw answer into the file
+        # make the request for the image and store the raw answer atomically
         logger.debug("getting tile {} {}/{}-{}".format(layer, zoom, x, y))
-        request_url = tile_url.format("b", zoom, x, y)
+        request_url = get_tile_url(tile_url, x, y, zoom)
         try:
-            request.urlretrieve(request_url, file)
-        except HTTPError:
-            logger.warning("Could not fetch {}".format(request_url))
+            data = tile_fetcher.fetch_with_retries(lambda *tile: tile_fetcher.download(request_url), zoom, x, y)
+        except Exception as error:
+            logger.warning("Could not fetch {}: {}".format(request_url, error))
+            return
+
+        if data is not None:
+            storage.write(zoom, x, y, data)
+        else:
+            logger.warning("Tile {} is not available".format(request_url))
 
     else:
         logger.debug("skipped tile {} {}/{}-{}".format(layer, zoom, y, x))
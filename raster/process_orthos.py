@@ -1,17 +1,18 @@
 import logging
 import os
-from pathlib import Path
 
 from django.contrib.gis.geos import Polygon
 from django.conf import settings
-from requests import HTTPError
 
+import requests
 import webmercator
 import owslib.wmts as wmts
+from owslib.util import ServiceException
 
 
 # current default is the austrian basemap  TODO: make it configurable
 from landscapelab import utils
+from raster import tile_fetcher, tile_storage
 
 DEFAULT_URL = "https://www.basemap.at/wmts/1.0.0/WMTSCapabilities.xml"
 DEFAULT_LAYER = "bmaporthofoto30cm"
@@ -21,13 +22,16 @@ DEFAULT_ZOOM_TO = 22
 
 # the format and location of the ortho pictures
 ORTHOS_FILE = "/raster/{}/{}/{}/{}.jpg"
+ORTHOS_PATH = "raster/{}"
+ORTHOS_FILE_ENDING = "jpg"
 
 logger = logging.getLogger(__name__)
 
 
 # method to fetch a complete pyramid within a given bounding box
+# the tiles are downloaded concurrently, tiles which have been fetched in a previous run are skipped
 def fetch_wmts_tiles(bounding_box: Polygon, url=DEFAULT_URL, layer=DEFAULT_LAYER,
-                     zoom_from=DEFAULT_ZOOM_FROM, zoom_to=DEFAULT_ZOOM_TO):
+                     zoom_from=DEFAULT_ZOOM_FROM, zoom_to=DEFAULT_ZOOM_TO, workers=tile_fetcher.DEFAULT_WORKERS):
 
     # initialize wmts connection
     logger.info("fetch layer {} from {} (z: {} to {})".format(layer, url, zoom_from, zoom_to))
@@ -60,46 +64,88 @@ def fetch_wmts_tiles(bounding_box: Polygon, url=DEFAULT_URL, layer=DEFAULT_LAYER
                 max_y = y
 
         # get all tiles in the available extent and zoomlevel
-        for zoom in range(zoom_from, zoom_to):  # FIXME: fixed values -> configurable
-            p_from = webmercator.Point(meter_x=min_x, meter_y=min_y, zoom_level=zoom)
-            p_to = webmercator.Point(meter_x=max_x, meter_y=max_y, zoom_level=zoom)
-
-            logger.info("getting all tiles with z {} for ({}, {}), ({}, {})".format(zoom, p_from.tile_x, p_from.tile_y,
-                                                                                    p_to.tile_x, p_to.tile_y))
-            for y in range(p_to.tile_y, p_from.tile_y+1):
-                for x in range(p_from.tile_x, p_to.tile_x+1):
-                    retry = True
-                    while retry:
-                        try:
-                            fetch_wmts_tile(tile_server, layer, x, y, zoom)
-                            retry = False
-                        except Exception as e:
-                            logger.warning("Got exception {} - need to repeat".format(e))
+        def get_tiles():
+            for zoom in range(zoom_from, zoom_to):
+                p_from = webmercator.Point(meter_x=min_x, meter_y=min_y, zoom_level=zoom)
+                p_to = webmercator.Point(meter_x=max_x, meter_y=max_y, zoom_level=zoom)
+
+                logger.info("getting all tiles with z {} for ({}, {}), ({}, {})".format(
+                    zoom, p_from.tile_x, p_from.tile_y, p_to.tile_x, p_to.tile_y))
+                for y in range(p_to.tile_y, p_from.tile_y+1):
+                    for x in range(p_from.tile_x, p_to.tile_x+1):
+                        yield zoom, x, y
+
+        tile_url_template = get_wmts_tile_url_template(tile_server, layer)
+
+        def fetch(zoom, x, y):
+            return download_wmts_tile(tile_server, tile_url_template, layer, x, y, zoom)
+
+        return tile_fetcher.fetch_pyramid(get_tiles(), fetch, utils.get_full_texture_path(ORTHOS_PATH.format(layer)),
+                                          ORTHOS_FILE_ENDING, workers)
     else:
         pass  # TODO: error
 
 
+# returns the url template of the tiles of the given layer if the server offers a RESTful interface, otherwise None
+def get_wmts_tile_url_template(tile_server, layer):
+
+    layer_contents = tile_server.contents[layer]
+
+    for resource_url in getattr(layer_contents, 'resourceURLs', None) or []:
+        if resource_url.get('resourceType') == 'tile':
+            template = resource_url['template']
+
+            # the style and tile matrix set are the same for all tiles, like the ones owslib chooses by default
+            styles = getattr(layer_contents, 'styles', None) or {}
+            style = next((name for name, style in styles.items() if style.get('isDefault')), next(iter(styles), ''))
+            tile_matrix_set = next(iter(layer_contents.tilematrixsetlinks), '')
+
+            return template.replace('{Style}', style).replace('{style}', style) \
+                .replace('{TileMatrixSet}', tile_matrix_set)
+
+    return None
+
+
+# returns the content of a single tile, or None if the server doesn't have it
+# if a url template is given (see get_wmts_tile_url_template), the tile is requested via the RESTful interface, so
+# that the connections to the server are reused
+def download_wmts_tile(tile_server, tile_url_template, layer, col, row, zoom):
+
+    if tile_url_template:
+        return tile_fetcher.download(tile_url_template.replace('{TileMatrix}', str(zoom))
+                                     .replace('{TileRow}', str(row)).replace('{TileCol}', str(col)))
+
+    try:
+        return tile_server.gettile(layer=layer, tilematrix=str(zoom), row=row, column=col).read() or None
+    except ServiceException as error:
+        # the server answered with an exception report (e.g. TileOutOfRange), which doesn't change when repeated
+        logger.debug("tile {} {}/{}-{} is not available: {}".format(layer, zoom, col, row, error))
+        return None
+    except requests.HTTPError as error:
+        # like in tile_fetcher.download, missing tiles are not an error (owslib raises for them)
+        if error.response is not None and error.response.status_code == 404:
+            return None
+        raise
+
+
 # this fetches a single tile and puts it into our source directory
 def fetch_wmts_tile(tile_server, layer, col, row, zoom):
 
-    # generate the path with given parameters
-    file = utils.get_full_texture_path(ORTHOS_FILE.format(layer, zoom, col, row))
+    storage = tile_storage.get_storage(utils.get_full_texture_path(ORTHOS_PATH.format(layer)), ORTHOS_FILE_ENDING)
 
-    # create necessary subdirectories
-    if not Path(file).is_file():
-        try:
-            os.makedirs(Path(file).parent)
-        except FileExistsError:
-            pass  # skip if all paths are already there
+    if not storage.exists(zoom, col, row):
         logger.debug("getting tile {} {}/{}-{}".format(layer, zoom, col, row))
         try:
-            tile = tile_server.gettile(layer=layer, tilematrix=str(zoom), row=row, column=col)
-            out = open(file, 'wb')
-            out.write(tile.read())
-            out.close()
-
-        except HTTPError:
-            logger.warning("could not fetch tile for {} {}/{}-{}".format(layer, zoom, col, row))
+            data = tile_fetcher.fetch_with_retries(
+                lambda *tile: download_wmts_tile(tile_server, get_wmts_tile_url_template(tile_server, layer), layer,
+                                                 col, row, zoom), zoom, col, row)
+        except Exception as error:
+            logger.warning("could not fetch tile for {} {}/{}-{}: {}".format(layer, zoom, col, row, error))
+            return
+
+        # the tile is written atomically, so that an interrupted fetch doesn't leave a truncated file behind
+        if data is not None:
+            storage.write(zoom, col, row, data)
     else:
         logger.debug("skipped tile {} {}/{}-{}".format(layer, zoom, col, row))
 
@@ -0,0 +1,127 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+from unittest import mock
+
+from django.test import SimpleTestCase
+from PIL import Image
+
+from raster import tile_index, tile_storage, tiles
+
+
+class FindNearestAncestorZoomTest(SimpleTestCase):
+    """A pyramid whose lowest zoom level is 8, but which only has data from zoom 14 upwards in the tested area"""
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+        # the area of the requested tiles (tile 142641/91768 at zoom 18), which has been prefetched from zoom 14
+        self.save_tile(14, 142641 >> 4, 91768 >> 4)
+
+        # another area of the pyramid, which starts at zoom 8
+        self.save_tile(8, 10, 10)
+
+        # the lowest zoom levels are cached per pyramid path
+        self.addCleanup(tiles.lowest_zoom_levels.pop, self.path, None)
+
+    def save_tile(self, zoom, tile_x, tile_y):
+        os.makedirs(os.path.join(self.path, str(zoom), str(tile_x)), exist_ok=True)
+        Image.new("RGB", (256, 256), (zoom, tile_x % 256, tile_y % 256)).save(
+            os.path.join(self.path, str(zoom), str(tile_x), "{}.png".format(tile_y)))
+
+    def use_built_index(self):
+        index = tile_index.TileIndex(self.path, "png")
+        index.build()
+
+        tile_index.indices[(self.path, "png")] = index
+        self.addCleanup(tile_index.indices.pop, (self.path, "png"), None)
+
+    def test_sparse_area_without_index(self):
+        with mock.patch.object(tiles, "USE_TILE_INDEX", False):
+            self.assertEqual(tiles.find_nearest_ancestor_zoom(142641, 91768, 18, self.path, "png"), 14)
+
+    def test_sparse_area_with_index(self):
+        self.use_built_index()
+
+        self.assertEqual(tiles.find_nearest_ancestor_zoom(142641, 91768, 18, self.path, "png"), 14)
+
+    def test_no_ancestor(self):
+        with mock.patch.object(tiles, "USE_TILE_INDEX", False):
+            self.assertIsNone(tiles.find_nearest_ancestor_zoom(0, 0, 18, self.path, "png"))
+
+    def test_tile_is_cropped_from_sparse_area(self):
+        self.use_built_index()
+
+        # nothing is materialized in the background, since the pyramid is removed after the test
+        with mock.patch.object(tiles, "submit_materialization"):
+            filename = tiles.get_tile_at(142641, 91768, 18, self.path)
+
+        self.assertTrue(os.path.isfile(filename))
+
+
+class TileIndexTest(SimpleTestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+        os.makedirs(os.path.join(self.path, "10", "5"))
+        Image.new("RGB", (256, 256)).save(os.path.join(self.path, "10", "5", "7.png"))
+
+        # an empty file which has been left behind by an interrupted write
+        open(os.path.join(self.path, "10", "5", "8.png"), "wb").close()
+
+    def test_empty_files_are_not_indexed(self):
+        index = tile_index.TileIndex(self.path, "png")
+        index.build()
+
+        self.assertTrue(index.contains(10, 5, 7))
+        self.assertFalse(index.contains(10, 5, 8))
+
+    def test_removed_tiles_are_forgotten(self):
+        index = tile_index.TileIndex(self.path, "png")
+        index.build()
+
+        index.remove(10, 5, 7)
+        self.assertFalse(index.contains(10, 5, 7))
+
+        index.add(10, 5, 7)
+        self.assertTrue(index.contains(10, 5, 7))
+
+
+class MBTilesStorageTest(SimpleTestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+    def test_existing_file_is_not_changed(self):
+        # a file like the ones written by common tools, in which tiles is a view over deduplicated images
+        filename = os.path.join(self.path, "existing.mbtiles")
+        with sqlite3.connect(filename) as connection:
+            connection.executescript(
+                "CREATE TABLE map (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_id TEXT);"
+                "CREATE TABLE images (tile_id TEXT, tile_data BLOB);"
+                "CREATE VIEW tiles AS SELECT zoom_level, tile_column, tile_row, tile_data FROM map JOIN images "
+                "USING (tile_id);"
+                "INSERT INTO map VALUES (2, 1, 0, 'a');"
+                "INSERT INTO images VALUES ('a', x'0102');")
+        connection.close()
+
+        storage = tile_storage.MBTilesStorage(filename, "png")
+
+        self.assertEqual(storage.read(2, 1, 3), b"\x01\x02")
+        self.assertEqual(list(storage.get_tile_keys()), [tile_storage.pack_key(2, 1, 3)])
+
+        with sqlite3.connect(filename) as connection:
+            self.assertEqual(connection.execute("PRAGMA journal_mode").fetchone()[0], "delete")
+        connection.close()
+
+    def test_new_file_is_created_on_write(self):
+        storage = tile_storage.MBTilesStorage(os.path.join(self.path, "new.mbtiles"), "png")
+
+        self.assertIsNone(storage.read(1, 0, 1))
+        self.assertFalse(os.path.exists(storage.path))
+
+        storage.write(1, 0, 1, b"tile")
+        self.assertEqual(storage.read(1, 0, 1), b"tile")
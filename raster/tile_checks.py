@@ -0,0 +1,63 @@
+import logging
+import sqlite3
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+from raster import tile_storage
+
+# the results of check_tiles
+TILE_COMPLETE = "complete"
+TILE_INCOMPLETE = "incomplete"
+TILE_UNREADABLE = "unreadable"
+
+logger = logging.getLogger(__name__)
+
+
+def is_incomplete(pixels: np.ndarray):
+    """Returns True if the given pixels (rows, columns[, bands]) contain a pixel which is 0 in all bands.
+
+    Such pixels are empty (e.g. transparent or outside of the source data), so the tile only partially covers its
+    area. This happens at the border of a data source - if such a tile replaces a complete one, cliffs appear.
+    """
+
+    if pixels.ndim == 2:
+        return bool((pixels == 0).any())
+
+    return bool(np.all(pixels == 0, axis=-1).any())
+
+
+def is_incomplete_image(image: Image):
+    """Returns True if the given image contains a pixel which is 0 in all bands (see is_incomplete)"""
+
+    return is_incomplete(np.asarray(image))
+
+
+def check_tiles(path: str, file_ending: str, keys):
+    """Checks the tiles with the given packed keys (see tile_storage.pack_key) in the pyramid at the given path.
+    Returns a list of (key, result) tuples for all tiles which are not complete (TILE_INCOMPLETE or TILE_UNREADABLE).
+
+    This only reads from the storage, so it can run in a pool of worker processes.
+    """
+
+    storage = tile_storage.get_storage(path, file_ending)
+    results = []
+
+    for key in keys:
+        zoom, tile_x, tile_y = tile_storage.unpack_key(key)
+
+        try:
+            data = storage.read(zoom, tile_x, tile_y)
+            if data is None:
+                raise OSError("the tile is empty")
+
+            with Image.open(BytesIO(data)) as image:
+                if is_incomplete_image(image):
+                    results.append((key, TILE_INCOMPLETE))
+
+        except (OSError, sqlite3.Error) as error:
+            logger.warning("Could not read tile {}/{}/{} in {}: {}".format(zoom, tile_x, tile_y, path, error))
+            results.append((key, TILE_UNREADABLE))
+
+    return results
@@ -0,0 +1,250 @@
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from landscapelab import utils
+from raster import tile_storage
+
+# the number of tiles which are downloaded at the same time
+DEFAULT_WORKERS = 16
+
+# the number of times a failing download is repeated before the tile is given up (until the next run)
+MAX_RETRIES = 5
+
+# the delay before the first repetition of a failed download in seconds - it is doubled with every further attempt,
+# up to MAX_BACKOFF seconds (and randomized a bit, so that the workers don't hit the server in lockstep)
+BACKOFF_BASE = 1
+MAX_BACKOFF = 60
+
+# the number of seconds to wait for a response of the tile server
+REQUEST_TIMEOUT = 30
+
+# the tiles which have been fetched (or are known to be unavailable) are recorded in an SQLite file with this ending
+# next to the pyramid, so that an interrupted prefetch can be resumed without checking every file - the tiles are
+# looked up in it one by one, so it doesn't have to be loaded into memory
+MANIFEST_ENDING = ".manifest.sqlite"
+MANIFEST_FETCHED = "fetched"
+MANIFEST_MISSING = "missing"
+
+# manifests used to be text files with this ending and one "zoom/x/y status" line per tile - they are imported once
+LEGACY_MANIFEST_ENDING = ".manifest"
+
+# the number of finished tiles after which they are committed to the manifest (an interrupted prefetch fetches the
+# uncommitted ones again)
+MANIFEST_COMMIT_INTERVAL = 1000
+
+# every worker thread has its own http session, which keeps its connections to the tile server open
+sessions = threading.local()
+
+logger = logging.getLogger(__name__)
+
+
+def get_session():
+    """Returns the http session of the current thread"""
+
+    if not hasattr(sessions, "session"):
+        session = requests.Session()
+        session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=4))
+        session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=4))
+        sessions.session = session
+
+    return sessions.session
+
+
+def download(url: str):
+    """Returns the content at the given url, or None if the server doesn't have it (e.g. outside of its extent).
+    Other errors are raised, so that the download can be repeated."""
+
+    response = get_session().get(url, timeout=REQUEST_TIMEOUT)
+
+    if response.status_code in (204, 404):
+        return None
+
+    response.raise_for_status()
+
+    return response.content or None
+
+
+def fetch_with_retries(fetch, zoom: int, tile_x: int, tile_y: int):
+    """Returns fetch(zoom, tile_x, tile_y), repeating it with an exponential backoff if it fails.
+    The last error is raised if it still fails after MAX_RETRIES repetitions."""
+
+    attempt = 0
+
+    while True:
+        try:
+            return fetch(zoom, tile_x, tile_y)
+        except Exception as error:
+            if attempt >= MAX_RETRIES:
+                raise
+
+            delay = min(MAX_BACKOFF, BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1)
+            attempt += 1
+
+            logger.warning("Got exception {} while fetching tile {}/{}/{} - repeating in {:.1f}s ({}/{})"
+                           .format(error, zoom, tile_x, tile_y, delay, attempt, MAX_RETRIES))
+            time.sleep(delay)
+
+
+def get_manifest_path(path: str, ending=MANIFEST_ENDING):
+    """Returns the path of the manifest file of the pyramid at the given path"""
+
+    return utils.remove_trailing_delimiter(path) + ending
+
+
+def read_legacy_manifest(manifest_path: str):
+    """Yields the packed key (see tile_storage.pack_key) and status of every tile in the given text manifest"""
+
+    with open(manifest_path, "r") as manifest:
+        for line in manifest:
+            # an interrupted write could have left an incomplete last line, which is simply ignored
+            parts = line.split()
+            if len(parts) != 2 or parts[1] not in (MANIFEST_FETCHED, MANIFEST_MISSING):
+                continue
+
+            coordinates = parts[0].split("/")
+            if len(coordinates) == 3 and all(coordinate.isdigit() for coordinate in coordinates):
+                coordinates = [int(coordinate) for coordinate in coordinates]
+
+                if tile_storage.is_valid_tile(*coordinates):
+                    yield tile_storage.pack_key(*coordinates), parts[1]
+
+
+def open_manifest(path: str, file_ending: str):
+    """Returns a connection to the manifest of the pyramid at the given path, with a table of the packed keys (see
+    tile_storage.pack_key) and the status of all tiles which don't need to be fetched again.
+
+    A new manifest is filled from the text manifest of earlier versions, or if there is none (e.g. for a pyramid which
+    has been fetched before manifests were introduced) from the tiles which are already in the storage - a single scan
+    instead of a check per tile.
+    """
+
+    manifest_path = get_manifest_path(path)
+    is_new = not os.path.isfile(manifest_path)
+
+    connection = sqlite3.connect(manifest_path)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("CREATE TABLE IF NOT EXISTS tiles (key INTEGER PRIMARY KEY, status TEXT)")
+
+    if is_new:
+        legacy_manifest_path = get_manifest_path(path, LEGACY_MANIFEST_ENDING)
+
+        if os.path.isfile(legacy_manifest_path):
+            rows = read_legacy_manifest(legacy_manifest_path)
+        else:
+            # the keys are stored as unsigned 64 bit integers, sqlite's integers are signed - but the zoom level never
+            # reaches the highest bit (see tile_storage.MAX_ZOOM)
+            rows = ((key, MANIFEST_FETCHED) for key in tile_storage.get_storage(path, file_ending).get_tile_keys())
+
+        with connection:
+            connection.executemany("INSERT OR REPLACE INTO tiles (key, status) VALUES (?, ?)", rows)
+
+    return connection
+
+
+def is_in_manifest(manifest, zoom: int, tile_x: int, tile_y: int):
+    """Returns True if the given tile is in the given manifest (see open_manifest)"""
+
+    return manifest.execute("SELECT 1 FROM tiles WHERE key = ?",
+                            (tile_storage.pack_key(zoom, tile_x, tile_y),)).fetchone() is not None
+
+
+def fetch_and_store(fetch, storage, zoom: int, tile_x: int, tile_y: int):
+    """Fetches the given tile and writes it to the storage - runs in a worker thread.
+    Returns the manifest status of the tile, or None if it could not be fetched."""
+
+    try:
+        data = fetch_with_retries(fetch, zoom, tile_x, tile_y)
+    except Exception as error:
+        logger.error("Giving up tile {}/{}/{} after {} retries: {}".format(zoom, tile_x, tile_y, MAX_RETRIES, error))
+        return None
+
+    if data is None:
+        logger.debug("tile {}/{}/{} is not available".format(zoom, tile_x, tile_y))
+        return MANIFEST_MISSING
+
+    # the storage writes atomically, so an interrupted prefetch never leaves a truncated tile behind
+    try:
+        storage.write(zoom, tile_x, tile_y, data)
+    except (OSError, sqlite3.Error) as error:
+        logger.error("Tile {}/{}/{} could not be saved! Got error: {}".format(zoom, tile_x, tile_y, error))
+        return None
+
+    return MANIFEST_FETCHED
+
+
+def fetch_pyramid(tiles, fetch, path: str, file_ending: str, workers=DEFAULT_WORKERS):
+    """Fetches all given (zoom, tile_x, tile_y) tiles with fetch(zoom, tile_x, tile_y) - which returns the encoded
+    tile or None if it is not available - and stores them in the pyramid at the given path.
+
+    The downloads run in a pool of worker threads. Tiles which are in the manifest of the pyramid are skipped, and
+    every finished tile is added to it, so that the prefetch can be interrupted and resumed at any time. Tiles which
+    failed even after the retries are not added, so they are tried again in the next run.
+
+    Returns the number of fetched, missing, failed and skipped tiles as a dictionary.
+    """
+
+    storage = tile_storage.get_storage(path, file_ending)
+    statistics = {MANIFEST_FETCHED: 0, MANIFEST_MISSING: 0, "failed": 0, "skipped": 0}
+
+    # only a limited number of jobs is submitted at once, so that huge pyramids don't fill up the memory
+    max_pending = workers * 4
+
+    uncommitted = 0
+
+    def handle_finished(finished_jobs):
+        nonlocal uncommitted
+
+        for job in finished_jobs:
+            zoom, tile_x, tile_y = pending.pop(job)
+            status = job.result()
+
+            if status is None:
+                statistics["failed"] += 1
+            else:
+                statistics[status] += 1
+                manifest.execute("INSERT OR REPLACE INTO tiles (key, status) VALUES (?, ?)",
+                                 (tile_storage.pack_key(zoom, tile_x, tile_y), status))
+                uncommitted += 1
+
+        if uncommitted >= MANIFEST_COMMIT_INTERVAL:
+            manifest.commit()
+            uncommitted = 0
+
+    if isinstance(storage, tile_storage.DirectoryStorage):
+        os.makedirs(path, exist_ok=True)
+
+    manifest = open_manifest(path, file_ending)
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = {}
+
+            for zoom, tile_x, tile_y in tiles:
+                if is_in_manifest(manifest, zoom, tile_x, tile_y):
+                    statistics["skipped"] += 1
+                    continue
+
+                if len(pending) >= max_pending:
+                    finished_jobs, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    handle_finished(finished_jobs)
+
+                pending[executor.submit(fetch_and_store, fetch, storage, zoom, tile_x, tile_y)] = \
+                    (zoom, tile_x, tile_y)
+
+            handle_finished(wait(pending).done)
+    finally:
+        # the tiles which have been finished before an interruption are kept as well
+        manifest.commit()
+        manifest.close()
+
+    logger.info("fetched {} tiles into {}: {}".format(sum(statistics.values()), path, statistics))
+
+    return statistics
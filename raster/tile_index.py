@@ -0,0 +1,116 @@
+import logging
+import threading
+
+import numpy as np
+
+from raster.tile_storage import ZOOM_SHIFT, pack_key, get_storage
+
+logger = logging.getLogger(__name__)
+
+# all indices which have been built (or are being built) so far, by (pyramid path, file ending)
+indices = {}
+indices_lock = threading.Lock()
+
+
+class TileIndex:
+    """Knows which tiles exist in a pyramid, without touching its storage (see tile_storage) once it has been built.
+
+    The tiles found while scanning are stored as a sorted numpy array of packed keys (8 bytes per tile), tiles which
+    are added or removed later are kept in (small) sets. Until the scan is done, only the added tiles are known and
+    lowest_zoom is None, so callers have to check the storage for all other tiles in the meantime.
+    """
+
+    def __init__(self, path: str, file_ending: str):
+        self.path = path
+        self.file_ending = file_ending
+        self.scanned_keys = np.empty(0, dtype=np.uint64)
+        self.added_keys = set()
+        self.removed_keys = set()
+        self.lowest_zoom = None
+        self.is_built = False
+        self.lock = threading.Lock()
+
+    def build(self):
+        """Scans the pyramid storage and adds the tiles found there to this index"""
+
+        keys = get_storage(self.path, self.file_ending).get_tile_keys()
+
+        scanned_keys = np.frombuffer(keys, dtype=np.uint64).copy()
+        scanned_keys.sort()
+
+        with self.lock:
+            # tiles which have been added during the scan are kept, they might have been written after their folder
+            zoom_levels = [int(scanned_keys[0]) >> ZOOM_SHIFT] if len(scanned_keys) > 0 else []
+            zoom_levels.extend(key >> ZOOM_SHIFT for key in self.added_keys)
+
+            self.scanned_keys = scanned_keys
+            self.lowest_zoom = min(zoom_levels) if zoom_levels else None
+            self.is_built = True
+
+        logger.info("indexed {} tiles in {}".format(len(scanned_keys), self.path))
+
+    def contains(self, zoom: int, tile_x: int, tile_y: int):
+        """Returns True if the given tile is known to exist"""
+
+        key = pack_key(zoom, tile_x, tile_y)
+
+        if key in self.added_keys:
+            return True
+
+        if key in self.removed_keys:
+            return False
+
+        # the keys are replaced at once when the scan is done, so the same array has to be used for the whole lookup
+        scanned_keys = self.scanned_keys
+
+        position = np.searchsorted(scanned_keys, np.uint64(key))
+        return position < len(scanned_keys) and scanned_keys[position] == key
+
+    def add(self, zoom: int, tile_x: int, tile_y: int):
+        """Registers a tile which has been written to the pyramid"""
+
+        with self.lock:
+            key = pack_key(zoom, tile_x, tile_y)
+            self.added_keys.add(key)
+            self.removed_keys.discard(key)
+
+            # before the scan is done, the lowest zoom level of the added tiles says nothing about the pyramid
+            if self.is_built and (self.lowest_zoom is None or zoom < self.lowest_zoom):
+                self.lowest_zoom = zoom
+
+
+    def remove(self, zoom: int, tile_x: int, tile_y: int):
+        """Registers a tile which turned out not to exist (anymore), e.g. since it has been deleted by another
+        process or could not be read"""
+
+        with self.lock:
+            key = pack_key(zoom, tile_x, tile_y)
+            self.added_keys.discard(key)
+            self.removed_keys.add(key)
+
+
+def build_tile_index(index: TileIndex):
+    """Builds the given index, logging instead of raising errors since this runs in a thread of its own"""
+
+    try:
+        index.build()
+    except Exception:
+        logger.exception("Could not index the tiles in {}".format(index.path))
+
+
+def get_tile_index(path: str, file_ending: str):
+    """Returns the index of the pyramid at the given path. On first use, the index is built in the background and
+    returned right away (see TileIndex), so neither this caller nor the ones of other pyramids wait for the scan."""
+
+    index = indices.get((path, file_ending))
+
+    if index is None:
+        with indices_lock:
+            index = indices.get((path, file_ending))
+
+            if index is None:
+                index = TileIndex(path, file_ending)
+                indices[(path, file_ending)] = index
+                threading.Thread(target=build_tile_index, args=(index,), daemon=True).start()
+
+    return index
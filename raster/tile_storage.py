@@ -0,0 +1,340 @@
+import os
+import logging
+import sqlite3
+import threading
+from array import array
+from urllib.request import pathname2url
+
+from landscapelab import utils
+
+ZOOM_PATH = "{}"
+METER_X_PATH = utils.join_path(ZOOM_PATH, "{}")
+FULL_PATH = utils.join_path(METER_X_PATH, "{}.{}")
+
+# pyramids at a path with this ending are stored in a single MBTiles (SQLite) file instead of a directory
+MBTILES_ENDING = ".mbtiles"
+
+# the number of bytes of an MBTiles file which SQLite may map into memory for reading
+MBTILES_MMAP_SIZE = 1024 ** 3
+
+# the number of seconds to wait for a lock on an MBTiles file which is written by another process
+MBTILES_TIMEOUT = 30
+
+# bit layout of a packed tile key: 5 bits zoom | 29 bits x | 29 bits y (enough for zoom levels up to 28)
+ZOOM_SHIFT = 58
+X_SHIFT = 29
+COORDINATE_MASK = (1 << X_SHIFT) - 1
+MAX_ZOOM = 28
+
+# all storages which have been opened so far, by (pyramid path, file ending)
+storages = {}
+storages_lock = threading.Lock()
+
+logger = logging.getLogger(__name__)
+
+
+def is_valid_tile(zoom: int, tile_x: int, tile_y: int):
+    """Returns True if the given tile coordinates exist at their zoom level, which has to be at most MAX_ZOOM"""
+
+    return 0 <= zoom <= MAX_ZOOM and 0 <= tile_x < (1 << zoom) and 0 <= tile_y < (1 << zoom)
+
+
+def pack_key(zoom: int, tile_x: int, tile_y: int):
+    """Packs the given tile coordinates into a single integer key - raises a ValueError if they are not valid (see
+    is_valid_tile), since they would overlap with the bits of other coordinates"""
+
+    if not is_valid_tile(zoom, tile_x, tile_y):
+        raise ValueError("Invalid tile {}/{}/{}".format(zoom, tile_x, tile_y))
+
+    return (zoom << ZOOM_SHIFT) | (tile_x << X_SHIFT) | tile_y
+
+
+def unpack_key(key: int):
+    """Returns the zoom, tile x and tile y of the given packed key"""
+
+    key = int(key)
+    return key >> ZOOM_SHIFT, (key >> X_SHIFT) & COORDINATE_MASK, key & COORDINATE_MASK
+
+
+def get_storage(path: str, file_ending: str):
+    """Returns the storage of the pyramid at the given path - an MBTilesStorage if the path ends with MBTILES_ENDING,
+    a DirectoryStorage otherwise"""
+
+    storage = storages.get((path, file_ending))
+
+    if storage is None:
+        with storages_lock:
+            storage = storages.get((path, file_ending))
+
+            if storage is None:
+                if path.endswith(MBTILES_ENDING):
+                    storage = MBTilesStorage(path, file_ending)
+                else:
+                    storage = DirectoryStorage(path, file_ending)
+                storages[(path, file_ending)] = storage
+
+    return storage
+
+
+class DirectoryStorage:
+    """Stores the tiles of a pyramid as single files which are organized like this:
+    zoom level folders (containing) tile x folders (containing) tile y images
+    """
+
+    def __init__(self, path: str, file_ending: str):
+        self.path = path
+        self.file_ending = file_ending
+        self.full_path = utils.join_path(path, FULL_PATH)
+
+    def get_filename(self, zoom: int, tile_x: int, tile_y: int):
+        """Returns the filename of the given tile (which does not need to exist)"""
+
+        return self.full_path.format(zoom, tile_x, tile_y, self.file_ending)
+
+    def exists(self, zoom: int, tile_x: int, tile_y: int):
+        """Returns True if the given tile exists and is not empty (empty files are left behind by failed writes)"""
+
+        filename = self.get_filename(zoom, tile_x, tile_y)
+        return os.path.isfile(filename) and os.path.getsize(filename) > 0
+
+    def read(self, zoom: int, tile_x: int, tile_y: int):
+        """Returns the encoded content of the given tile, or None if it does not exist"""
+
+        try:
+            with open(self.get_filename(zoom, tile_x, tile_y), "rb") as tile_file:
+                return tile_file.read() or None
+        except FileNotFoundError:
+            return None
+
+    def write(self, zoom: int, tile_x: int, tile_y: int, data: bytes):
+        """Stores the encoded content of the given tile.
+
+        The data is written to a temporary file first, which is then renamed to the tile filename. Since the rename is
+        atomic, readers (including other server processes) never see a partially written tile.
+        """
+
+        filename = self.get_filename(zoom, tile_x, tile_y)
+        temporary_filename = "{}.{}-{}.tmp".format(filename, os.getpid(), threading.get_ident())
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+
+        try:
+            with open(temporary_filename, 'wb') as out_file:
+                out_file.write(data)
+
+                # Make sure that the file is completely written before it is moved into the pyramid
+                out_file.flush()
+                os.fsync(out_file.fileno())
+
+            # If another process has saved the same tile in the meantime, it is simply replaced by an identical one
+            os.replace(temporary_filename, filename)
+        except OSError:
+            if os.path.isfile(temporary_filename):
+                os.remove(temporary_filename)
+            raise
+
+    def write_many(self, tiles):
+        """Stores all given (zoom, tile_x, tile_y, data) tuples"""
+
+        for zoom, tile_x, tile_y, data in tiles:
+            self.write(zoom, tile_x, tile_y, data)
+
+    def delete(self, zoom: int, tile_x: int, tile_y: int):
+        """Removes the given tile from the pyramid, if it exists"""
+
+        try:
+            os.remove(self.get_filename(zoom, tile_x, tile_y))
+        except FileNotFoundError:
+            pass
+
+    def get_zoom_levels(self):
+        """Returns all zoom levels which are present in the pyramid"""
+
+        if not os.path.isdir(self.path):
+            return []
+
+        return [int(entry) for entry in os.listdir(self.path) if entry.isdigit()]
+
+    def get_tile_keys(self):
+        """Returns the packed keys (see pack_key) of all tiles in the pyramid as array('Q').
+
+        Empty files (which are left behind by failed writes of earlier versions) are not included, like in exists."""
+
+        suffix = "." + self.file_ending
+        keys = array('Q')  # 8 bytes per tile while scanning, instead of a list of python ints
+
+        if not os.path.isdir(self.path):
+            return keys
+
+        with os.scandir(self.path) as zoom_entries:
+            for zoom_entry in zoom_entries:
+                if not zoom_entry.name.isdigit() or not zoom_entry.is_dir():
+                    continue
+                zoom = int(zoom_entry.name)
+
+                with os.scandir(zoom_entry.path) as x_entries:
+                    for x_entry in x_entries:
+                        if not x_entry.name.isdigit() or not x_entry.is_dir():
+                            continue
+                        x_key = (zoom << ZOOM_SHIFT) | (int(x_entry.name) << X_SHIFT)
+
+                        with os.scandir(x_entry.path) as y_entries:
+                            for y_entry in y_entries:
+                                coordinate = y_entry.name[:-len(suffix)]
+                                if not y_entry.name.endswith(suffix) or not coordinate.isdigit():
+                                    continue
+
+                                try:
+                                    if y_entry.stat().st_size == 0:
+                                        continue
+                                except FileNotFoundError:
+                                    # removed while scanning
+                                    continue
+
+                                keys.append(x_key | int(coordinate))
+
+        return keys
+
+
+class MBTilesStorage:
+    """Stores the tiles of a pyramid in a single SQLite file according to the MBTiles specification
+    (https://github.com/mapbox/mbtiles-spec). Note that MBTiles uses TMS rows, so the y coordinate is flipped.
+
+    Every thread uses its own connection, which is read-only (and memory-mapped) until the thread writes, so that
+    existing files (e.g. read-only ones, or ones where tiles is a view) are served without being changed. Only files
+    without a tiles table get the schema and are put in WAL mode, so that reads are not blocked by writes.
+    """
+
+    def __init__(self, path: str, file_ending: str):
+        self.path = path
+        self.file_ending = file_ending
+        self.local = threading.local()
+
+    def get_connection(self, writable: bool = False):
+        """Returns the connection of the current thread (and process), which is opened on first use - read-only unless
+        writable is set. Returns None if the file doesn't exist and is only to be read."""
+
+        if getattr(self.local, "pid", None) != os.getpid():
+            self.local.connection = None
+            self.local.writable = False
+            self.local.pid = os.getpid()
+
+        if self.local.connection is None or (writable and not self.local.writable):
+            if writable:
+                connection = self.open_writable()
+            elif os.path.isfile(self.path):
+                connection = sqlite3.connect("file:{}?mode=ro".format(pathname2url(self.path)), uri=True,
+                                             timeout=MBTILES_TIMEOUT)
+            else:
+                return None
+
+            connection.execute("PRAGMA mmap_size={}".format(MBTILES_MMAP_SIZE))
+
+            if self.local.connection is not None:
+                self.local.connection.close()
+
+            self.local.connection = connection
+            self.local.writable = writable
+
+        return self.local.connection
+
+    def open_writable(self):
+        """Opens a new connection which may write to the file, which is created (with the MBTiles schema) if needed"""
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        connection = sqlite3.connect(self.path, timeout=MBTILES_TIMEOUT)
+
+        if connection.execute("SELECT 1 FROM sqlite_master WHERE name = 'tiles'").fetchone() is None:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT)")
+            connection.execute("CREATE TABLE IF NOT EXISTS tiles "
+                               "(zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)")
+            connection.execute("CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles "
+                               "(zoom_level, tile_column, tile_row)")
+            connection.execute("INSERT INTO metadata (name, value) SELECT 'format', ? WHERE NOT EXISTS "
+                               "(SELECT 1 FROM metadata WHERE name = 'format')", (self.file_ending,))
+            connection.commit()
+
+        return connection
+
+    def get_filename(self, zoom: int, tile_x: int, tile_y: int):
+        """Tiles in an MBTiles file don't have a filename of their own, so this always returns None"""
+
+        return None
+
+    def exists(self, zoom: int, tile_x: int, tile_y: int):
+        """Returns True if the given tile exists and is not empty"""
+
+        connection = self.get_connection()
+        if connection is None:
+            return False
+
+        return connection.execute(
+            "SELECT 1 FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ? AND length(tile_data) > 0",
+            (zoom, tile_x, (1 << zoom) - 1 - tile_y)).fetchone() is not None
+
+    def read(self, zoom: int, tile_x: int, tile_y: int):
+        """Returns the encoded content of the given tile, or None if it does not exist"""
+
+        connection = self.get_connection()
+        if connection is None:
+            return None
+
+        row = connection.execute(
+            "SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+            (zoom, tile_x, (1 << zoom) - 1 - tile_y)).fetchone()
+
+        return bytes(row[0]) if row and row[0] else None
+
+    def write(self, zoom: int, tile_x: int, tile_y: int, data: bytes):
+        """Stores the encoded content of the given tile in a transaction of its own"""
+
+        self.write_many([(zoom, tile_x, tile_y, data)])
+
+    def write_many(self, tiles):
+        """Stores all given (zoom, tile_x, tile_y, data) tuples in a single transaction"""
+
+        connection = self.get_connection(writable=True)
+
+        with connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?)",
+                ((zoom, tile_x, (1 << zoom) - 1 - tile_y, sqlite3.Binary(data)) for zoom, tile_x, tile_y, data in tiles))
+
+    def delete(self, zoom: int, tile_x: int, tile_y: int):
+        """Removes the given tile from the pyramid, if it exists"""
+
+        if not os.path.isfile(self.path):
+            return
+
+        connection = self.get_connection(writable=True)
+
+        with connection:
+            connection.execute("DELETE FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                               (zoom, tile_x, (1 << zoom) - 1 - tile_y))
+
+    def get_zoom_levels(self):
+        """Returns all zoom levels which are present in the pyramid"""
+
+        connection = self.get_connection()
+        if connection is None:
+            return []
+
+        return [row[0] for row in connection.execute("SELECT DISTINCT zoom_level FROM tiles")]
+
+    def get_tile_keys(self):
+        """Returns the packed keys (see pack_key) of all tiles in the pyramid as array('Q')"""
+
+        keys = array('Q')
+
+        connection = self.get_connection()
+        if connection is None:
+            return keys
+
+        keys.extend((zoom << ZOOM_SHIFT) | (tile_x << X_SHIFT) | ((1 << zoom) - 1 - tile_row)
+                    for zoom, tile_x, tile_row in connection.execute(
+                        "SELECT zoom_level, tile_column, tile_row FROM tiles WHERE length(tile_data) > 0"))
+
+        return keys
@@ -1,20 +1,57 @@
-import os
+import sqlite3
+import threading
 import webmercator
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
 from PIL import Image
 
-from landscapelab import utils
-from raster import epx
+from raster import epx, tile_checks, tile_index, tile_storage
+from raster.tile_storage import pack_key
 from django.contrib.gis.geos import Point
 from location.models import Scenario
 from assetpos.models import Tile
 
-ZOOM_PATH = "{}"
-METER_X_PATH = utils.join_path(ZOOM_PATH, "{}")
-FULL_PATH = utils.join_path(METER_X_PATH, "{}.{}")
-
 MAX_STEP_NUMBER = 8
 
+# if True, the existence of tiles is looked up in an in-memory index of each pyramid instead of the filesystem
+USE_TILE_INDEX = True
+
+# if True, the tiles between the nearest existing ancestor and a requested tile are saved as well,
+# since neighbouring requests are likely to need them - this happens in the background
+MATERIALIZE_INTERMEDIATE_TILES = True
+
+# if True, the other three quarters of every parent which has been decoded for a requested tile are saved as well
+MATERIALIZE_SIBLING_TILES = True
+
+# the number of zoom levels above a requested tile which are generated from it in the background (0 for none)
+MATERIALIZE_DESCENDANT_LEVELS = 0
+
+# if True, tiles which would be cropped from an incomplete part of their ancestor (see tile_checks.is_incomplete)
+# are not saved, e.g. for pyramids which are combined from several sources
+REJECT_INCOMPLETE_TILES = False
+
+materialize_executor = ThreadPoolExecutor(max_workers=2)
+
+# the maximum number of materializations which are waiting for (or running in) the materialize_executor - while that
+# many are pending, further ones are skipped, since the tiles can still be cropped when they are requested
+MAX_QUEUED_MATERIALIZATIONS = 64
+
+# the pending materializations, by (kind, pyramid path, file ending, zoom, x, y) of the tile they start from
+queued_materializations = set()
+queued_materializations_lock = threading.Lock()
+
+# the lowest zoom level of each pyramid, by pyramid path
+lowest_zoom_levels = {}
+
+# the tiles which are currently being generated, by (pyramid path, file ending, zoom, x, y)
+# other threads which need one of these tiles wait for the event instead of generating it again
+tiles_in_generation = {}
+tiles_in_generation_lock = threading.Lock()
+
+# the maximum number of seconds to wait for a tile which is generated by another thread
+GENERATION_TIMEOUT = 30
+
 logger = logging.getLogger(__name__)
 
 
@@ -26,192 +63,478 @@ def get_tile(meter_x: float, meter_y: float, zoom: int, path: str, do_epx_scale=
     The given path must lead to a tile directory. This means that the content of this directory must be organized like
     this:
     zoom level folders (containing) tile x folders (containing) tile y images
+    Pyramids in an MBTiles file (see tile_storage) are supported as well, but since their tiles have no path of their
+    own, None is returned for them - use get_tile_at and read the tile from the storage instead.
 
     If such a tile does not exist, it is created by cropping lower LOD tiles.
+    Raises a ValueError if the coordinates are outside of the tile grid (see tile_storage.is_valid_tile).
     """
 
-    return get_cropped_recursively(meter_x, meter_y, zoom, path, 0, do_epx_scale, file_ending)
+    this_point = webmercator.Point(meter_x=meter_x, meter_y=meter_y, zoom_level=zoom)
+
+    return get_tile_at(this_point.tile_x, this_point.tile_y, zoom, path, do_epx_scale, file_ending)
 
 
-def get_cropped_recursively(meter_x: float, meter_y: float, zoom: int, path: str, steps: int, do_epx_scale: bool,
-                            file_ending: str):
-    """Recursively crops tiles until the required one has been generated.
+def get_tile_at(tile_x: int, tile_y: int, zoom: int, path: str, do_epx_scale=False, file_ending="png"):
+    """Returns the path to the tile with the given tile coordinates, creating it from its nearest existing ancestor if
+    necessary.
 
-    To prevent a stack overflow, the steps are limited to MAX_STEP_NUMBER.
+    The ancestor is searched for at most MAX_STEP_NUMBER zoom levels below the requested one. It is opened only once
+    and the requested tile is cropped from it in memory, so only a single file is written on the request path. If
+    MATERIALIZE_INTERMEDIATE_TILES is set, the tiles in between are saved in the background.
+    Raises a ValueError if the tile does not exist in the tile grid (see tile_storage.is_valid_tile).
     """
 
-    if steps >= MAX_STEP_NUMBER:
-        # No tile that could be cropped has been found for the set MAX_STEP_NUMBER
-        logger.error("{}: No tile could be found or created (tried from zoom {} down to {}) at location {}, {}!"
+    if not tile_storage.is_valid_tile(zoom, tile_x, tile_y):
+        raise ValueError("Invalid tile {}/{}/{}".format(zoom, tile_x, tile_y))
+
+    filename = tile_storage.get_storage(path, file_ending).get_filename(zoom, tile_x, tile_y)
+
+    if tile_exists(path, zoom, tile_x, tile_y, file_ending):
+        return filename
+
+    ancestor_zoom = find_nearest_ancestor_zoom(tile_x, tile_y, zoom, path, file_ending)
+
+    if ancestor_zoom is None:
+        # No tile that could be cropped has been found within MAX_STEP_NUMBER levels
+        logger.error("{}: No tile could be found or created (tried from zoom {} down to {}) at tile {}, {}!"
                      " Possible causes: Missing data, wrong path, no write permissions"
-                     .format(path, zoom + steps, zoom, meter_x, meter_y))
+                     .format(path, zoom, zoom - MAX_STEP_NUMBER, tile_x, tile_y))
         return None
 
-    full_path = utils.join_path(path, FULL_PATH)
+    generate_tile_once(path, zoom, tile_x, tile_y, file_ending, crop_from_ancestor,
+                       tile_x, tile_y, zoom, ancestor_zoom, path, do_epx_scale, file_ending)
 
-    this_point = webmercator.Point(meter_x=meter_x, meter_y=meter_y, zoom_level=zoom)
-    this_point_filename = full_path.format(zoom, this_point.tile_x, this_point.tile_y, file_ending)
+    return filename
+
+
+def generate_tile_once(path: str, zoom: int, tile_x: int, tile_y: int, file_ending: str, generate, *args):
+    """Calls generate(*args) to create the given tile, unless it is already being generated by another thread - in
+    that case, this waits until the other thread is done (but at most GENERATION_TIMEOUT seconds).
+
+    This way, a burst of requests for the same missing tile only crops and writes it once.
+    """
+
+    key = (path, file_ending, zoom, tile_x, tile_y)
+
+    with tiles_in_generation_lock:
+        done_event = tiles_in_generation.get(key)
+        is_generating_thread = done_event is None
+
+        if is_generating_thread:
+            done_event = threading.Event()
+            tiles_in_generation[key] = done_event
+
+    if not is_generating_thread:
+        if not done_event.wait(GENERATION_TIMEOUT):
+            logger.warning("Timed out while waiting for tile {} to be generated".format(key))
+        return
+
+    try:
+        # The tile might have been finished by another thread right before we started generating it
+        if not tile_exists(path, zoom, tile_x, tile_y, file_ending):
+            generate(*args)
+    finally:
+        with tiles_in_generation_lock:
+            del tiles_in_generation[key]
+        done_event.set()
+
+
+def tile_exists(path: str, zoom: int, tile_x: int, tile_y: int, file_ending: str):
+    """Returns True if the given tile exists in the pyramid at the given path and is not empty (empty files are left
+    behind by failed writes).
+
+    If USE_TILE_INDEX is set, tiles are looked up in the in-memory index of the pyramid first. Tiles which are not in
+    the index are still checked in the storage, since they might have been added by another process (e.g. a
+    prefetch command).
+    """
+
+    index = tile_index.get_tile_index(path, file_ending) if USE_TILE_INDEX else None
+
+    if index is not None and index.contains(zoom, tile_x, tile_y):
+        return True
+
+    if tile_storage.get_storage(path, file_ending).exists(zoom, tile_x, tile_y):
+        if index is not None:
+            index.add(zoom, tile_x, tile_y)
+        return True
+
+    return False
+
+
+def find_nearest_ancestor_zoom(tile_x: int, tile_y: int, zoom: int, path: str, file_ending: str):
+    """Returns the highest zoom level below the given one at which an ancestor of the given tile exists, or None if
+    there is no such ancestor within MAX_STEP_NUMBER levels.
+
+    If USE_TILE_INDEX is set, the levels are looked up in the in-memory index from the top down first. Otherwise (or
+    if the index doesn't know any ancestor), the storage is searched: an area of a pyramid is filled from its lowest
+    zoom level upwards, so an existing ancestor implies that all of its own ancestors down to that lowest level exist
+    as well, which allows a binary search over the levels. Since areas can start deeper than the lowest zoom level of
+    the whole pyramid (e.g. when they were prefetched with a different zoom range), the levels are checked one by one
+    from the top down if there is no ancestor at the lowest level.
+    """
+
+    def ancestor_exists(ancestor_zoom):
+        steps = zoom - ancestor_zoom
+        return tile_exists(path, ancestor_zoom, tile_x >> steps, tile_y >> steps, file_ending)
+
+    lowest = max(zoom - MAX_STEP_NUMBER, get_lowest_zoom_level(path, file_ending))
+    if lowest >= zoom:
+        return None
+
+    if USE_TILE_INDEX:
+        index = tile_index.get_tile_index(path, file_ending)
+
+        for ancestor_zoom in range(zoom - 1, lowest - 1, -1):
+            steps = zoom - ancestor_zoom
+            if index.contains(ancestor_zoom, tile_x >> steps, tile_y >> steps):
+                return ancestor_zoom
+
+    if not ancestor_exists(lowest):
+        for ancestor_zoom in range(zoom - 1, lowest, -1):
+            if ancestor_exists(ancestor_zoom):
+                return ancestor_zoom
+
+        return None
+
+    # Invariant: the ancestor at 'lowest' exists, everything above 'highest' does not
+    highest = zoom - 1
+    while lowest < highest:
+        middle = (lowest + highest + 1) // 2
+        if ancestor_exists(middle):
+            lowest = middle
+        else:
+            highest = middle - 1
+
+    return lowest
+
+
+def get_lowest_zoom_level(path: str, file_ending: str):
+    """Returns the lowest zoom level which is present in the pyramid at the given path.
+
+    Derived tiles are only ever added above the existing levels, so the result is cached per pyramid.
+    """
+
+    if USE_TILE_INDEX:
+        lowest_zoom = tile_index.get_tile_index(path, file_ending).lowest_zoom
+        if lowest_zoom is not None:
+            return lowest_zoom
+
+    if path not in lowest_zoom_levels:
+        zoom_levels = tile_storage.get_storage(path, file_ending).get_zoom_levels()
+
+        if not zoom_levels:
+            # Don't cache this - the pyramid might not have been fetched yet
+            return 0
+
+        lowest_zoom_levels[path] = min(zoom_levels)
+
+    return lowest_zoom_levels[path]
+
+
+def crop_from_ancestor(tile_x: int, tile_y: int, zoom: int, ancestor_zoom: int, path: str, do_epx_scale: bool,
+                       file_ending: str):
+    """Creates the tile at the given tile coordinates from its (existing) ancestor at ancestor_zoom.
+
+    The ancestor is cropped quarter by quarter in memory, exactly like cropping one level after the other on disk
+    would, so that the result does not depend on which intermediate tiles already existed.
+
+    Only the requested tile is cropped and saved right away. The other tiles which can be cut from the decoded images
+    (see MATERIALIZE_INTERMEDIATE_TILES, MATERIALIZE_SIBLING_TILES and MATERIALIZE_DESCENDANT_LEVELS) are saved in the
+    background, so that a client panning over neighbouring tiles doesn't cause the same parent to be decoded again.
+    """
+
+    image = open_tile_image(path, ancestor_zoom, tile_x >> (zoom - ancestor_zoom), tile_y >> (zoom - ancestor_zoom),
+                            file_ending)
+    if image is None:
+        return
+
+    # the decoded parent images on the way to the requested tile, with the child which has been cropped from them
+    parents = []
+
+    for current_zoom in range(ancestor_zoom + 1, zoom + 1):
+        steps = zoom - current_zoom
+        parent_image = image
+        image = crop_quarter(parent_image, tile_x >> steps, tile_y >> steps, do_epx_scale)
+
+        if image is None:
+            logger.warning("Ancestor of tile {}/{}/{} in {} was too small, not proceeding!"
+                           .format(zoom, tile_x, tile_y, path))
+            return
+
+        parents.append((parent_image, current_zoom - 1, tile_x >> (steps + 1), tile_y >> (steps + 1),
+                        {(tile_x >> steps, tile_y >> steps): image}))
 
-    if not os.path.isfile(this_point_filename) or (os.path.getsize(this_point_filename) == 0):
-        prev_point = webmercator.Point(meter_x=meter_x, meter_y=meter_y, zoom_level=zoom - 1)
-        prev_point_filename = full_path.format(zoom, prev_point.tile_x, prev_point.tile_y, file_ending)
+    if REJECT_INCOMPLETE_TILES and tile_checks.is_incomplete_image(image):
+        logger.warning("Ancestor of tile {}/{}/{} in {} is incomplete, not proceeding!"
+                       .format(zoom, tile_x, tile_y, path))
+        return
+
+    save_tile_image(image, path, zoom, tile_x, tile_y, file_ending)
+
+    for parent_image, parent_zoom, parent_x, parent_y, cropped_children in parents:
+        submit_materialization(("children", path, file_ending, parent_zoom, parent_x, parent_y), materialize_children,
+                               parent_image, parent_x, parent_y, parent_zoom, cropped_children, parent_zoom + 1 < zoom,
+                               path, do_epx_scale, file_ending)
+
+    if MATERIALIZE_DESCENDANT_LEVELS > 0:
+        submit_materialization(("descendants", path, file_ending, zoom, tile_x, tile_y),
+                               generate_descendants_from_image, image, tile_x, tile_y, zoom,
+                               zoom + MATERIALIZE_DESCENDANT_LEVELS, path, do_epx_scale, file_ending)
+
+
+def submit_materialization(key: tuple, materialize, *args):
+    """Calls materialize(*args) in the background (see materialize_executor) and returns True, unless a
+    materialization with the same key is already pending or MAX_QUEUED_MATERIALIZATIONS are pending.
+
+    This way, a burst of requests neither queues the same parent many times nor holds an unbounded number of decoded
+    images in memory."""
+
+    with queued_materializations_lock:
+        if key in queued_materializations or len(queued_materializations) >= MAX_QUEUED_MATERIALIZATIONS:
+            return False
+
+        queued_materializations.add(key)
+
+    def run():
+        try:
+            materialize(*args)
+        except Exception:
+            logger.exception("Materializing tiles from {} failed".format(key))
+        finally:
+            with queued_materializations_lock:
+                queued_materializations.discard(key)
+
+    materialize_executor.submit(run)
+
+    return True
+
+
+def materialize_children(parent_image: Image, parent_x: int, parent_y: int, parent_zoom: int, cropped_children: dict,
+                         is_intermediate: bool, path: str, do_epx_scale: bool, file_ending: str):
+    """Saves those children of the given parent which are missing in the pyramid, according to the
+    MATERIALIZE_INTERMEDIATE_TILES and MATERIALIZE_SIBLING_TILES settings. Runs in the background.
+
+    cropped_children holds the child which has already been cropped on the way to the requested tile (by its tile
+    coordinates) - it is an intermediate tile if is_intermediate is True, otherwise it is the requested tile itself.
+    """
+
+    for child_y in (parent_y * 2, parent_y * 2 + 1):
+        for child_x in (parent_x * 2, parent_x * 2 + 1):
+            if (child_x, child_y) in cropped_children:
+                if not (is_intermediate and MATERIALIZE_INTERMEDIATE_TILES):
+                    continue
+                child_image = cropped_children[(child_x, child_y)]
+            elif MATERIALIZE_SIBLING_TILES:
+                child_image = None
+            else:
+                continue
+
+            generate_tile_once(path, parent_zoom + 1, child_x, child_y, file_ending, save_cropped_child,
+                               parent_image, child_image, child_x, child_y, parent_zoom + 1, path, do_epx_scale,
+                               file_ending)
+
+
+def save_cropped_child(parent_image: Image, child_image: Image, child_x: int, child_y: int, zoom: int, path: str,
+                       do_epx_scale: bool, file_ending: str):
+    """Saves the given child image, cropping it from the parent image first if it is None"""
+
+    if child_image is None:
+        child_image = crop_quarter(parent_image, child_x, child_y, do_epx_scale)
+
+    if child_image is not None and not (REJECT_INCOMPLETE_TILES and tile_checks.is_incomplete_image(child_image)):
+        save_tile_image(child_image, path, zoom, child_x, child_y, file_ending)
+
+
+def generate_descendants(tile_x: int, tile_y: int, zoom: int, target_zoom: int, path: str, do_epx_scale: bool,
+                         file_ending: str, tile_filter=None):
+    """Generates all missing descendants of the given (existing) tile up to target_zoom and returns their number.
+
+    Every tile is decoded at most once: all four children are cut from their parent in the same pass, and generated
+    children are passed on to the next level in memory. Children which already exist are read from disk instead, since
+    they might contain more detailed source data.
+
+    If a tile_filter is given, only children for which tile_filter(tile_x, tile_y, zoom) is True are generated.
+    """
+
+    image = open_tile_image(path, zoom, tile_x, tile_y, file_ending)
+    if image is None:
+        return 0
+
+    return generate_descendants_from_image(image, tile_x, tile_y, zoom, target_zoom, path, do_epx_scale, file_ending,
+                                           tile_filter)
+
+
+def generate_descendants_from_image(image: Image, tile_x: int, tile_y: int, zoom: int, target_zoom: int, path: str,
+                                    do_epx_scale: bool, file_ending: str, tile_filter=None):
+    """Like generate_descendants, but starting from the already decoded image of the given tile"""
+
+    generated = 0
+
+    if zoom >= target_zoom:
+        return generated
+
+    for (child_x, child_y), child_image in crop_children(image, tile_x, tile_y, do_epx_scale).items():
+        if tile_filter is not None and not tile_filter(child_x, child_y, zoom + 1):
+            continue
+
+        if tile_exists(path, zoom + 1, child_x, child_y, file_ending):
+            child_image = open_tile_image(path, zoom + 1, child_x, child_y, file_ending)
+        elif child_image is not None:
+            save_tile_image(child_image, path, zoom + 1, child_x, child_y, file_ending)
+            generated += 1
 
-        if not os.path.isfile(prev_point_filename) or (os.path.getsize(prev_point_filename) == 0):
-            get_cropped_recursively(meter_x, meter_y, zoom - 1, path, steps + 1, do_epx_scale, file_ending)
+        if child_image is not None:
+            generated += generate_descendants_from_image(child_image, child_x, child_y, zoom + 1, target_zoom, path,
+                                                         do_epx_scale, file_ending, tile_filter)
 
-        get_cropped_for_next_tile(meter_x, meter_y, zoom - 1, path, do_epx_scale, file_ending)
+    return generated
 
-    return this_point_filename
 
+def crop_children(image: Image, tile_x: int, tile_y: int, do_epx_scale: bool):
+    """Returns the images of all four children of the tile with the given image, by their tile coordinates.
+    Children which could not be cropped (since the image is too small) are None."""
 
-def get_cropped_for_next_tile(meter_x: float, meter_y: float, zoom: int, path: str, do_epx_scale: bool,
-                              file_ending: str):
-    """Takes the tile at the given parameters (which must exist!) and crops it to create a tile one zoom level above
-    the given one. This new tile is then saved in the LOD pyramid.
+    return {(child_x, child_y): crop_quarter(image, child_x, child_y, do_epx_scale)
+            for child_y in (tile_y * 2, tile_y * 2 + 1)
+            for child_x in (tile_x * 2, tile_x * 2 + 1)}
+
+
+def open_tile_image(path: str, zoom: int, tile_x: int, tile_y: int, file_ending: str):
+    """Returns the decoded image of the given tile, or None if it could not be opened"""
+
+    try:
+        data = tile_storage.get_storage(path, file_ending).read(zoom, tile_x, tile_y)
+        if data is None:
+            raise OSError("the tile does not exist")
+
+        image = Image.open(BytesIO(data))
+        image.load()
+    except (OSError, sqlite3.Error) as error:
+        logger.error("Error while opening image {}/{}/{} in {}: {}".format(zoom, tile_x, tile_y, path, error))
+        forget_tile(path, zoom, tile_x, tile_y, file_ending)
+        return None
+
+    return image
+
+
+def forget_tile(path: str, zoom: int, tile_x: int, tile_y: int, file_ending: str):
+    """Removes the given tile from the index of its pyramid (see USE_TILE_INDEX) after reading it failed, so that it is
+    looked up in the storage again (and regenerated if it is missing) the next time"""
+
+    if USE_TILE_INDEX:
+        tile_index.get_tile_index(path, file_ending).remove(zoom, tile_x, tile_y)
+
+
+def crop_quarter(image: Image, wanted_tile_x: int, wanted_tile_y: int, do_epx_scale: bool):
+    """Returns the quarter of the given image which corresponds to the wanted tile one zoom level above, or None if
+    the image is too small to be cropped.
 
     The quarter of the existing tile to crop to is chosen by utilizing how tile coordinates work in OSM:
     2x,2y    2x+1,2y
     2x,2y+1  2x+1,2y+1
     """
 
-    p_wanted = webmercator.Point(meter_x=meter_x, meter_y=meter_y, zoom_level=zoom + 1)
-    p_available = webmercator.Point(meter_x=meter_x, meter_y=meter_y, zoom_level=zoom)
-
-    if p_wanted.tile_x % 2 == 0:
+    if wanted_tile_x % 2 == 0:
         left_right = [0, 0.5]
     else:
         left_right = [0.5, 1]
 
-    if p_wanted.tile_y % 2 == 0:
+    if wanted_tile_y % 2 == 0:
         upper_lower = [0, 0.5]
     else:
         upper_lower = [0.5, 1]
 
-    zoom_path_template = utils.join_path(path, ZOOM_PATH)
-    x_path_template = utils.join_path(path, METER_X_PATH)
-    full_path_template = utils.join_path(path, FULL_PATH)
-
-    available_filename = full_path_template.format(zoom, p_available.tile_x, p_available.tile_y, file_ending)
-    wanted_filename = full_path_template.format(zoom + 1, p_wanted.tile_x, p_wanted.tile_y, file_ending)
-
-    if not os.path.isfile(available_filename):
-        # Nothing here yet - we might recurse further in get_cropped_recursively
-        return
-
-    x_path = x_path_template.format(zoom + 1, p_wanted.tile_x)
-    os.makedirs(x_path, exist_ok=True)
-
-    try:
-        # Wait for access to the file to become available - in case the image is still being written to
-        while True:
-            try:
-                os.rename(available_filename, available_filename)
-                break
-            except OSError as e:
-                pass
-    
-        available_image = Image.open(available_filename)
-    except OSError as error:
-        logger.error("OSError while opening image: {}".format(error))
-        return
-    except Error as error:
-        logger.error("Other Error while opening image: {}".format(error))
-        return
-    
-    # PIL needs the image to be in RGB mode for processing - convert it if necessary
-    original_image_mode = available_image.mode
-    if original_image_mode != "RGB":
-        available_image.convert('RGB')
-
-    available_size = tuple(available_image.size)
+    available_size = tuple(image.size)
 
     # If the available image is smaller than 2x2, this won't work
     if available_size[0] < 2:
-        logger.warning("Image {} was too small, not proceeding!".format(available_filename))
-        return
+        return None
 
-    wanted_image = available_image.crop((int(left_right[0] * available_size[0]),
-                                         int(upper_lower[0] * available_size[1]),
-                                         int(left_right[1] * available_size[0]),
-                                         int(upper_lower[1] * available_size[1])))
+    wanted_image = image.crop((int(left_right[0] * available_size[0]),
+                               int(upper_lower[0] * available_size[1]),
+                               int(left_right[1] * available_size[0]),
+                               int(upper_lower[1] * available_size[1])))
 
     if do_epx_scale:
         wanted_image = epx.scale_epx(wanted_image)
 
-    # If the image has been converted to RGB for processing, convert it back to the original mode
-    if original_image_mode != wanted_image.mode:
-        wanted_image.convert(original_image_mode)
+    return wanted_image
+
+
+def save_tile_image(image: Image, path: str, zoom: int, tile_x: int, tile_y: int, file_ending: str):
+    """Saves the given image as the given tile in the storage of the pyramid at path (see tile_storage), which makes
+    sure that readers never see a partially written tile."""
 
-    # It is possible that in the time since we last checked whether the image exists,
-    #  the same request was handled in another thread. This means that the image already
-    #  exists at this point. This error doesn't matter; in any case, the image exists
-    try:
-        out_file = open(wanted_filename, 'wb')
-    except OSError as error:
-        logger.error("OSError: Could not open new image file {}. Got error: {}".format(available_filename, error))
-    except IOError as error:
-        logger.error("IOError: Could not open new image file {}. Got error: {}".format(available_filename, error))
-       
     try:
-        wanted_image.save(out_file)
-        wanted_image.close()
+        data = BytesIO()
+        image.save(data, format=Image.registered_extensions()["." + file_ending])
+
+        tile_storage.get_storage(path, file_ending).write(zoom, tile_x, tile_y, data.getvalue())
 
-        # Make sure that the file is completely written and closed - otherwise the client
-        #  may try to open an image which is still unfinished
-        out_file.flush()
-        os.fsync(out_file.fileno())
-        out_file.close()
+        if USE_TILE_INDEX:
+            tile_index.get_tile_index(path, file_ending).add(zoom, tile_x, tile_y)
 
-        logger.debug("Done saving image {}".format(wanted_filename))
-    except IOError as error:
-        logger.warning("IOError: Image {} could not be saved! This could be due to another thread having saved it earlier, "
-                       "in which case it is not an issue. Error: {}".format(wanted_filename, error))
-    except OSError as error:
-        logger.error("OSError: Could not save file {} - this file does not seem valid. Got error: {}".format(available_filename, error))
+        logger.debug("Done saving image {}/{}/{} in {}".format(zoom, tile_x, tile_y, path))
+    except (OSError, sqlite3.Error) as error:
+        logger.error("Image {}/{}/{} in {} could not be saved! Got error: {}".format(zoom, tile_x, tile_y, path, error))
 
 
 # returns the highest LOD (or LOD = max_lod) tile that contains the specified location
 # if the LOD is not high enough new tiles will be generated
-# TODO binary search for the highest currently existing tile could significantly increase performance
+# all existing ancestors of the location are looked up with a single query on the (indexed) tile keys
 def get_highest_lod_tile(location: Point, parent_tile: Tile, min_lod: int, max_lod: int = 28):
-    # break recursion if LOD has reached
-    # the specified max value
+    # break if LOD has reached the specified max value
     if parent_tile.lod >= max_lod:
         return parent_tile
 
-    # get x and y coordinate for the next lod and look for a matching tile
-    x, y = get_corresponding_tile_coordinates(location, parent_tile.lod + 1)
-    child_tile = Tile.objects.filter(x=x, y=y, lod=parent_tile.lod + 1)
+    # the keys of the tiles containing the location from the parent tile up to max_lod
+    keys = [pack_key(lod, *get_corresponding_tile_coordinates(location, lod))
+            for lod in range(parent_tile.lod + 1, max_lod + 1)]
+    highest_tile = Tile.objects.filter(scenario_id=parent_tile.scenario_id, key__in=keys).order_by('-lod').first()
 
-    # if no matching tile could be found
-    # check if the LOD is high enough
-    if not child_tile:
-        if parent_tile.lod >= min_lod:
-            # return if LOD is high enough
-            return parent_tile
+    if highest_tile is None:
+        highest_tile = parent_tile
 
-        else:
-            # create missing LODs if it is not high enough
-            return generate_remaining_sub_tiles(parent_tile, location, min_lod)
+    # create missing LODs if it is not high enough
+    if highest_tile.lod < min_lod:
+        return generate_remaining_sub_tiles(highest_tile, location, min_lod)
 
-    # continue recursion until the highest LOD tile is found
-    return get_highest_lod_tile(location, child_tile.first(), min_lod, max_lod)
+    return highest_tile
 
 
-# recursively generates sub-tiles, from one specific tile with low LOD until
+# generates the sub-tiles containing the location, from one specific tile with low LOD until
 # the LOD hits the specified target_lod
 # the last generated Tile will be returned
 def generate_remaining_sub_tiles(parent_tile: Tile, location: Point, target_lod: int):
-    # break recursion and return highest LOD tile if LOD is high enough
+    # return the parent tile if LOD is already high enough
     if parent_tile.lod >= target_lod:
         return parent_tile
 
-    # generate tile with higher LOD
-    x, y = get_corresponding_tile_coordinates(location, parent_tile.lod + 1)
-    child_tile = generate_sub_tile(x, y, parent_tile)
+    # insert all missing levels at once (tiles which have been created concurrently are skipped)
+    new_tiles = []
+    for lod in range(parent_tile.lod + 1, target_lod + 1):
+        x, y = get_corresponding_tile_coordinates(location, lod)
+        new_tiles.append(Tile(scenario_id=parent_tile.scenario_id, x=x, y=y, lod=lod, key=pack_key(lod, x, y)))
+
+    Tile.objects.bulk_create(new_tiles, ignore_conflicts=True)
+
+    # the ids of the new tiles are not known after an insert which ignores conflicts, so they are loaded again
+    # and linked to their parents
+    tiles = list(Tile.objects.filter(scenario_id=parent_tile.scenario_id, key__in=[tile.key for tile in new_tiles])
+                 .order_by('lod'))
+
+    unlinked_tiles = []
+    for parent, child in zip([parent_tile] + tiles, tiles):
+        if child.parent_id is None:
+            child.parent = parent
+            unlinked_tiles.append(child)
 
-    # continue recursion until LOD is high enough
-    return generate_remaining_sub_tiles(child_tile, location, target_lod)
+    Tile.objects.bulk_update(unlinked_tiles, ['parent'])
+
+    # TODO move assets that are in parent and child to child
+
+    return tiles[-1]
 
 
 # generates a child-tile of specified parent-tile
@@ -224,22 +547,15 @@ def generate_sub_tile(x, y, parent: Tile):
     return child
 
 
-# returns the root tile of specified scenario
+# returns the root tile of specified scenario (the tile with LOD 0, which is its own parent)
+# it is created if it doesn't exist yet
 def get_root_tile(scenario: Scenario):
-    # return Tile.objects.get(scenario=scenario, parent='self') # this apparently does not work
-    # TODO maybe find a more efficient solution (may be possible with simple statement like in comment above)
-
-    # find tile with
-    tiles = Tile.objects.filter(scenario=scenario, x=0, y=0, lod=0)
-    for tile in tiles:
-        if tile.pk == tile.parent.pk:
-            return tile
-
-    # create a new root tile if none could be found
-    tile = Tile(scenario=scenario, x=0, y=0, lod=0)
-    tile.save()
-    tile.parent = tile
-    tile.save()
+    tile, created = Tile.objects.get_or_create(scenario=scenario, key=pack_key(0, 0, 0),
+                                               defaults={'x': 0, 'y': 0, 'lod': 0})
+
+    if tile.parent_id is None:
+        tile.parent = tile
+        tile.save(update_fields=['parent'])
 
     return tile
 
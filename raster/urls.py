@@ -4,6 +4,9 @@ from . import views
 
 urlpatterns = [
 
+    # get the filenames of the pyramid tiles for a list of locations which is posted as json
+    url(r'^batch.json$', views.get_ortho_dhm_batch, name="get_ortho_and_dhm_batch"),
+
     # deliver a static raster image by given filename
     url(r'^(?P<filename>[\w,\s-]+\.[A-Za-z]{2,4})$', views.static_raster, name="static_raster"),
 
@@ -11,6 +14,15 @@ urlpatterns = [
     # this also triggers the on-demand calculation of the required
     # height data and splatmaps - will return an according json
     url(r'^(?P<meter_x>(\d+(?:\.\d+)))/(?P<meter_y>(\d+(?:\.\d+)))/(?P<zoom>(\d+)).json$',
-        views.get_ortho_dhm, name="get_ortho_and_dhm")
+        views.get_ortho_dhm, name="get_ortho_and_dhm"),
+
+    # get the filenames of all pyramid tiles within an extent (min_x/min_y/max_x/max_y) and zoom range
+    url(r'^extent/(?P<min_x>(\d+(?:\.\d+)))/(?P<min_y>(\d+(?:\.\d+)))/(?P<max_x>(\d+(?:\.\d+)))/'
+        r'(?P<max_y>(\d+(?:\.\d+)))/(?P<zoom_from>(\d+))/(?P<zoom_to>(\d+)).json$',
+        views.get_ortho_dhm_extent, name="get_ortho_and_dhm_extent"),
+
+    # deliver the content of a pyramid tile (ortho, map, dhm or landuse) with http caching headers
+    url(r'^tile/(?P<pyramid>[a-z]+)/(?P<zoom>(\d+))/(?P<tile_x>(\d+))/(?P<tile_y>(\d+))\.(?P<file_ending>[a-z]+)$',
+        views.get_tile_file, name="get_tile_file")
 
 ]
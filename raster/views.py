@@ -1,20 +1,51 @@
-from django.http import JsonResponse
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import webmercator
+from django.http import JsonResponse, HttpResponse, HttpResponseBadRequest, FileResponse, Http404
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from django.views.decorators.csrf import csrf_exempt
 
 from landscapelab import utils
 from raster import png_to_response, process_maps
 
-from raster import tiles
+from raster import tiles, tile_storage
+from vegetation.splatmap import LAND_USE_BASE
 
 
 DHM_BASE = "raster/dhm"
 ORTHO_BASE = "raster/bmaporthofoto30cm"
 MAP_BASE = "raster/opentopomap"
 
+# all tile pyramids by name: (full path, whether derived tiles are EPX scaled, file ending of the tiles)
+PYRAMIDS = {
+    "ortho": (utils.get_full_texture_path(ORTHO_BASE), False, "jpg"),
+    "map": (utils.get_full_texture_path(MAP_BASE), False, "png"),
+    "dhm": (utils.get_full_texture_path(DHM_BASE), False, "png"),
+    "landuse": (LAND_USE_BASE, True, "png"),
+}
+
+# the number of seconds for which clients and proxies may cache a tile served by get_tile_file
+TILE_CACHE_MAX_AGE = 24 * 60 * 60
+
+# the maximum number of tiles which can be requested at once with get_ortho_dhm_batch
+MAX_TILES_PER_BATCH = 1024
+
+# missing tiles of a batch request are generated in parallel by these threads
+batch_executor = ThreadPoolExecutor(max_workers=8)
+
+logger = logging.getLogger(__name__)
+
 
-# delivers a static raster file by given filename as json
+# delivers a static raster file by given filename as binary response
 # TODO: we will use this for textures and precalculated orthos?
 def static_raster(request, filename):
-    return JsonResponse(png_to_response.request_to_png_response(filename))
+    return png_to_response.request_to_png_response(request, filename)
 
 
 # returns the pointer to the filename which contains the combined ortho and dhm info
@@ -26,9 +57,13 @@ def get_ortho_dhm(request, meter_x: str, meter_y: str, zoom: str):
     meter_y = float(meter_y)
 
     # TODO: maybe we add callbacks later to generate the files if they could not be found
-    filename_ortho = tiles.get_tile(meter_x, meter_y, zoom, utils.get_full_texture_path(ORTHO_BASE), False, "jpg")
-    filename_map = tiles.get_tile(meter_x, meter_y, zoom, utils.get_full_texture_path(MAP_BASE), False)
-    filename_dhm = tiles.get_tile(meter_x, meter_y, zoom, utils.get_full_texture_path(DHM_BASE))
+    try:
+        filename_ortho = tiles.get_tile(meter_x, meter_y, zoom, utils.get_full_texture_path(ORTHO_BASE), False, "jpg")
+        filename_map = tiles.get_tile(meter_x, meter_y, zoom, utils.get_full_texture_path(MAP_BASE), False)
+        filename_dhm = tiles.get_tile(meter_x, meter_y, zoom, utils.get_full_texture_path(DHM_BASE))
+    except ValueError as error:
+        logger.warning("Invalid tile request: {}".format(error))
+        return HttpResponseBadRequest()
 
     # answer with a json
     ret = {
@@ -37,3 +72,152 @@ def get_ortho_dhm(request, meter_x: str, meter_y: str, zoom: str):
         'dhm': utils.replace_path_prefix(filename_dhm)
     }
     return JsonResponse(ret)
+
+
+def get_ortho_dhm_paths(tile_x: int, tile_y: int, zoom: int):
+    """Returns a dictionary with the (client) paths of the ortho, map and dhm tile at the given tile coordinates"""
+
+    return {
+        'zoom': zoom,
+        'x': tile_x,
+        'y': tile_y,
+        'ortho': utils.replace_path_prefix(
+            tiles.get_tile_at(tile_x, tile_y, zoom, utils.get_full_texture_path(ORTHO_BASE), False, "jpg")),
+        'map': utils.replace_path_prefix(
+            tiles.get_tile_at(tile_x, tile_y, zoom, utils.get_full_texture_path(MAP_BASE), False)),
+        'dhm': utils.replace_path_prefix(
+            tiles.get_tile_at(tile_x, tile_y, zoom, utils.get_full_texture_path(DHM_BASE)))
+    }
+
+
+def get_ortho_dhm_for_tiles(tile_coordinates):
+    """Returns the ortho, map and dhm paths for all given (tile_x, tile_y, zoom) tuples, in the given order.
+
+    Missing tiles are generated in parallel, one zoom level after the other - this way, tiles of the higher zoom
+    levels can be cropped from the tiles which have just been generated for the lower ones instead of all of them
+    searching for and decoding the same distant ancestor.
+    """
+
+    results = {}
+
+    for zoom in sorted(set(zoom for tile_x, tile_y, zoom in tile_coordinates)):
+        coordinates_at_zoom = set(coordinates for coordinates in tile_coordinates if coordinates[2] == zoom)
+        paths = batch_executor.map(lambda coordinates: get_ortho_dhm_paths(*coordinates), coordinates_at_zoom)
+        results.update(zip(coordinates_at_zoom, paths))
+
+    return [results[coordinates] for coordinates in tile_coordinates]
+
+
+# returns the ortho, map and dhm filenames for a list of locations given as json in the request body:
+# {"tiles": [[meter_x, meter_y, zoom], ...]}
+@csrf_exempt
+def get_ortho_dhm_batch(request):
+
+    try:
+        requested_tiles = json.loads(request.body.decode("utf-8"))["tiles"]
+        tile_coordinates = []
+
+        for meter_x, meter_y, zoom in requested_tiles:
+            point = webmercator.Point(meter_x=float(meter_x), meter_y=float(meter_y), zoom_level=int(zoom))
+
+            if not tile_storage.is_valid_tile(int(zoom), point.tile_x, point.tile_y):
+                raise ValueError("{}, {} is not within the tile grid at zoom {}".format(meter_x, meter_y, zoom))
+
+            tile_coordinates.append((point.tile_x, point.tile_y, int(zoom)))
+    except (ValueError, KeyError, TypeError) as error:
+        logger.warning("Invalid batch tile request: {}".format(error))
+        return HttpResponseBadRequest()
+
+    if len(tile_coordinates) > MAX_TILES_PER_BATCH:
+        logger.warning("Batch tile request with {} tiles exceeded the maximum of {}"
+                       .format(len(tile_coordinates), MAX_TILES_PER_BATCH))
+        return HttpResponseBadRequest()
+
+    return JsonResponse({'tiles': get_ortho_dhm_for_tiles(tile_coordinates)})
+
+
+# returns the ortho, map and dhm filenames for all tiles within the given extent in the given zoom range
+def get_ortho_dhm_extent(request, min_x: str, min_y: str, max_x: str, max_y: str, zoom_from: str, zoom_to: str):
+
+    tile_ranges = []
+    number_of_tiles = 0
+
+    # The number of tiles is checked before any of them is enumerated, so huge extents are rejected right away
+    for zoom in range(int(zoom_from), int(zoom_to) + 1):
+        # the y tile coordinate grows southwards, so the upper left corner has the smallest tile coordinates
+        p_from = webmercator.Point(meter_x=float(min_x), meter_y=float(max_y), zoom_level=zoom)
+        p_to = webmercator.Point(meter_x=float(max_x), meter_y=float(min_y), zoom_level=zoom)
+
+        if not tile_storage.is_valid_tile(zoom, p_from.tile_x, p_from.tile_y) \
+                or not tile_storage.is_valid_tile(zoom, p_to.tile_x, p_to.tile_y):
+            logger.warning("Extent tile request is not within the tile grid at zoom {}".format(zoom))
+            return HttpResponseBadRequest()
+
+        number_of_tiles += max(p_to.tile_x - p_from.tile_x + 1, 0) * max(p_to.tile_y - p_from.tile_y + 1, 0)
+
+        if number_of_tiles > MAX_TILES_PER_BATCH:
+            logger.warning("Extent tile request exceeded the maximum of {} tiles".format(MAX_TILES_PER_BATCH))
+            return HttpResponseBadRequest()
+
+        tile_ranges.append((zoom, p_from, p_to))
+
+    tile_coordinates = [(x, y, zoom) for zoom, p_from, p_to in tile_ranges
+                        for x in range(p_from.tile_x, p_to.tile_x + 1)
+                        for y in range(p_from.tile_y, p_to.tile_y + 1)]
+
+    return JsonResponse({'tiles': get_ortho_dhm_for_tiles(tile_coordinates)})
+
+
+# delivers the content of a pyramid tile (e.g. /raster/tile/ortho/18/142641/91768.jpg)
+# missing tiles are generated like in get_ortho_dhm - clients which revalidate their copy get a 304 if it is unchanged
+def get_tile_file(request, pyramid: str, zoom: str, tile_x: str, tile_y: str, file_ending: str):
+
+    if pyramid not in PYRAMIDS or PYRAMIDS[pyramid][2] != file_ending:
+        raise Http404("Unknown pyramid {} with file ending {}".format(pyramid, file_ending))
+
+    path, do_epx_scale, file_ending = PYRAMIDS[pyramid]
+    zoom, tile_x, tile_y = int(zoom), int(tile_x), int(tile_y)
+
+    if not tile_storage.is_valid_tile(zoom, tile_x, tile_y):
+        raise Http404("Tile {}/{}/{} is not within the tile grid".format(zoom, tile_x, tile_y))
+
+    filename = tiles.get_tile_at(tile_x, tile_y, zoom, path, do_epx_scale, file_ending)
+    content_type = mimetypes.guess_type("tile." + file_ending)[0]
+
+    if filename is None:
+        # either the tile could not be created, or it is stored in a container file (see tile_storage)
+        data = tile_storage.get_storage(path, file_ending).read(zoom, tile_x, tile_y)
+        if data is None:
+            tiles.forget_tile(path, zoom, tile_x, tile_y, file_ending)
+            raise Http404("Tile {}/{}/{} of {} does not exist".format(zoom, tile_x, tile_y, pyramid))
+
+        etag = '"{}"'.format(hashlib.sha1(data).hexdigest())
+
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = HttpResponse(data, content_type=content_type)
+    else:
+        try:
+            tile_file = open(filename, "rb")
+        except OSError:
+            tiles.forget_tile(path, zoom, tile_x, tile_y, file_ending)
+            raise Http404("Tile {}/{}/{} of {} does not exist".format(zoom, tile_x, tile_y, pyramid))
+
+        # the tile only changes if it is replaced, e.g. by a prefetched version of a derived tile
+        modification_time = os.fstat(tile_file.fileno()).st_mtime_ns
+        etag = '"{}"'.format(hashlib.sha1("{}/{}/{}/{}/{}".format(pyramid, zoom, tile_x, tile_y, modification_time)
+                                          .encode("utf-8")).hexdigest())
+        last_modified = modification_time // 10 ** 9
+
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is not None:
+            tile_file.close()
+        else:
+            # the file is handed to the server as it is, which allows it to use sendfile if supported
+            response = FileResponse(tile_file, content_type=content_type)
+            response["Last-Modified"] = http_date(last_modified)
+
+    response["ETag"] = etag
+    response["Cache-Control"] = "public, max-age={}".format(TILE_CACHE_MAX_AGE)
+
+    return response
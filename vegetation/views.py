@@ -1,15 +1,24 @@
-from django.http import JsonResponse
+import logging
+
+from django.http import JsonResponse, HttpResponseBadRequest
 from django.conf import settings
 
 from landscapelab import utils
 from vegetation import generate_distribution, splatmap, phytocoenosis_textures, vegetation_spritesheet
 
+logger = logging.getLogger(__name__)
+
 
 def get_vegetation_splatmap(request, meter_x, meter_y, zoom):
     """Returns a JsonResponse with the path to the splatmap PNG for the given location"""
 
     zoom = int(zoom)
-    splat_path, ids = splatmap.get_splatmap_path_and_ids_for_coordinates(float(meter_x), float(meter_y), zoom)
+
+    try:
+        splat_path, ids = splatmap.get_splatmap_path_and_ids_for_coordinates(float(meter_x), float(meter_y), zoom)
+    except ValueError as error:
+        logger.warning("Invalid splatmap request: {}".format(error))
+        return HttpResponseBadRequest()
 
     res = {
         'path_to_splatmap': utils.replace_path_prefix(splat_path),